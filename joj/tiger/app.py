@@ -1,19 +1,24 @@
 import asyncio
 import logging
 import platform
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 from celery import Celery, Task
-from celery.signals import setup_logging
+from celery.signals import setup_logging, worker_process_init, worker_process_shutdown
 from loguru import logger
 from pydantic_universal_settings import init_settings
 from pydantic_universal_settings.cli import async_command
 from tenacity import RetryError
 
+from joj.tiger.batch import TigerBatch
 from joj.tiger.config import AllSettings
+from joj.tiger.pool import close_runner_pools, start_runner_pools
+from joj.tiger.reaper import flush_reaper, start_orphan_collector
 from joj.tiger.task import TigerTask
 from joj.tiger.toolchains import get_toolchains_config
+from joj.tiger.utils.docker import close_docker
 from joj.tiger.utils.retry import retry_init
+from joj.tiger.utils.signals import cancel_on_signal
 
 
 class InterceptHandler(logging.Handler):
@@ -46,6 +51,18 @@ def setup_celery_logging(*args: Any, **kwargs: Any) -> None:
     )
 
 
+@worker_process_init.connect
+def start_worker_process(*args: Any, **kwargs: Any) -> None:
+    start_orphan_collector()
+    start_runner_pools()
+
+
+@worker_process_shutdown.connect
+def stop_worker_process(*args: Any, **kwargs: Any) -> None:
+    close_runner_pools()
+    flush_reaper()
+
+
 settings = init_settings(AllSettings, overwrite=False)
 if settings.debug:
     logger.debug(f"settings: {settings}")
@@ -80,12 +97,37 @@ async def submit_task(
     self: Task, record_dict: Dict[str, Any], base_url: str
 ) -> Dict[str, Any]:
     task = TigerTask(self, record_dict, base_url)
-    submit_result = await task.submit()
-    logger.info(f"task[{task.id}] submit result: {submit_result}")
-    await task.clean()
+    try:
+        with cancel_on_signal():
+            submit_result = await task.submit()
+        logger.info(f"task[{task.id}] submit result: {submit_result}")
+        await task.clean()
+    finally:
+        await close_docker()
     return submit_result.json()
 
 
+@app.task(name="joj.tiger.batch", bind=True)
+@async_command
+async def batch_task(
+    self: Task,
+    record_dicts: List[Dict[str, Any]],
+    base_url: str,
+    max_parallel: Optional[int] = None,
+    results: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Judges the records at once, e.g. to rejudge a problem, see TigerBatch.
+    results holds those of the records judged by the previous tries.
+    """
+    batch = TigerBatch(self, record_dicts, base_url, max_parallel, results)
+    try:
+        with cancel_on_signal():
+            return await batch.submit()
+    finally:
+        await close_docker()
+
+
 async def startup(settings: AllSettings, *, test: bool = False) -> List[str]:
     async def startup_event() -> None:  # pragma: no cover
         @retry_init("Celery")
@@ -0,0 +1,765 @@
+import asyncio
+import math
+import os
+import struct
+import time
+import uuid
+from contextlib import AsyncExitStack
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import aiodocker
+import msgpack
+from aiodocker.containers import DockerContainer
+from aiodocker.stream import Stream
+from fs.base import FS
+
+from joj.tiger.reaper import container_labels, reap_container
+from joj.tiger.runner import (
+    RUNNER_DOCKER_IMAGE,
+    RUNNER_MEM_LIMIT,
+    RUNNER_MIN_FALLBACK_TIMEOUT,
+    RUNNER_PATH,
+    RUNNER_PIDS_LIMIT,
+    RUNNER_TMPFS_DIRS,
+    RUNNER_USERNAME,
+    RUNNER_WORKING_DIR_NAME,
+    RunnerCommandError,
+    fallback_timeout_command,
+    load_command_result,
+    runner_binary_archive,
+    tmpfs_volume_options,
+)
+from joj.tiger.schemas import CommandResult, RunnerCommand
+from joj.tiger.utils.archive import (
+    ArchiveMember,
+    directory_members,
+    file_members,
+    host_fs,
+    host_path,
+    iter_tar,
+    tar_file_contents,
+)
+from joj.tiger.utils.docker import get_docker
+from joj.tiger.utils.units import parse_memory
+
+
+class AsyncRunner:
+    """
+    The asyncio counterpart of Runner.
+
+    Instead of forking a docker CLI process for every operation, it talks
+    to the Docker Engine API through the pooled session returned by
+    get_docker(). An AsyncRunner only keeps the name of its container, and
+    resolves the session of the running event loop on each call, so the
+    same runner can be created on one event loop and used on another
+    (e.g. created by a RunnerPool and leased by a task).
+
+    Instances of this class are intended to be used with an async context
+    manager, which creates and destroys the underlying container.
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        docker_image: str = RUNNER_DOCKER_IMAGE,
+        allow_network_access: bool = False,
+        environment_variables: Optional[Mapping[str, str]] = None,
+        pids_limit: int = RUNNER_PIDS_LIMIT,
+        memory_limit: str = RUNNER_MEM_LIMIT,
+        min_fallback_timeout: int = RUNNER_MIN_FALLBACK_TIMEOUT,
+        runner_binary_installed: bool = False,
+        task_id: Optional[str] = None,
+        tmpfs_size: Optional[str] = None,
+        volumes: Optional[Mapping[str, str]] = None,
+        read_only_volumes: Optional[Mapping[str, str]] = None,
+        debug: bool = False,
+    ):
+        """
+        See Runner.__init__ for the meaning of the parameters.
+        """
+        if name is None:
+            self._name = "runner-{}".format(uuid.uuid4().hex)
+        else:
+            self._name = name
+        self._named = name is not None
+
+        self._docker_image = docker_image
+        self._allow_network_access = allow_network_access
+        self._environment_variables = environment_variables
+        self._is_running = False
+        self._pids_limit = pids_limit
+        self._memory_limit = memory_limit
+        self._min_fallback_timeout = min_fallback_timeout
+        self._runner_binary_installed = runner_binary_installed
+        self._task_id = task_id
+        self._created_at: Optional[float] = None
+        self._tmpfs_volume_options = (
+            None
+            if tmpfs_size is None
+            else tmpfs_volume_options(tmpfs_size, memory_limit)
+        )
+        self._volumes = dict(volumes or {})
+        self._read_only_volumes = dict(read_only_volumes or {})
+        self.debug = debug
+
+    async def __aenter__(self) -> "AsyncRunner":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.reap()
+
+    @property
+    def name(self) -> str:
+        """
+        The name used to identify this runner. (Read only)
+        """
+        return self._name
+
+    @property
+    def docker_image(self) -> str:
+        """
+        The name of the docker image to create the runner from.
+        """
+        return self._docker_image
+
+    @property
+    def task_id(self) -> Optional[str]:
+        """
+        The celery task the container is labelled with, see container_labels.
+        """
+        return self._task_id
+
+    @property
+    def created_at(self) -> Optional[float]:
+        """
+        When the underlying container was created, None if not started.
+        """
+        return self._created_at
+
+    @property
+    def allow_network_access(self) -> bool:
+        """
+        Whether network access is allowed by this runner. (Read only)
+        """
+        return self._allow_network_access
+
+    @property
+    def environment_variables(self) -> Mapping[str, str]:
+        """
+        A dictionary of environment variables to be set inside the
+        runner (Read only).
+        """
+        if not self._environment_variables:
+            return {}
+
+        return dict(self._environment_variables)
+
+    @property
+    def container(self) -> DockerContainer:
+        return get_docker().containers.container(self.name)
+
+    def _container_config(self) -> Dict[str, object]:
+        memory_limit = parse_memory(self._memory_limit)
+        host_config: Dict[str, object] = {
+            "Privileged": True,
+            "PidsLimit": self._pids_limit,
+            "Memory": memory_limit,
+            "MemorySwap": memory_limit,
+            "OomKillDisable": True,
+        }
+        if not self.allow_network_access:
+            host_config["NetworkMode"] = "none"
+        mounts: List[Dict[str, object]] = [
+            {"Type": "volume", "Source": volume, "Target": directory}
+            for volume, directory in self._volumes.items()
+        ] + [
+            {"Type": "volume", "Source": volume, "Target": directory, "ReadOnly": True}
+            for volume, directory in self._read_only_volumes.items()
+        ]
+        if self._tmpfs_volume_options is not None:
+            # anonymous volumes, removed along with the container
+            mounts += [
+                {
+                    "Type": "volume",
+                    "Target": directory,
+                    "VolumeOptions": {
+                        "DriverConfig": {
+                            "Name": "local",
+                            "Options": self._tmpfs_volume_options,
+                        }
+                    },
+                }
+                for directory in RUNNER_TMPFS_DIRS
+            ]
+        if mounts:
+            host_config["Mounts"] = mounts
+
+        return {
+            "Image": self.docker_image,
+            # Override any CMD or ENTRYPOINT directives used in custom images,
+            # see Runner._create_and_start.
+            "Entrypoint": [""],
+            "Cmd": ["/bin/bash"],
+            "OpenStdin": True,
+            "Tty": True,
+            "NetworkDisabled": not self.allow_network_access,
+            "Env": [
+                "{}={}".format(key, value)
+                for key, value in self.environment_variables.items()
+            ],
+            "Labels": container_labels(self._task_id, self._created_at),
+            "HostConfig": host_config,
+        }
+
+    async def start(self) -> None:
+        """
+        Creates and starts the underlying docker container, then copies the
+        runner binary into it unless the image already contains it.
+        """
+        docker = get_docker()
+        self._created_at = time.time()
+        container = await docker.containers.create(
+            config=self._container_config(), name=self.name
+        )
+        try:
+            await container.start()
+            if not self._runner_binary_installed:
+                await container.put_archive(
+                    os.path.dirname(RUNNER_PATH), runner_binary_archive()
+                )
+        except aiodocker.DockerError:
+            await container.delete(force=True)
+            raise
+
+        self._is_running = True
+
+    async def destroy(self) -> None:
+        """
+        Kills and removes the underlying docker container.
+        """
+        await self.container.delete(force=True, v=True)
+        self._is_running = False
+
+    async def reap(self) -> None:
+        """
+        See Runner.reap.
+        """
+        if self._named:
+            await self.destroy()
+            return
+        await asyncio.wrap_future(reap_container(self.name))
+        self._is_running = False
+
+    async def clean(self) -> None:
+        """
+        See Runner.clean.
+        """
+        clean_script = (
+            "kill -9 -1; "
+            "find {working_dir} /tmp -mindepth 1 -maxdepth 1 -exec rm -rf {{}} +"
+        ).format(working_dir=RUNNER_WORKING_DIR_NAME)
+        exit_code, stdout, stderr = await self._exec(["sh", "-c", clean_script])
+        if exit_code != 0:
+            raise RunnerCommandError(
+                stdout.decode("utf-8", "surrogateescape")
+                + "\n"
+                + stderr.decode("utf-8", "surrogateescape")
+            )
+
+    async def _exec(self, cmd: List[str]) -> Tuple[int, bytearray, bytearray]:
+        exec_ = await self.container.exec(
+            cmd, stdout=True, stderr=True, stdin=False, tty=False
+        )
+        stdout = bytearray()
+        stderr = bytearray()
+        async with exec_.start(detach=False) as stream:
+            while True:
+                message = await stream.read_out()
+                if message is None:
+                    break
+                if message.stream == 1:
+                    stdout += message.data
+                else:
+                    stderr += message.data
+        exit_code = (await exec_.inspect())["ExitCode"]
+        return exit_code, stdout, stderr
+
+    def get_fallback_timeout(self, timeout: Optional[int]) -> Optional[int]:
+        """
+        The time limit applied on the python side to a command with the
+        given timeout, see Runner.__init__.
+        """
+        if timeout is None:
+            return None
+        return max(timeout * 2, self._min_fallback_timeout)
+
+    async def run_command(
+        self,
+        args: List[str],
+        timeout: Optional[int] = None,
+        check: bool = False,
+        truncate_stdout: Optional[int] = None,
+        truncate_stderr: Optional[int] = None,
+        output_limit: Optional[int] = None,
+        stdout_file: Optional[str] = None,
+        stderr_file: Optional[str] = None,
+        stdin_file: Optional[str] = None,
+    ) -> CommandResult:
+        """
+        Runs a command inside the runner and returns the results.
+
+        :param args: A list of strings that specify which command should
+            be run inside the runner.
+
+        :param timeout: The time limit for the command, in seconds of cpu
+            time.
+
+        :param check: Causes RunnerCommandError to be raised if the
+            command exits nonzero or times out.
+
+        :param truncate_stdout: When not None, stdout from the command
+            will be truncated after this many bytes. Otherwise the runner
+            binary still truncates it after RUNNER_DEFAULT_TRUNCATE bytes.
+
+        :param truncate_stderr: Same as truncate_stdout, for stderr.
+
+        :param output_limit: When not None, the command is killed as soon
+            as its stdout or stderr exceeds this many bytes, and
+            output_limit_exceeded is set in the result.
+
+        :param stdout_file: When not None, the whole stdout (up to
+            output_limit) is also written to this file inside the runner.
+
+        :param stderr_file: Same as stdout_file, for stderr.
+
+        :param stdin_file: A file inside the runner opened as the command's
+            stdin, see Runner.run_command.
+        """
+        command = RunnerCommand(
+            args=args,
+            truncate_stdout=truncate_stdout,
+            truncate_stderr=truncate_stderr,
+            output_limit=output_limit,
+            stdout_file=stdout_file,
+            stderr_file=stderr_file,
+            stdin_file=stdin_file,
+            time_limit=_time_limit(timeout),
+        )
+        # names the cgroup of the command, to kill it if abandoned
+        command_name = uuid.uuid4().hex
+        cmd = [RUNNER_PATH, "--name", command_name] + command.to_flags()
+        cmd += ["--"] + args
+
+        if self.debug:
+            print("running: {}".format(cmd), flush=True)
+
+        try:
+            exit_code, stdout, stderr = await asyncio.wait_for(
+                self._exec(cmd), self.get_fallback_timeout(timeout)
+            )
+        except asyncio.TimeoutError:
+            await self.kill_command(command_name)
+            return fallback_timeout_command()
+        except asyncio.CancelledError:
+            await asyncio.shield(self.kill_command(command_name))
+            raise
+
+        if exit_code != 0:
+            raise RunnerCommandError(
+                stdout.decode("utf-8", "surrogateescape")
+                + "\n"
+                + stderr.decode("utf-8", "surrogateescape")
+            )
+
+        result, _ = load_command_result(memoryview(stdout))
+        if (result.return_code != 0 or result.timed_out) and check:
+            raise RunnerCommandError(
+                bytes(result.stdout).decode("utf-8", "surrogateescape")
+                + "\n"
+                + bytes(result.stderr).decode("utf-8", "surrogateescape")
+            )
+        return result
+
+    async def kill_command(self, command_name: str) -> None:
+        """
+        Kills a command run by run_command with all its child processes.
+        Abandoning a docker exec does not stop the process it started, so
+        this is how a command exceeding its fallback timeout (or whose caller
+        was cancelled) stops using the cpu. The other commands of the runner,
+        including those of a RunnerDaemon, are left alone.
+
+        :param command_name: The --name the command was run with.
+        """
+        await self._exec([RUNNER_PATH, "--kill", command_name])
+
+    async def run_batch(
+        self,
+        commands: Sequence[RunnerCommand],
+        timeout: Optional[int] = None,
+        check: bool = False,
+    ) -> AsyncIterator[CommandResult]:
+        """
+        Runs all the commands with a single daemon, see RunnerDaemon.run_batch.
+        """
+        async with RunnerDaemon(self) as daemon:
+            async for result in daemon.run_batch(commands, timeout, check):
+                yield result
+
+    async def put_archive(self, path: str, chunks: Iterable[bytes]) -> None:
+        """
+        Streams a tar archive into the runner and extracts it at path. The
+        chunks are produced in the default executor, since building them
+        reads files.
+        """
+        await self.container.put_archive(path, _iterate_in_executor(chunks))
+
+    async def _put_members(
+        self,
+        fs: FS,
+        members: Iterable[ArchiveMember],
+        owner: str,
+        read_only: bool,
+    ) -> None:
+        if owner != RUNNER_USERNAME and owner != "root":
+            raise ValueError('Invalid value for parameter "owner": {}'.format(owner))
+
+        await self.put_archive(
+            RUNNER_WORKING_DIR_NAME,
+            iter_tar(fs, members, uname=owner, read_only=read_only),
+        )
+
+    async def add_directory(
+        self,
+        directory: str,
+        *,
+        fs: Optional[FS] = None,
+        owner: str = RUNNER_USERNAME,
+        read_only: bool = False,
+    ) -> None:
+        """
+        See Runner.add_directory.
+        """
+        if fs is None:
+            fs, directory = host_fs(), host_path(directory)
+        await self._put_members(fs, directory_members(fs, directory), owner, read_only)
+
+    async def add_files(
+        self,
+        *filenames: str,
+        fs: Optional[FS] = None,
+        owner: str = RUNNER_USERNAME,
+        read_only: bool = False,
+    ) -> None:
+        """
+        See Runner.add_files. Ownership and permissions are set in the
+        archive headers, so no extra command is run inside the runner.
+        """
+        if fs is None:
+            fs, filenames = host_fs(), tuple(map(host_path, filenames))
+        await self._put_members(fs, file_members(fs, filenames), owner, read_only)
+
+    async def get_files(self, *paths: str) -> Dict[str, bytes]:
+        """
+        See Runner.get_files.
+        """
+        files = {}
+        for path in paths:
+            path = os.path.join(RUNNER_WORKING_DIR_NAME, path)
+            tar_file = await self.container.get_archive(path)
+            with tar_file:
+                files.update(tar_file_contents(tar_file, os.path.dirname(path)))
+        return files
+
+
+DAEMON_FRAME_HEADER = struct.Struct(">I")
+
+
+class RunnerDaemon:
+    """
+    A client of the runner binary running in daemon mode inside an
+    AsyncRunner.
+
+    The daemon is started with a single docker exec and reads commands from
+    its stdin as length-prefixed msgpack frames. Commands are executed one
+    at a time in the order they were sent, each response carries the ID of
+    its request, so callers can pipeline requests without waiting for the
+    previous ones. Compared to AsyncRunner.run_command, no docker exec,
+    process spawn or cgroup setup is paid per command.
+
+    The client is bound to the event loop it was started on.
+    """
+
+    def __init__(self, runner: AsyncRunner):
+        self._runner = runner
+        self._exit_stack = AsyncExitStack()
+        self._stream: Optional[Stream] = None
+        self._reader: Optional["asyncio.Task[None]"] = None
+        self._pending: Dict[int, "asyncio.Future[CommandResult]"] = {}
+        self._next_id = 0
+
+    async def __aenter__(self) -> "RunnerDaemon":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.stop()
+
+    @property
+    def runner(self) -> AsyncRunner:
+        return self._runner
+
+    async def start(self) -> None:
+        exec_ = await self._runner.container.exec(
+            [RUNNER_PATH, "--daemon"], stdout=True, stderr=True, stdin=True, tty=False
+        )
+        self._stream = await self._exit_stack.enter_async_context(
+            exec_.start(detach=False)
+        )
+        self._reader = asyncio.create_task(self._read_responses())
+
+    async def stop(self) -> None:
+        # closing the attached stream closes the stdin of the daemon
+        await self._exit_stack.aclose()
+        if self._reader is not None:
+            await self._reader
+
+    async def _read_responses(self) -> None:
+        assert self._stream is not None
+        # Every frame is copied once from the stream into a buffer of its own
+        # size, which the outputs of its result then reference. The frame
+        # header is accumulated separately since it may be split across
+        # messages too.
+        header = bytearray()
+        frame: Optional[bytearray] = None
+        filled = 0
+        try:
+            while True:
+                message = await self._stream.read_out()
+                if message is None:
+                    break
+                if message.stream != 1:
+                    if self._runner.debug:
+                        print(message.data.decode("utf-8", "surrogateescape"), end="")
+                    continue
+                data = memoryview(message.data)
+                while data:
+                    if frame is None:
+                        needed = DAEMON_FRAME_HEADER.size - len(header)
+                        header += data[:needed]
+                        data = data[needed:]
+                        if len(header) < DAEMON_FRAME_HEADER.size:
+                            break
+                        (length,) = DAEMON_FRAME_HEADER.unpack(header)
+                        header.clear()
+                        frame = bytearray(length)
+                        filled = 0
+                    chunk = data[: len(frame) - filled]
+                    frame[filled : filled + len(chunk)] = chunk
+                    filled += len(chunk)
+                    data = data[len(chunk) :]
+                    if filled == len(frame):
+                        self._resolve(frame)
+                        frame = None
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(RunnerCommandError("runner daemon exited"))
+            self._pending.clear()
+
+    def _resolve(self, frame: bytearray) -> None:
+        result, header = load_command_result(memoryview(frame))
+        future = self._pending.pop(header["ID"], None)
+        if future is None or future.done():
+            # the caller gave up waiting (e.g. fallback timeout)
+            return
+        if header.get("Error"):
+            future.set_exception(RunnerCommandError(header["Error"]))
+        else:
+            future.set_result(result)
+
+    def _new_request(
+        self, command: RunnerCommand
+    ) -> Tuple[int, bytes, "asyncio.Future[CommandResult]"]:
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        return request_id, _frame(command.to_request(request_id)), future
+
+    async def kill(self, *request_ids: int) -> None:
+        """
+        Kills the commands of the given requests, whether they are running
+        or still queued in the daemon, together with their child processes.
+        Errors are ignored, since the daemon may have exited meanwhile.
+        """
+        if self._stream is None or not request_ids:
+            return
+        try:
+            await self._stream.write_in(
+                b"".join(_frame({"Kill": request_id}) for request_id in request_ids)
+            )
+        except (OSError, RuntimeError):
+            pass
+
+    async def run_command(
+        self,
+        args: List[str],
+        timeout: Optional[int] = None,
+        check: bool = False,
+        truncate_stdout: Optional[int] = None,
+        truncate_stderr: Optional[int] = None,
+        output_limit: Optional[int] = None,
+        stdout_file: Optional[str] = None,
+        stderr_file: Optional[str] = None,
+        stdin_file: Optional[str] = None,
+    ) -> CommandResult:
+        """
+        Runs a command through the daemon, see AsyncRunner.run_command.
+        """
+        return await self.run(
+            RunnerCommand(
+                args=args,
+                truncate_stdout=truncate_stdout,
+                truncate_stderr=truncate_stderr,
+                output_limit=output_limit,
+                stdout_file=stdout_file,
+                stderr_file=stderr_file,
+                stdin_file=stdin_file,
+                time_limit=_time_limit(timeout),
+            ),
+            timeout,
+            check,
+        )
+
+    async def run(
+        self,
+        command: RunnerCommand,
+        timeout: Optional[int] = None,
+        check: bool = False,
+    ) -> CommandResult:
+        """
+        Runs a command with its own limits through the daemon, see run_batch
+        for the meaning of timeout.
+        """
+        if self._stream is None:
+            raise RuntimeError("runner daemon is not started")
+
+        if self._runner.debug:
+            print("running: {}".format(command.args), flush=True)
+
+        request_id, frame, future = self._new_request(command)
+        await self._stream.write_in(frame)
+        return await self._wait_result(
+            request_id,
+            future,
+            timeout if timeout is not None else _timeout(command),
+            check,
+        )
+
+    async def run_batch(
+        self,
+        commands: Sequence[RunnerCommand],
+        timeout: Optional[int] = None,
+        check: bool = False,
+    ) -> AsyncIterator[CommandResult]:
+        """
+        Sends all the commands to the daemon in a single write and yields
+        their results one by one, in order, as soon as each one finishes.
+        check has the same meaning as in run_command. The fallback timeout
+        of a command is derived from its own time limit, unless timeout is
+        given for all of them.
+        """
+        if self._stream is None:
+            raise RuntimeError("runner daemon is not started")
+
+        if self._runner.debug:
+            print("running batch: {}".format(commands), flush=True)
+
+        request_ids = []
+        frames = []
+        futures = []
+        for command in commands:
+            request_id, frame, future = self._new_request(command)
+            request_ids.append(request_id)
+            frames.append(frame)
+            futures.append(future)
+        await self._stream.write_in(b"".join(frames))
+        try:
+            for request_id, command, future in zip(request_ids, commands, futures):
+                yield await self._wait_result(
+                    request_id,
+                    future,
+                    timeout if timeout is not None else _timeout(command),
+                    check,
+                )
+        finally:
+            # the caller stopped early (error, cancellation or break), the
+            # remaining commands must not keep running in the daemon
+            unfinished = [
+                request_id
+                for request_id, future in zip(request_ids, futures)
+                if future.cancel()
+            ]
+            await asyncio.shield(self.kill(*unfinished))
+
+    async def _wait_result(
+        self,
+        request_id: int,
+        future: "asyncio.Future[CommandResult]",
+        timeout: Optional[int],
+        check: bool,
+    ) -> CommandResult:
+        try:
+            result = await asyncio.wait_for(
+                future, self._runner.get_fallback_timeout(timeout)
+            )
+        except asyncio.TimeoutError:
+            await self.kill(request_id)
+            return fallback_timeout_command()
+        except asyncio.CancelledError:
+            await asyncio.shield(self.kill(request_id))
+            raise
+
+        if (result.return_code != 0 or result.timed_out) and check:
+            raise RunnerCommandError(
+                bytes(result.stdout).decode("utf-8", "surrogateescape")
+                + "\n"
+                + bytes(result.stderr).decode("utf-8", "surrogateescape")
+            )
+        return result
+
+
+def _frame(request: Dict[str, Any]) -> bytes:
+    body = msgpack.packb(request)
+    return DAEMON_FRAME_HEADER.pack(len(body)) + body
+
+
+def _time_limit(timeout: Optional[int]) -> Optional[int]:
+    return timeout * 1000 if timeout is not None else None
+
+
+def _timeout(command: RunnerCommand) -> Optional[int]:
+    if command.time_limit is None:
+        return None
+    return math.ceil(command.time_limit / 1000)
+
+
+async def _iterate_in_executor(chunks: Iterable[bytes]) -> AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    iterator = iter(chunks)
+    while True:
+        chunk = await loop.run_in_executor(None, next, iterator, None)
+        if chunk is None:
+            return
+        yield chunk
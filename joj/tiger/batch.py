@@ -0,0 +1,155 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from celery import Task
+from loguru import logger
+
+from joj.tiger import errors
+from joj.tiger.config import settings
+from joj.tiger.horse_apis import HorseClient
+from joj.tiger.pool import RunnerPool
+from joj.tiger.session import JudgeSession
+from joj.tiger.task import TigerTask
+
+
+class BatchRecordTask(TigerTask):
+    """
+    A record judged as part of a TigerBatch, with the horse client and the
+    sessions of the batch.
+    """
+
+    def __init__(self, batch: "TigerBatch", record: Dict[str, Any]) -> None:
+        super().__init__(batch.task, record, batch.base_url, batch.horse_client)
+        self.batch = batch
+
+    async def login(self) -> None:
+        # the batch logs in once for all its records
+        pass
+
+    async def open_session(self) -> JudgeSession:
+        return await self.batch.lease_session(self.runner_pool(), self.task_id)
+
+    async def close_session(self, session: JudgeSession) -> None:
+        await self.batch.release_session(session)
+
+    def retry(self) -> None:
+        # only the records that need it are retried, see TigerBatch.submit
+        raise errors.RetryableError(f"record {self.record['id']} to be retried")
+
+
+class TigerBatch:
+    """
+    Judges a batch of records at once, e.g. when the records of a problem
+    are rejudged after its config changed.
+
+    The records are claimed, judged and submitted one by one as in a
+    TigerTask, and the progress of the celery task is updated as each of
+    them is submitted, but up to max_parallel of them are judged at the
+    same time, after logging in once. The problem config is fetched once
+    per commit, the records share it through the problem cache. The
+    sessions are kept across records: a session is recycled and reused by
+    the next record judged in the same pool instead of being handed back,
+    up to image.max_reuse records as the runners of a pool. With the
+    default max_reuse of 1, no session is reused, and a batch only saves
+    the logins, the problem configs and the waits between the records.
+
+    The records failing with a retryable error are retried by retrying the
+    celery task, along with the results of the records judged so far, so
+    that the final result of the task covers the whole batch.
+    """
+
+    def __init__(
+        self,
+        task: Task,
+        records: List[Dict[str, Any]],
+        base_url: str,
+        max_parallel: Optional[int] = None,
+        results: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.task = task
+        self.records = records
+        self.base_url = base_url
+        self.max_parallel = max(1, max_parallel or settings.max_parallel_records)
+        self.horse_client = HorseClient(base_url)
+        # including those of the previous tries of the task
+        self.results: Dict[str, str] = dict(results or {})
+        self.total = len(self.results) + len(records)
+        self._idle: List[JudgeSession] = []
+        # records judged by the sessions, by runner name
+        self._uses: Dict[str, int] = {}
+
+    async def lease_session(self, pool: RunnerPool, task_id: str) -> JudgeSession:
+        for session in self._idle:
+            if session.pool is pool:
+                self._idle.remove(session)
+                return session
+        session = JudgeSession(pool, task_id=task_id)
+        await session.start()
+        return session
+
+    async def release_session(self, session: JudgeSession) -> None:
+        uses = self._uses.pop(session.runner.name, 0) + 1
+        if uses >= session.pool.image.max_reuse:
+            await session.stop()
+            return
+        try:
+            await session.recycle()
+        except Exception as e:
+            logger.warning(f"judge session not recycled: {e}")
+            await session.stop()
+        else:
+            self._uses[session.runner.name] = uses
+            self._idle.append(session)
+
+    async def _judge(self, record: Dict[str, Any]) -> None:
+        record_task = BatchRecordTask(self, record)
+        try:
+            submit_res = await record_task.submit()
+        finally:
+            await record_task.clean()
+        record_id = str(record["id"])
+        self.results[record_id] = submit_res.json()
+        self.task.update_state(
+            state="PROGRESS",
+            meta={
+                "record_id": record_id,
+                "submit_result": self.results[record_id],
+                "done": len(self.results),
+                "total": self.total,
+            },
+        )
+
+    async def submit(self) -> Dict[str, str]:
+        """
+        Judges all the records and returns their results by record id. The
+        records that fail with a retryable error are retried in a new batch
+        once the others are judged, which returns the results of both.
+        """
+        await self.horse_client.login()
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        retried: List[Dict[str, Any]] = []
+
+        async def judge(record: Dict[str, Any]) -> None:
+            async with semaphore:
+                try:
+                    await self._judge(record)
+                except errors.RetryableError:
+                    retried.append(record)
+                except Exception as e:
+                    logger.exception(e)
+
+        try:
+            await asyncio.gather(*[judge(record) for record in self.records])
+        finally:
+            while self._idle:
+                await self._idle.pop().stop()
+        logger.info(
+            f"batch {self.task.request.id}: {len(self.results)}/{self.total} "
+            f"records judged, {len(retried)} retried"
+        )
+        if retried:
+            self.task.retry(
+                args=(retried, self.base_url, self.max_parallel, self.results),
+                countdown=5,
+            )
+        return self.results
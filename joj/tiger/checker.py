@@ -0,0 +1,347 @@
+import asyncio
+import re
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from joj.tiger.schemas import CheckMode, CheckResult, Output
+from joj.tiger.utils.archive import iter_file
+
+CHECKER_CHUNK_SIZE = 2**16
+CHECKER_FLOAT_TOLERANCE = 1e-6
+# longer tokens are never parsed as numbers, only compared byte by byte
+CHECKER_FLOAT_MAX_LENGTH = 256
+
+_TOKEN = re.compile(rb"\S+")
+_TRAILING_WHITESPACE = b" \t\r\f\v"
+
+# (offset in the stream, data), an item (a line or a token) starting at the
+# offset when data is None, or else a slice of the current item, which ends
+# where the next one starts
+Event = Tuple[int, Optional[memoryview]]
+
+
+def iter_output(
+    output: Output, chunk_size: int = CHECKER_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Slices the output of a command into chunks, without copying it if it is
+    a memoryview.
+    """
+    view = memoryview(output)
+    for start in range(0, len(view), chunk_size):
+        yield view[start : start + chunk_size]  # type: ignore
+
+
+def _common_prefix(a: Union[bytes, memoryview], b: Union[bytes, memoryview]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def _check_exact(output: Iterable[bytes], answer: Iterable[bytes]) -> CheckResult:
+    offset = 0
+    output_buffer = answer_buffer = memoryview(b"")
+    output_chunks, answer_chunks = iter(output), iter(answer)
+    while True:
+        if not output_buffer:
+            output_buffer = memoryview(next(output_chunks, b""))
+        if not answer_buffer:
+            answer_buffer = memoryview(next(answer_chunks, b""))
+        if not output_buffer or not answer_buffer:
+            if output_buffer or answer_buffer:
+                return CheckResult(accepted=False, offset=offset)
+            return CheckResult(accepted=True)
+        n = min(len(output_buffer), len(answer_buffer))
+        if output_buffer[:n] != answer_buffer[:n]:
+            return CheckResult(
+                accepted=False,
+                offset=offset + _common_prefix(output_buffer, answer_buffer),
+            )
+        offset += n
+        output_buffer, answer_buffer = output_buffer[n:], answer_buffer[n:]
+
+
+def _iter_tokens(chunks: Iterable[bytes]) -> Iterator[Event]:
+    """
+    Splits a stream into whitespace separated tokens, see Event. A token
+    spanning several chunks is made of a slice of each of them.
+    """
+    offset = 0  # of the chunk in the stream
+    in_token = False  # at the end of the previous chunk
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if not view:
+            continue
+        continued, in_token = in_token, False
+        for match in _TOKEN.finditer(view):
+            start, end = match.span()
+            if start > 0 or not continued:
+                yield offset + start, None
+            yield offset + start, view[start:end]
+            in_token = end == len(view)
+        offset += len(view)
+
+
+def _iter_lines(chunks: Iterable[bytes]) -> Iterator[Event]:
+    """
+    Splits a stream into lines without their trailing whitespace, see Event,
+    and drops the empty lines at its end. Whitespace is held back until it
+    is known not to be trailing, and only a count of the empty lines is
+    kept until a non-empty line follows them, so they are all reported at
+    the offset of the first one.
+    """
+    offset = 0  # of the chunk in the stream
+    line_start = 0
+    started = False  # whether the current line was reported
+    pending: List[Event] = []  # whitespace of the current line
+    empty_start, empty_count = 0, 0
+    for chunk in chunks:
+        data = bytes(chunk)
+        view = memoryview(data)
+        start = 0
+        while start <= len(data):
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = len(data)
+            content_end = start + len(data[start:end].rstrip(_TRAILING_WHITESPACE))
+            if content_end > start:
+                if not started:
+                    for _ in range(empty_count):
+                        yield empty_start, None
+                    empty_count = 0
+                    yield line_start, None
+                    started = True
+                yield from pending
+                pending.clear()
+                yield offset + start, view[start:content_end]
+            if end > content_end:
+                pending.append((offset + content_end, view[content_end:end]))
+            if end == len(data):
+                break
+            # end of the line
+            if not started:
+                if empty_count == 0:
+                    empty_start = line_start
+                empty_count += 1
+            started = False
+            pending.clear()
+            start = end + 1
+            line_start = offset + start
+        offset += len(data)
+
+
+class _Events:
+    """
+    Reads the events of a stream item by item, see Event.
+    """
+
+    def __init__(self, events: Iterator[Event]):
+        self._events = events
+        self._next = next(events, None)
+
+    def next_item(self) -> Optional[int]:
+        """
+        Skips what is left of the current item and returns the offset of the
+        next one, None if there is none.
+        """
+        while self._next is not None and self._next[1] is not None:
+            self._next = next(self._events, None)
+        if self._next is None:
+            return None
+        offset = self._next[0]
+        self._next = next(self._events, None)
+        return offset
+
+    def read(self) -> Optional[Tuple[int, memoryview]]:
+        """
+        Returns the next slice of the current item, None at its end.
+        """
+        if self._next is None:
+            return None
+        offset, data = self._next
+        if data is None:
+            return None
+        self._next = next(self._events, None)
+        return offset, data
+
+    def read_item(self, head: bytes, max_length: int) -> Optional[bytes]:
+        """
+        Returns head followed by what is left of the current item, None if
+        longer than max_length.
+        """
+        parts = [head]
+        length = len(head)
+        while length <= max_length:
+            event = self.read()
+            if event is None:
+                return b"".join(parts)
+            length += len(event[1])
+            parts.append(bytes(event[1]))
+        return None
+
+
+def _parse_float(token: bytes) -> Optional[float]:
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+
+def _floats_equal(output: bytes, answer: bytes, float_tolerance: float) -> bool:
+    output_value, answer_value = _parse_float(output), _parse_float(answer)
+    if output_value is None or answer_value is None:
+        return False
+    return abs(output_value - answer_value) <= float_tolerance * max(
+        1.0, abs(answer_value)
+    )
+
+
+def _compare_items(
+    output: _Events,
+    answer: _Events,
+    offset: int,
+    mode: CheckMode,
+    float_tolerance: float,
+) -> Optional[int]:
+    """
+    Compares the current items of the output and the answer slice by slice,
+    the one of the output starting at offset, and returns where the output
+    first differs, None if the items are equal. In float mode, the items
+    are then compared as numbers, the common prefix of the items being kept
+    for that up to CHECKER_FLOAT_MAX_LENGTH.
+    """
+    start = offset
+    output_data = answer_data = memoryview(b"")
+    prefix = bytearray()
+    while True:
+        if not output_data:
+            event = output.read()
+            if event is not None:
+                offset, output_data = event
+        if not answer_data:
+            event = answer.read()
+            if event is not None:
+                answer_data = event[1]
+        n = min(len(output_data), len(answer_data))
+        if n == 0 and not output_data and not answer_data:
+            return None
+        if n == 0 or output_data[:n] != answer_data[:n]:
+            break
+        if mode == CheckMode.float and len(prefix) <= CHECKER_FLOAT_MAX_LENGTH:
+            prefix += output_data[: min(n, CHECKER_FLOAT_MAX_LENGTH + 1 - len(prefix))]
+        offset += n
+        output_data, answer_data = output_data[n:], answer_data[n:]
+    if mode != CheckMode.float:
+        return offset + _common_prefix(output_data, answer_data)
+
+    def read_token(events: _Events, data: memoryview) -> Optional[bytes]:
+        if len(prefix) + len(data) > CHECKER_FLOAT_MAX_LENGTH:
+            return None
+        return events.read_item(bytes(prefix + data), CHECKER_FLOAT_MAX_LENGTH)
+
+    output_token = read_token(output, output_data)
+    answer_token = read_token(answer, answer_data)
+    if output_token is None or answer_token is None:
+        return start
+    if not _floats_equal(output_token, answer_token, float_tolerance):
+        return start
+    return None
+
+
+def _check_items(
+    output: _Events,
+    answer: _Events,
+    mode: CheckMode,
+    float_tolerance: float,
+    output_size: Callable[[], int],
+) -> CheckResult:
+    """
+    Compares the items of the output and the answer, the size of the output
+    is only known once its items are exhausted.
+    """
+    while True:
+        output_offset = output.next_item()
+        answer_offset = answer.next_item()
+        if output_offset is None:
+            if answer_offset is None:
+                return CheckResult(accepted=True)
+            return CheckResult(accepted=False, offset=output_size())
+        if answer_offset is None:
+            return CheckResult(accepted=False, offset=output_offset)
+        offset = _compare_items(output, answer, output_offset, mode, float_tolerance)
+        if offset is not None:
+            return CheckResult(accepted=False, offset=offset)
+
+
+def check(
+    output: Iterable[bytes],
+    answer: Iterable[bytes],
+    mode: CheckMode = CheckMode.exact,
+    float_tolerance: float = CHECKER_FLOAT_TOLERANCE,
+) -> CheckResult:
+    """
+    Compares the output of a command with the expected answer, both given as
+    streams of chunks, and stops at the first difference. The offset of the
+    result is where the output first differs, in bytes from its start.
+
+    - exact: the bytes must be identical.
+    - trailing_whitespace: the lines must be identical once stripped of their
+      trailing whitespace, ignoring the empty lines at the end.
+    - token: the whitespace separated tokens must be identical.
+    - float: same as token, but tokens that are both numbers are equal when
+      their difference is at most float_tolerance, absolute or relative to
+      the answer, whichever is larger.
+
+    The chunks are compared as they come, slice by slice, without keeping
+    whole lines or tokens in memory (but for the tokens compared as numbers
+    in float mode, up to CHECKER_FLOAT_MAX_LENGTH).
+    """
+    if mode == CheckMode.exact:
+        return _check_exact(output, answer)
+
+    output_size = 0
+
+    def counted(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        nonlocal output_size
+        for chunk in chunks:
+            output_size += len(chunk)
+            yield chunk
+
+    split = _iter_lines if mode == CheckMode.trailing_whitespace else _iter_tokens
+    return _check_items(
+        _Events(split(counted(output))),
+        _Events(split(answer)),
+        mode,
+        float_tolerance,
+        lambda: output_size,
+    )
+
+
+async def check_output(
+    output: Output,
+    open_answer: Callable[[], IO[bytes]],
+    mode: CheckMode = CheckMode.exact,
+    float_tolerance: float = CHECKER_FLOAT_TOLERANCE,
+) -> CheckResult:
+    """
+    Checks the output of a command against the answer file returned by
+    open_answer, see check. The answer is opened, read and compared in the
+    default executor, so that the event loop is not blocked.
+
+    Only the answer is streamed from its file: the output is already whole
+    in memory (up to RUNNER_OUTPUT_LIMIT), as the runner returns it in the
+    result of the command. It is sliced without being copied.
+    """
+
+    def sync_func() -> CheckResult:
+        with open_answer() as answer:
+            return check(
+                iter_output(output),
+                iter_file(answer, CHECKER_CHUNK_SIZE),
+                mode,
+                float_tolerance,
+            )
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, sync_func)
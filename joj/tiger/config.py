@@ -11,6 +11,8 @@ from pydantic_universal_settings import (
     get_settings_proxy,
 )
 
+from joj.tiger.schemas import CheckMode
+
 
 class BaseConfig(BaseSettings):
     debug: bool = False
@@ -39,6 +41,27 @@ class BaseConfig(BaseSettings):
     queues: str = "default"
     queues_type: str = "official"
 
+    # judge config
+    max_parallel_cases: int = 1
+    # records of a batch judged at the same time, see TigerBatch
+    max_parallel_records: int = 4
+    # how case outputs are compared with the answers, see CheckMode
+    output_check_mode: CheckMode = CheckMode.trailing_whitespace
+    # problem configs and data cached on the local disk, shared by the
+    # worker processes, see DirectoryCache
+    problem_cache_dir: str = "/tmp/joj-tiger-problems"
+    problem_cache_size: str = "10g"
+    # compiled working directories, keyed by sources, compile args and image
+    artifact_cache_dir: str = "/tmp/joj-tiger-artifacts"
+    artifact_cache_size: str = "2g"
+    # reuse the results of identical submissions, kept in "redis" (for
+    # result_cache_ttl seconds) or "local"ly in result_cache_dir, disabled
+    # if empty, see ResultCache
+    result_cache: str = ""
+    result_cache_ttl: int = 7 * 24 * 3600
+    result_cache_dir: str = "/tmp/joj-tiger-results"
+    result_cache_size: str = "256m"
+
     # lakefs config
     lakefs_s3_domain: str = "s3.lakefs.example.com"
     lakefs_host: str = ""
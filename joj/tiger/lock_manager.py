@@ -1,9 +1,16 @@
+import asyncio
+import os
+import socket
+from contextlib import contextmanager
 from functools import lru_cache
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List
 
-from aioredlock import Aioredlock
+from aioredlock import Aioredlock, Lock, LockError
 
 from joj.tiger.config import settings
+from joj.tiger.utils.background import run_in_background
+
+HOST_LOCK_WAIT = 600
 
 
 @lru_cache
@@ -21,3 +28,37 @@ def get_redis_instances() -> List[Dict[str, Any]]:
 @lru_cache()
 def get_lock_manager() -> Aioredlock:
     return Aioredlock(get_redis_instances(), retry_delay_min=0.3, retry_delay_max=0.7)
+
+
+async def _lock_until(resource: str, wait: float) -> Lock:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        try:
+            # without a lock_timeout, the lock is extended until released
+            return await get_lock_manager().lock(resource)
+        except LockError:
+            if loop.time() >= deadline:
+                raise
+
+
+@contextmanager
+def host_lock(name: str, wait: float = HOST_LOCK_WAIT) -> Iterator[None]:
+    """
+    Holds the redis lock of name shared by the worker processes of this
+    host, waiting up to wait seconds for it (LockError is raised after).
+
+    The lock is taken and extended on the background loop, which owns the
+    connections of the lock manager, so this must be called from a thread
+    that is not running the background loop, e.g. an executor.
+    """
+    resource = f"joj.tiger:{socket.gethostname()}:{name}"
+    lock = run_in_background(_lock_until(resource, wait)).result()
+    try:
+        yield
+    finally:
+        run_in_background(get_lock_manager().unlock(lock)).result()
+
+
+# the connections of the lock manager belong to the background loop
+os.register_at_fork(after_in_child=get_lock_manager.cache_clear)
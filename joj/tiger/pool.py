@@ -0,0 +1,190 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Deque, Dict, Optional
+
+import aiodocker
+from loguru import logger
+
+from joj.tiger.async_runner import AsyncRunner
+from joj.tiger.reaper import ORPHAN_CONTAINER_TTL, get_reaper
+from joj.tiger.runner import RUNNER_DOCKER_IMAGE, RunnerCommandError
+from joj.tiger.toolchains import Image, get_toolchains_config
+from joj.tiger.utils.background import run_in_background
+
+POOL_REFILL_RETRY_DELAY = 5
+# recycled well before the orphan collectors of other hosts expire them
+POOL_RUNNER_MAX_AGE = ORPHAN_CONTAINER_TTL / 2
+POOL_EXPIRE_INTERVAL = 60
+
+
+class RunnerPool:
+    """
+    A pool of pre-created runners for one docker image.
+
+    Idle runners are kept on the background loop of the worker process,
+    which refills the pool up to image.pool_size and cleans (or recycles,
+    after image.max_reuse leases) the runners handed back by tasks. All
+    bookkeeping happens on the background loop, so no locking is needed.
+    Runners are also recycled once older than POOL_RUNNER_MAX_AGE, even if
+    they stay idle.
+
+    The runners mount the compiler cache of the image read-only, if any, so
+    that a submission is compiled and judged in the same runner. The cache
+    is thus never filled by the submissions it serves, see
+    Image.compiler_cache_volumes.
+    """
+
+    def __init__(self, image: Image):
+        self.image = image
+        self._idle: Deque[AsyncRunner] = deque()
+        self._uses: Dict[str, int] = {}
+        self._creating = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._started = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.image.pool_size > 0
+
+    def _new_runner(self, task_id: Optional[str] = None) -> AsyncRunner:
+        return AsyncRunner(
+            docker_image=self.image.container_image,
+            runner_binary_installed=self.image.runner_image is not None,
+            task_id=task_id,
+            tmpfs_size=self.image.tmpfs_size,
+            environment_variables=self.image.compiler_cache_environment(),
+            read_only_volumes=self.image.compiler_cache_volumes(),
+        )
+
+    @staticmethod
+    def _is_expired(runner: AsyncRunner) -> bool:
+        created_at = runner.created_at or 0
+        return time.time() - created_at > POOL_RUNNER_MAX_AGE
+
+    async def _expire(self) -> None:
+        for runner in [runner for runner in self._idle if self._is_expired(runner)]:
+            self._idle.remove(runner)
+            self._uses.pop(runner.name, None)
+            await get_reaper().put(runner.name)
+
+    def start(self) -> None:
+        if self._started or not self.enabled:
+            return
+        self._started = True
+        run_in_background(self._refill_forever())
+
+    async def _refill_forever(self) -> None:
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            while len(self._idle) + self._creating < self.image.pool_size:
+                runner = self._new_runner()
+                self._creating += 1
+                try:
+                    await runner.start()
+                except Exception as e:
+                    logger.error(f"runner pool [{self.image.name}] refill failed: {e}")
+                    await asyncio.sleep(POOL_REFILL_RETRY_DELAY)
+                    continue
+                finally:
+                    self._creating -= 1
+                self._idle.append(runner)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POOL_EXPIRE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self._expire()
+
+    def _notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _acquire(self) -> Optional[AsyncRunner]:
+        runner = self._idle.popleft() if self._idle else None
+        self._notify()
+        return runner
+
+    async def _release(self, runner: AsyncRunner) -> None:
+        uses = self._uses.pop(runner.name, 0) + 1
+        # a runner created on demand is labelled with its task, the orphan
+        # collector would remove it once the task is done
+        if (
+            uses < self.image.max_reuse
+            and runner.task_id is None
+            and len(self._idle) < self.image.pool_size
+            and runner.docker_image == self.image.container_image
+            and not self._is_expired(runner)
+        ):
+            try:
+                await runner.clean()
+            except (aiodocker.DockerError, RunnerCommandError) as e:
+                logger.warning(f"runner {runner.name} clean failed: {e}")
+            else:
+                self._uses[runner.name] = uses
+                self._idle.append(runner)
+                self._notify()
+                return
+        await get_reaper().put(runner.name)
+        self._notify()
+
+    async def close(self) -> None:
+        while self._idle:
+            await self._idle.popleft().destroy()
+
+    @asynccontextmanager
+    async def lease(self, task_id: Optional[str] = None) -> AsyncIterator[AsyncRunner]:
+        """
+        Leases a clean, running runner. A new runner is created on demand if
+        the pool is empty (or disabled), labelled with task_id, and removed
+        instead of entering the pool once handed back. The runner is handed
+        back to the background loop on exit, the caller does not wait for
+        the cleanup.
+        """
+        runner: Optional[AsyncRunner] = None
+        if self.enabled:
+            self.start()
+            runner = await asyncio.wrap_future(run_in_background(self._acquire()))
+        if runner is None:
+            runner = self._new_runner(task_id)
+            await runner.start()
+        try:
+            yield runner
+        finally:
+            if self.enabled:
+                run_in_background(self._release(runner))
+            else:
+                await runner.reap()
+
+
+@lru_cache()
+def get_runner_pool(docker_image: str = RUNNER_DOCKER_IMAGE) -> RunnerPool:
+    image = get_toolchains_config().find_image(docker_image)
+    if image is None:
+        image = Image(name=docker_image, image=docker_image)
+    return RunnerPool(image)
+
+
+def start_runner_pools() -> None:
+    toolchains_config = get_toolchains_config()
+    for queue in toolchains_config.queues.values():
+        for name in queue.images:
+            get_runner_pool(toolchains_config.images[name].image).start()
+
+
+def close_runner_pools() -> None:
+    toolchains_config = get_toolchains_config()
+    futures = [
+        run_in_background(get_runner_pool(image.image).close())
+        for image in toolchains_config.images.values()
+        if image.pool_size > 0
+    ]
+    for future in futures:
+        future.result()
+
+
+# pools created before fork belong to the parent process
+os.register_at_fork(after_in_child=get_runner_pool.cache_clear)
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterator, List, Mapping, Optional
+
+import aiodocker
+from loguru import logger
+
+from joj.tiger.utils.background import run_in_background
+from joj.tiger.utils.docker import get_docker
+
+REAPER_BACKLOG = int(os.environ.get("REAPER_BACKLOG", 64))
+REAPER_BATCH_SIZE = int(os.environ.get("REAPER_BATCH_SIZE", 8))
+REAPER_FLUSH_TIMEOUT = 30
+# runner containers older than this are removed whoever owns them
+ORPHAN_CONTAINER_TTL = int(os.environ.get("ORPHAN_CONTAINER_TTL", 6 * 3600))
+ORPHAN_COLLECT_INTERVAL = int(os.environ.get("ORPHAN_COLLECT_INTERVAL", 600))
+
+LABEL_PREFIX = "org.joj.tiger"
+WORKER_LABEL = f"{LABEL_PREFIX}.worker"
+TASK_LABEL = f"{LABEL_PREFIX}.task"
+CREATED_LABEL = f"{LABEL_PREFIX}.created"
+
+# celery task ids of the tasks running in this worker process, counted since
+# the records of a batch run concurrently under the same id
+_active_tasks: "Counter[str]" = Counter()
+
+
+class ContainerReaper:
+    """
+    Removes the containers of finished runners off the critical path.
+
+    Containers are queued by name and force-removed on the background loop
+    of the worker process, batch_size at a time, so that tasks do not wait
+    for the removal before reporting their results. The queue holds at most
+    backlog containers: once full, queueing waits for room, so that a storm
+    of removals slows down the tasks producing it instead of competing
+    without bound with the creation of new containers.
+
+    All the methods must be called on the background loop, see reap_container.
+    """
+
+    def __init__(
+        self, backlog: int = REAPER_BACKLOG, batch_size: int = REAPER_BATCH_SIZE
+    ):
+        self.backlog = backlog
+        self.batch_size = batch_size
+        self._queue: Optional["asyncio.Queue[str]"] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def _get_queue(self) -> "asyncio.Queue[str]":
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.backlog)
+            self._task = asyncio.create_task(self._reap_forever(self._queue))
+        return self._queue
+
+    async def put(self, name: str) -> None:
+        await self._get_queue().put(name)
+
+    async def join(self) -> None:
+        """
+        Waits until every queued container is removed.
+        """
+        await self._get_queue().join()
+
+    async def _reap_forever(self, queue: "asyncio.Queue[str]") -> None:
+        while True:
+            names: List[str] = [await queue.get()]
+            while len(names) < self.batch_size and not queue.empty():
+                names.append(queue.get_nowait())
+            results = await asyncio.gather(
+                *[self._remove(name) for name in names], return_exceptions=True
+            )
+            for name, result in zip(names, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"runner {name} removal failed: {result}")
+                queue.task_done()
+
+    async def _remove(self, name: str) -> None:
+        try:
+            await get_docker().containers.container(name).delete(force=True, v=True)
+        except aiodocker.DockerError as e:
+            if e.status != 404:
+                raise
+
+
+@lru_cache()
+def get_reaper() -> ContainerReaper:
+    return ContainerReaper()
+
+
+def reap_container(name: str) -> "Future[None]":
+    """
+    Queues the container for removal by the reaper. The returned future is
+    done as soon as the container is queued, which only waits while the
+    backlog is full.
+    """
+    return run_in_background(get_reaper().put(name))
+
+
+def flush_reaper(timeout: Optional[float] = REAPER_FLUSH_TIMEOUT) -> None:
+    """
+    Waits until every queued container is removed, e.g. before the worker
+    process exits.
+    """
+    run_in_background(get_reaper().join()).result(timeout)
+
+
+def worker_id() -> str:
+    """
+    Identifies the worker process as "<hostname>:<pid>". Worker processes
+    running in the same container share the hostname and pid namespace, so
+    they can tell whether the owner of a container is still alive.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def container_labels(
+    task_id: Optional[str] = None, created_at: Optional[float] = None
+) -> Dict[str, str]:
+    """
+    The labels of a runner container created by this worker process, for the
+    task task_id (or for no task in particular, e.g. pooled runners). Labels
+    cannot be changed once the container is created.
+    """
+    return {
+        WORKER_LABEL: worker_id(),
+        TASK_LABEL: task_id or "",
+        CREATED_LABEL: str(int(time.time() if created_at is None else created_at)),
+    }
+
+
+@contextmanager
+def track_task(task_id: str) -> Iterator[None]:
+    """
+    Marks the task as running in this worker process, so that the orphan
+    collector leaves the containers labelled with it alone. The task may be
+    tracked several times at once, it is running until all of them exit.
+    """
+    _active_tasks[task_id] += 1
+    try:
+        yield
+    finally:
+        _active_tasks[task_id] -= 1
+        if _active_tasks[task_id] <= 0:
+            del _active_tasks[task_id]
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_orphan(labels: Mapping[str, str], now: Optional[float] = None) -> bool:
+    """
+    Whether a labelled runner container is left over: it is older than
+    ORPHAN_CONTAINER_TTL, or it was created on this host by a worker process
+    that is gone, or by this worker process for a task that is not running
+    anymore. The owners on other hosts cannot be checked, their containers
+    only expire.
+    """
+    now = time.time() if now is None else now
+    try:
+        created_at = int(labels.get(CREATED_LABEL, ""))
+    except ValueError:
+        created_at = 0
+    if now - created_at > ORPHAN_CONTAINER_TTL:
+        return True
+    hostname, _, pid = labels.get(WORKER_LABEL, "").rpartition(":")
+    if hostname != socket.gethostname() or not pid.isdigit():
+        return False
+    if int(pid) != os.getpid():
+        return not _is_process_alive(int(pid))
+    task_id = labels.get(TASK_LABEL, "")
+    return bool(task_id) and task_id not in _active_tasks
+
+
+async def collect_orphans() -> List[str]:
+    """
+    Lists all the labelled runner containers of the docker host in a single
+    request and queues the orphan ones (see is_orphan) for removal. Returns
+    the names of the queued containers.
+    """
+    containers = await get_docker().containers.list(
+        all=True, filters=json.dumps({"label": [WORKER_LABEL]})
+    )
+    now = time.time()
+    orphans = []
+    for container in containers:
+        if is_orphan(container["Labels"] or {}, now):
+            name = container["Names"][0].lstrip("/")
+            await get_reaper().put(name)
+            orphans.append(name)
+    if orphans:
+        logger.info(f"orphan runners queued for removal: {orphans}")
+    return orphans
+
+
+async def _collect_orphans_forever(interval: float) -> None:
+    while True:
+        try:
+            await collect_orphans()
+        except Exception as e:
+            logger.warning(f"orphan runner collection failed: {e}")
+        await asyncio.sleep(interval)
+
+
+@lru_cache()
+def start_orphan_collector(interval: float = ORPHAN_COLLECT_INTERVAL) -> "Future[None]":
+    """
+    Collects the orphan runner containers right away, then every interval
+    seconds, on the background loop. Only the first call starts a collector.
+    """
+    return run_in_background(_collect_orphans_forever(interval))
+
+
+# the reaper task runs on the background loop, which is not inherited
+os.register_at_fork(after_in_child=get_reaper.cache_clear)
+os.register_at_fork(after_in_child=start_orphan_collector.cache_clear)
+os.register_at_fork(after_in_child=_active_tasks.clear)
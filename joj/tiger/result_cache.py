@@ -0,0 +1,122 @@
+import os
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Optional
+
+import msgpack
+import redis
+
+from joj.tiger.config import settings
+from joj.tiger.lock_manager import get_redis_instances
+from joj.tiger.schemas import RecordCaseResult, SubmitResult
+from joj.tiger.utils.cache import DirectoryCache
+from joj.tiger.utils.units import parse_memory
+
+RESULT_CACHE_FILE = "submit_result.msgpack"
+# may differ when the submission is judged again
+RESULT_CACHE_UNSTABLE_STATUSES = {
+    RecordCaseResult.time_limit_exceeded,
+    RecordCaseResult.system_error,
+    RecordCaseResult.canceled,
+    RecordCaseResult.etc,
+}
+
+
+def dump_submit_result(result: SubmitResult) -> bytes:
+    # msgpack keeps the outputs as they are, they may not be valid utf-8
+    return msgpack.packb(result.dict(), use_bin_type=True)
+
+
+def load_submit_result(data: bytes) -> SubmitResult:
+    return SubmitResult(**msgpack.unpackb(data, raw=False))
+
+
+def is_reusable(result: SubmitResult) -> bool:
+    """
+    Whether the result may be reused for identical submissions: not if any
+    command timed out or any case failed for reasons other than the
+    submission itself, which another judge may not reproduce.
+    """
+    if result.compile_result is not None and result.compile_result.timed_out:
+        return False
+    return all(
+        exec_res.status not in RESULT_CACHE_UNSTABLE_STATUSES
+        and not exec_res.completed_command.timed_out
+        for exec_res in result.execute_results or []
+    )
+
+
+class ResultCache(ABC):
+    """
+    The results of the submissions already judged, keyed by the problem
+    commit, the language, the sources and the runner image (see
+    TigerTask.result_key), so that identical submissions are not judged
+    again.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[SubmitResult]:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, result: SubmitResult) -> None:
+        pass
+
+
+class RedisResultCache(ResultCache):
+    """
+    Shared by all the workers through the redis of the lock manager, the
+    results expire after ttl seconds.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._client = redis.Redis(**get_redis_instances()[0])
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return f"joj.tiger:result:{key}"
+
+    def get(self, key: str) -> Optional[SubmitResult]:
+        data = self._client.get(self._name(key))
+        return None if data is None else load_submit_result(data)
+
+    def put(self, key: str, result: SubmitResult) -> None:
+        self._client.set(self._name(key), dump_submit_result(result), ex=self.ttl)
+
+
+class LocalResultCache(ResultCache):
+    """
+    Shared by the worker processes of the host, the least recently used
+    results are evicted, see DirectoryCache.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self._cache = DirectoryCache(directory, max_size)
+
+    def get(self, key: str) -> Optional[SubmitResult]:
+        with self._cache.get(key) as path:
+            if path is None:
+                return None
+            with open(os.path.join(path, RESULT_CACHE_FILE), "rb") as f:
+                return load_submit_result(f.read())
+
+    def put(self, key: str, result: SubmitResult) -> None:
+        def populate(directory: str) -> None:
+            with open(os.path.join(directory, RESULT_CACHE_FILE), "wb") as f:
+                f.write(dump_submit_result(result))
+
+        self._cache.put(key, populate)
+
+
+@lru_cache()
+def get_result_cache() -> Optional[ResultCache]:
+    if settings.result_cache == "redis":
+        return RedisResultCache(settings.result_cache_ttl)
+    if settings.result_cache == "local":
+        return LocalResultCache(
+            settings.result_cache_dir, parse_memory(settings.result_cache_size)
+        )
+    if settings.result_cache:
+        raise ValueError(f"unknown result cache: {settings.result_cache}")
+    return None
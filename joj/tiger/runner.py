@@ -1,16 +1,44 @@
 # modified from https://github.com/eecs-autograder/autograder-sandbox/blob/develop/autograder_sandbox/autograder_sandbox.py
 # Copyright eecs-autograder under GNU Lesser General Public License v3.0
 import asyncio
+import io
+import mmap
 import os
+import struct
 import subprocess
 import tarfile
 import tempfile
 import uuid
-from typing import IO, AnyStr, Iterator, List, Mapping, NoReturn, Optional, Sequence
+from contextlib import contextmanager
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NoReturn,
+    Optional,
+    Tuple,
+)
 
 import msgpack
-
-from joj.tiger.schemas import CompletedCommand
+from fs.base import FS
+
+from joj.tiger.reaper import container_labels, reap_container
+from joj.tiger.schemas import CommandResult, RunnerCommand
+from joj.tiger.utils.archive import (
+    ArchiveMember,
+    directory_members,
+    file_members,
+    host_fs,
+    host_path,
+    iter_fileobj_tar,
+    iter_tar,
+    read_tar,
+)
+from joj.tiger.utils.units import parse_memory
 
 RUNNER_HOME_DIR_NAME = "/root"
 RUNNER_WORKING_DIR_NAME = RUNNER_HOME_DIR_NAME
@@ -22,8 +50,25 @@ RUNNER_DOCKER_IMAGE = os.environ.get(
 RUNNER_PIDS_LIMIT = int(os.environ.get("RUNNER_PIDS_LIMIT", 512))
 RUNNER_MEM_LIMIT = os.environ.get("RUNNER_MEM_LIMIT", "4g")
 RUNNER_MIN_FALLBACK_TIMEOUT = int(os.environ.get("RUNNER_MIN_FALLBACK_TIMEOUT", 60))
-
-RUNNER_PATH = "/root/runner"
+# bytes of stdout / stderr kept by the runner binary when a command does not
+# set truncate_stdout / truncate_stderr (defaultTruncate in output.go)
+RUNNER_DEFAULT_TRUNCATE = 32 * 2**20
+# bytes of stdout / stderr the tasks keep in the results they report, well
+# below RUNNER_DEFAULT_TRUNCATE
+RUNNER_TRUNCATE_OUTPUT = int(os.environ.get("RUNNER_TRUNCATE_OUTPUT", 2**20))
+RUNNER_OUTPUT_LIMIT = int(os.environ.get("RUNNER_OUTPUT_LIMIT", 64 * 2**20))
+# limits of the commands that do not come with their own (e.g. compilation)
+RUNNER_COMPILE_TIME_LIMIT = int(os.environ.get("RUNNER_COMPILE_TIME_LIMIT", 30000))
+RUNNER_CASE_PIDS_LIMIT = int(os.environ.get("RUNNER_CASE_PIDS_LIMIT", 128))
+
+# outside of the working directory, so that cleaning or snapshotting the
+# working directory does not need to spare it
+RUNNER_PATH = "/usr/local/bin/joj-runner"
+# where the stdin file object of Runner.run_command is staged, outside of the
+# working directory
+RUNNER_STDIN_PATH = "/tmp/.joj-stdin"
+# the directories kept in memory when a runner is created with a tmpfs_size
+RUNNER_TMPFS_DIRS = (RUNNER_WORKING_DIR_NAME, "/tmp")
 
 
 class RunnerCommandError(Exception):
@@ -33,6 +78,101 @@ class RunnerCommandError(Exception):
     """
 
 
+RESULT_HEADER = struct.Struct(">I")
+
+
+def load_command_result(buffer: memoryview) -> Tuple[CommandResult, Dict[str, Any]]:
+    """
+    Decodes a result written by the runner binary: a length-prefixed msgpack
+    header followed by the raw stdout and stderr. The outputs of the result
+    are slices of buffer, they are not copied. The decoded header is also
+    returned for the fields that are not part of the result (e.g. ID).
+    """
+    (header_size,) = RESULT_HEADER.unpack_from(buffer)
+    offset = RESULT_HEADER.size + header_size
+    header = msgpack.unpackb(buffer[RESULT_HEADER.size : offset])
+    stdout_end = offset + header["StdoutSize"]
+    stderr_end = stdout_end + header["StderrSize"]
+    result = CommandResult(
+        return_code=header["ReturnCode"],
+        stdout=buffer[offset:stdout_end],
+        stderr=buffer[stdout_end:stderr_end],
+        timed_out=header["TimedOut"],
+        stdout_truncated=header["StdoutTruncated"],
+        stderr_truncated=header["StderrTruncated"],
+        time=header["Time"],
+        memory=header["Memory"],
+        memory_limit_exceeded=header["MemoryLimitExceeded"],
+        output_limit_exceeded=header["OutputLimitExceeded"],
+    )
+    return result, header
+
+
+def tmpfs_volume_options(tmpfs_size: str, memory_limit: str) -> Dict[str, str]:
+    """
+    The options of a local docker volume backed by a tmpfs of tmpfs_size,
+    one of which is mounted on each of RUNNER_TMPFS_DIRS. Volumes are used
+    instead of tmpfs mounts since docker cp cannot reach the latter.
+
+    The pages of a tmpfs are charged to the memory cgroup of the process
+    writing them, so the files written in the runner count against its
+    memory_limit, which must leave room for all the tmpfs.
+    """
+    size = parse_memory(tmpfs_size)
+    if size * len(RUNNER_TMPFS_DIRS) > parse_memory(memory_limit):
+        raise ValueError(
+            f"tmpfs of {tmpfs_size} for {len(RUNNER_TMPFS_DIRS)} directories "
+            f"exceed the memory limit of {memory_limit}"
+        )
+    return {"type": "tmpfs", "device": "tmpfs", "o": f"size={size}"}
+
+
+def fallback_timeout_command() -> CommandResult:
+    return CommandResult(
+        return_code=-1,
+        timed_out=True,
+        stdout=b"",
+        stderr=b"The command exceeded the fallback timeout. "
+        b"If this occurs frequently, contact your system administrator.\n",
+        stdout_truncated=False,
+        stderr_truncated=True,
+        time=0,
+        memory=0,
+    )
+
+
+def get_runner_binary_path() -> str:
+    return os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "runner", "runner"
+    )
+
+
+def add_runner_binary(tar_file: tarfile.TarFile) -> None:
+    """
+    Adds the runner binary to tar_file, named after RUNNER_PATH relative to
+    its directory, executable and owned by root.
+    """
+    tar_info = tar_file.gettarinfo(
+        get_runner_binary_path(), arcname=os.path.basename(RUNNER_PATH)
+    )
+    tar_info.mode = 0o555
+    tar_info.uid = tar_info.gid = 0
+    tar_info.uname = tar_info.gname = "root"
+    with open(get_runner_binary_path(), "rb") as f:
+        tar_file.addfile(tar_info, f)
+
+
+def runner_binary_archive() -> bytes:
+    """
+    A tar archive of the runner binary, to be extracted in the directory of
+    RUNNER_PATH.
+    """
+    buffer = io.BytesIO()
+    with tarfile.TarFile(fileobj=buffer, mode="w") as tar_file:
+        add_runner_binary(tar_file)
+    return buffer.getvalue()
+
+
 class Runner:
     """
     This class wraps Docker functionality to provide an interface for
@@ -57,6 +197,11 @@ class Runner:
         pids_limit: int = RUNNER_PIDS_LIMIT,
         memory_limit: str = RUNNER_MEM_LIMIT,
         min_fallback_timeout: int = RUNNER_MIN_FALLBACK_TIMEOUT,
+        runner_binary_installed: bool = False,
+        task_id: Optional[str] = None,
+        tmpfs_size: Optional[str] = None,
+        volumes: Optional[Mapping[str, str]] = None,
+        read_only_volumes: Optional[Mapping[str, str]] = None,
         debug: bool = False,
     ):
         """
@@ -108,7 +253,9 @@ class Runner:
             We choose to disable the OOM killer to prevent the runner's
             main process from being killed by the OOM killer (which would
             cause the whole container to exit). This means, however, that
-            a command that hits the memory limit may time out.
+            a command that hits the memory limit of the runner may time
+            out. The runner binary enables the OOM killer again for its
+            commands, which are killed at their own memory limit.
 
             In general we recommend setting this value as high as is safe
             for your host machine and additionally using the max_virtual_memory
@@ -131,12 +278,36 @@ class Runner:
             The default value for this parameter can be changed by
             setting the RUNNER_MIN_FALLBACK_TIMEOUT environment variable.
 
+        :param runner_binary_installed: Whether docker_image already
+            contains the runner binary at RUNNER_PATH (see
+            Image.build_runner_image). Otherwise it is copied into every
+            new container.
+
+        :param task_id: The celery task the runner is created for, set as a
+            label of the container along with the worker and the creation
+            time, see container_labels.
+
+        :param tmpfs_size: When set, the working directory and /tmp are
+            each backed by a tmpfs of this size (in the docker notation,
+            e.g. "256m") instead of the overlay filesystem of the
+            container, so that files written by the commands never hit the
+            disk. They count against memory_limit, see tmpfs_volume_options.
+
+        :param volumes: Named docker volumes mounted read-write in the
+            runner, mapped to where they are mounted, e.g. a compiler cache
+            shared with the other runners (see Image.compiler_cache_volumes).
+            They are kept when the runner is removed.
+
+        :param read_only_volumes: Same as volumes, mounted read-only, e.g.
+            the compiler cache in the runners judging submissions.
+
         :param debug: Whether to print additional debugging information.
         """
         if name is None:
             self._name = "runner-{}".format(uuid.uuid4().hex)
         else:
             self._name = name
+        self._named = name is not None
 
         self._docker_image = docker_image
         self._allow_network_access = allow_network_access
@@ -146,15 +317,51 @@ class Runner:
         self._pids_limit = pids_limit
         self._memory_limit = memory_limit
         self._min_fallback_timeout = min_fallback_timeout
+        self._runner_binary_installed = runner_binary_installed
+        self._task_id = task_id
+        self._tmpfs_volume_options = (
+            None
+            if tmpfs_size is None
+            else tmpfs_volume_options(tmpfs_size, memory_limit)
+        )
+        self._volumes = dict(volumes or {})
+        self._read_only_volumes = dict(read_only_volumes or {})
         self.debug = debug
 
     def __enter__(self) -> "Runner":
-        self._create_and_start()
+        self.start()
         return self
 
     def __exit__(self, *args: object) -> None:
+        self.reap()
+
+    def start(self) -> None:
+        """
+        Creates and starts the underlying docker container. Prefer using
+        the context manager unless the lifetime of the runner is managed
+        elsewhere (e.g. by a RunnerPool).
+        """
+        self._create_and_start()
+
+    def destroy(self) -> None:
+        """
+        Stops and removes the underlying docker container.
+        """
         self._destroy()
 
+    def reap(self) -> None:
+        """
+        Hands the underlying docker container to the reaper, which removes
+        it in the background, see ContainerReaper. A runner named by the
+        caller is removed right away instead, since the caller may create
+        another runner with the same name as soon as this one is reaped.
+        """
+        if self._named:
+            self._destroy()
+            return
+        reap_container(self.name).result()
+        self._is_running = False
+
     def reset(self) -> None:
         """
         Destroys, re-creates, and restarts the runner. As a side
@@ -164,6 +371,21 @@ class Runner:
         self._destroy()
         self._create_and_start()
 
+    def clean(self) -> None:
+        """
+        Kills every process inside the runner and removes everything from
+        the working directory and /tmp, so that the runner can be handed to
+        another submission without re-creating the container.
+        """
+        clean_script = (
+            "kill -9 -1; "
+            "find {working_dir} /tmp -mindepth 1 -maxdepth 1 -exec rm -rf {{}} +"
+        ).format(working_dir=RUNNER_WORKING_DIR_NAME)
+        subprocess.check_call(
+            ["docker", "exec", self.name, "sh", "-c", clean_script],
+            stdout=subprocess.DEVNULL,
+        )
+
     def restart(self) -> None:
         """
         Restarts the runner without destroying it.
@@ -193,6 +415,30 @@ class Runner:
             # Create the container without a network stack.
             create_args += ["--net", "none"]
 
+        # Labels let the orphan collector find containers left by dead workers.
+        for key, value in container_labels(self._task_id).items():
+            create_args += ["--label", "{}={}".format(key, value)]
+
+        if self._tmpfs_volume_options is not None:
+            # anonymous volumes, removed along with the container
+            for directory in RUNNER_TMPFS_DIRS:
+                mount = ["type=volume", "dst=" + directory] + [
+                    "volume-opt={}={}".format(key, value)
+                    for key, value in self._tmpfs_volume_options.items()
+                ]
+                create_args += ["--mount", ",".join(mount)]
+
+        for volume, directory in self._volumes.items():
+            create_args += [
+                "--mount",
+                "type=volume,src={},dst={}".format(volume, directory),
+            ]
+        for volume, directory in self._read_only_volumes.items():
+            create_args += [
+                "--mount",
+                "type=volume,src={},dst={},readonly".format(volume, directory),
+            ]
+
         if self.environment_variables:
             for key, value in self.environment_variables.items():
                 create_args += ["-e", "{}={}".format(key, value)]
@@ -211,40 +457,27 @@ class Runner:
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
         )
-        try:
-            cmd_runner_source = os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                "..",
-                "..",
-                "runner",
-                "runner",
-            )
-            subprocess.run(
-                [
-                    "docker",
-                    "cp",
-                    cmd_runner_source,
-                    "{}:{}".format(self.name, RUNNER_PATH),
-                ],
-                check=True,
-            )
-            subprocess.run(
-                ["docker", "exec", "-i", self.name, "chmod", "555", RUNNER_PATH],
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
-            if self.debug:
-                print(e.stdout)
-                print(e.stderr)
+        if not self._runner_binary_installed:
+            try:
+                # the mode is set in the archive, no chmod is needed
+                self.put_archive(
+                    os.path.dirname(RUNNER_PATH), [runner_binary_archive()]
+                )
+            except subprocess.CalledProcessError as e:
+                if self.debug:
+                    print(e.stdout)
+                    print(e.stderr)
 
-            self._destroy()
-            raise
+                self._destroy()
+                raise
 
         self._is_running = True
 
     def _destroy(self) -> None:
-        self._stop()
-        subprocess.check_call(["docker", "rm", self.name], stdout=subprocess.DEVNULL)
+        subprocess.check_call(
+            ["docker", "rm", "--force", "--volumes", self.name],
+            stdout=subprocess.DEVNULL,
+        )
         self._is_running = False
 
     def _stop(self) -> None:
@@ -305,12 +538,14 @@ class Runner:
         max_stack_size: Optional[int] = None,
         max_virtual_memory: Optional[int] = None,
         as_root: bool = False,
-        stdin: Optional[IO[AnyStr]] = None,
+        stdin: Optional[IO[bytes]] = None,
         timeout: Optional[int] = None,
         check: bool = False,
         truncate_stdout: Optional[int] = None,
         truncate_stderr: Optional[int] = None,
-    ) -> CompletedCommand:
+        output_limit: Optional[int] = None,
+        stdin_file: Optional[str] = None,
+    ) -> CommandResult:
         """
         Runs a command inside the runner and returns the results.
 
@@ -318,7 +553,7 @@ class Runner:
             be run inside the runner.
 
         :param block_process_spawn: If true, prevent the command from
-            spawning child processes by setting the nproc limit to 0.
+            spawning child processes by setting the pids limit to 1.
 
         :param max_stack_size: The maximum stack size, in bytes, allowed
             for the command.
@@ -326,50 +561,60 @@ class Runner:
         :param max_virtual_memory: The maximum amount of memory, in
             bytes, allowed for the command.
 
-        :param as_root: Whether to run the command as a root user.
+        :param as_root: Whether to run the command as a root user. Commands
+            are always run as root for now.
 
         :param stdin: A file object to be redirected as input to the
-            command's stdin. If this is None, /dev/null is sent to the
-            command's stdin.
+            command's stdin. It is copied into the runner (at
+            RUNNER_STDIN_PATH) before the command starts, rather than piped
+            through docker exec. Prefer staging large inputs once and
+            passing stdin_file instead.
 
-        :param timeout: The time limit for the command.
+        :param timeout: The time limit for the command, in seconds of cpu
+            time.
 
         :param check: Causes CalledProcessError to be raised if the
             command exits nonzero or times out.
 
         :param truncate_stdout: When not None, stdout from the command
-            will be truncated after this many bytes.
+            will be truncated after this many bytes. Otherwise the runner
+            binary still truncates it after RUNNER_DEFAULT_TRUNCATE bytes.
 
         :param truncate_stderr: When not None, stderr from the command
-            will be truncated after this many bytes.
-        """
-        cmd = ["docker", "exec", "-i", self.name, RUNNER_PATH]
-
-        # if stdin is None:
-        #     cmd.append('--stdin_devnull')
-
-        # if block_process_spawn:
-        #     cmd += ['--block_process_spawn']
-
-        # if max_stack_size is not None:
-        #     cmd += ['--max_stack_size', str(max_stack_size)]
-
-        # if max_virtual_memory is not None:
-        #     cmd += ['--max_virtual_memory', str(max_virtual_memory)]
-
-        # if timeout is not None:
-        #     cmd += ['--timeout', str(timeout)]
-
-        # if truncate_stdout is not None:
-        #     cmd += ['--truncate_stdout', str(truncate_stdout)]
+            will be truncated after this many bytes. Otherwise the runner
+            binary still truncates it after RUNNER_DEFAULT_TRUNCATE bytes.
 
-        # if truncate_stderr is not None:
-        #     cmd += ['--truncate_stderr', str(truncate_stderr)]
+        :param output_limit: When not None, the command is killed as soon
+            as its stdout or stderr exceeds this many bytes, and
+            output_limit_exceeded is set in the result.
 
-        # if as_root:
-        #     cmd += ['--as_root']
-
-        cmd += args
+        :param stdin_file: A file inside the runner opened by the runner
+            binary as the command's stdin. If both stdin and stdin_file are
+            None, the command's stdin is /dev/null.
+        """
+        if stdin is not None:
+            self.put_archive(
+                os.path.dirname(RUNNER_STDIN_PATH),
+                iter_fileobj_tar(stdin, os.path.basename(RUNNER_STDIN_PATH)),
+            )
+            stdin_file = RUNNER_STDIN_PATH
+
+        # names the cgroup of the command, to kill it if abandoned
+        command_name = uuid.uuid4().hex
+        cmd = ["docker", "exec", self.name, RUNNER_PATH, "--name", command_name]
+        cmd += RunnerCommand(
+            args=args,
+            truncate_stdout=truncate_stdout,
+            truncate_stderr=truncate_stderr,
+            output_limit=output_limit,
+            stdin_file=stdin_file,
+            time_limit=timeout * 1000 if timeout is not None else None,
+            memory_limit=max_virtual_memory,
+            stack_limit=max_stack_size,
+            pids_limit=1 if block_process_spawn else None,
+        ).to_flags()
+
+        cmd += ["--"] + args
 
         if self.debug:
             print("running: {}".format(cmd), flush=True)
@@ -383,45 +628,30 @@ class Runner:
             try:
                 subprocess.run(
                     cmd,
-                    stdin=stdin,
                     stdout=runner_stdout,
                     stderr=runner_stderr,
                     check=True,
                     timeout=fallback_timeout,
                 )
-                runner_stdout.seek(0)
-                runner_stdout_bytes = runner_stdout.read().strip()
-                results_msgpack = msgpack.unpackb(runner_stdout_bytes)
-
-                result = CompletedCommand(
-                    return_code=results_msgpack["ReturnCode"],
-                    timed_out=results_msgpack["TimedOut"],
-                    stdout=results_msgpack["Stdout"],
-                    stderr=results_msgpack["Stderr"],
-                    stdout_truncated=False,
-                    stderr_truncated=False,
-                    time=results_msgpack["Time"],
-                    memory=results_msgpack["Memory"],
-                )
-
-                if (result.return_code != 0 or results_msgpack["TimedOut"]) and check:
+                # the result is decoded from a mapping of the temporary file,
+                # the outputs are copied out of it so that it can be closed
+                with mmap.mmap(
+                    runner_stdout.fileno(), 0, access=mmap.ACCESS_READ
+                ) as mapping:
+                    result, _ = load_command_result(memoryview(mapping))
+                    result.stdout = bytes(result.stdout)
+                    result.stderr = bytes(result.stderr)
+
+                if (result.return_code != 0 or result.timed_out) and check:
                     self._raise_runner_command_error(
                         stdout=runner_stdout, stderr=runner_stderr
                     )
 
                 return result
             except subprocess.TimeoutExpired:
-                return CompletedCommand(
-                    return_code=-1,
-                    timed_out=True,
-                    stdout=b"",
-                    stderr=b"The command exceeded the fallback timeout. "
-                    b"If this occurs frequently, contact your system administrator.\n",
-                    stdout_truncated=False,
-                    stderr_truncated=True,
-                    time=0,
-                    memory=0,
-                )
+                # only the docker exec client was killed
+                self.kill_command(command_name)
+                return fallback_timeout_command()
             except subprocess.CalledProcessError as e:
                 # For some reason mypy wants us to return, even though
                 # _raise_runner_command_error is NoReturn
@@ -429,6 +659,19 @@ class Runner:
                     stdout=runner_stdout, stderr=runner_stderr, original_error=e
                 )
 
+    def kill_command(self, command_name: str) -> None:
+        """
+        Kills a command run by run_command with all its child processes,
+        leaving the other commands of the runner alone.
+
+        :param command_name: The --name the command was run with.
+        """
+        subprocess.run(
+            ["docker", "exec", self.name, RUNNER_PATH, "--kill", command_name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
     async def async_run_command(
         self,
         args: List[str],
@@ -436,12 +679,14 @@ class Runner:
         max_stack_size: Optional[int] = None,
         max_virtual_memory: Optional[int] = None,
         as_root: bool = False,
-        stdin: Optional[IO[AnyStr]] = None,
+        stdin: Optional[IO[bytes]] = None,
         timeout: Optional[int] = None,
         check: bool = False,
         truncate_stdout: Optional[int] = None,
         truncate_stderr: Optional[int] = None,
-    ) -> CompletedCommand:
+        output_limit: Optional[int] = None,
+        stdin_file: Optional[str] = None,
+    ) -> CommandResult:
         loop = asyncio.get_event_loop()
         return await loop.run_in_executor(
             None,
@@ -456,6 +701,8 @@ class Runner:
             check,
             truncate_stdout,
             truncate_stderr,
+            output_limit,
+            stdin_file,
         )
 
     def _raise_runner_command_error(
@@ -463,7 +710,7 @@ class Runner:
         *,
         stdout: IO[bytes],
         stderr: IO[bytes],
-        original_error: Optional[Exception] = None
+        original_error: Optional[Exception] = None,
     ) -> NoReturn:
         stdout.seek(0)
         stderr.seek(0)
@@ -477,20 +724,83 @@ class Runner:
             raise new_error from original_error
         raise new_error
 
-    def add_directory(self, directory: str) -> None:
-        subprocess.check_call(
-            ["docker", "cp", "-", self.name + ":" + RUNNER_WORKING_DIR_NAME]
+    def put_archive(self, path: str, chunks: Iterable[bytes]) -> None:
+        """
+        Streams a tar archive into the runner and extracts it at path.
+        """
+        with subprocess.Popen(
+            ["docker", "cp", "-", self.name + ":" + path], stdin=subprocess.PIPE
+        ) as process:
+            assert process.stdin is not None
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            finally:
+                process.stdin.close()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    @contextmanager
+    def get_archive(self, path: str) -> Iterator[IO[bytes]]:
+        """
+        Streams path (a file or a directory) out of the runner as a tar
+        archive, which should be read from the yielded pipe.
+        """
+        with subprocess.Popen(
+            ["docker", "cp", self.name + ":" + path, "-"], stdout=subprocess.PIPE
+        ) as process:
+            assert process.stdout is not None
+            yield process.stdout
+            process.stdout.read()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    def _put_members(
+        self,
+        fs: FS,
+        members: Iterable[ArchiveMember],
+        owner: str,
+        read_only: bool,
+    ) -> None:
+        if owner != RUNNER_USERNAME and owner != "root":
+            raise ValueError('Invalid value for parameter "owner": {}'.format(owner))
+
+        self.put_archive(
+            RUNNER_WORKING_DIR_NAME,
+            iter_tar(fs, members, uname=owner, read_only=read_only),
         )
 
+    def add_directory(
+        self,
+        directory: str,
+        *,
+        fs: Optional[FS] = None,
+        owner: str = RUNNER_USERNAME,
+        read_only: bool = False,
+    ) -> None:
+        """
+        Copies the content of directory into the working directory of this
+        runner. See add_files for the meaning of the other parameters.
+        """
+        if fs is None:
+            fs, directory = host_fs(), host_path(directory)
+        self._put_members(fs, directory_members(fs, directory), owner, read_only)
+
     def add_files(
-        self, *filenames: str, owner: str = RUNNER_USERNAME, read_only: bool = False
+        self,
+        *filenames: str,
+        fs: Optional[FS] = None,
+        owner: str = RUNNER_USERNAME,
+        read_only: bool = False,
     ) -> None:
         """
-        Copies the specified files into the working directory of this
-        runner.
+        Copies the specified files (or directories) into the working
+        directory of this runner.
         The filenames specified can be absolute paths or relative paths
         to the current working directory.
 
+        :param fs: When not None, the filenames are paths in this
+            filesystem (e.g. the fs of a TempStorage) instead of the host.
         :param owner: The name of a user who should be granted ownership of
             the newly added files.
             Must be either Runner.RUNNER_USERNAME or 'root',
@@ -498,42 +808,32 @@ class Runner:
         :param read_only: If true, the new files' permissions will be set to
             read-only.
         """
-        if owner != RUNNER_USERNAME and owner != "root":
-            raise ValueError('Invalid value for parameter "owner": {}'.format(owner))
-
-        with tempfile.TemporaryFile() as f, tarfile.TarFile(
-            fileobj=f, mode="w"
-        ) as tar_file:
-            for filename in filenames:
-                tar_file.add(filename, arcname=os.path.basename(filename))
-
-            f.seek(0)
-            subprocess.check_call(
-                ["docker", "cp", "-", self.name + ":" + RUNNER_WORKING_DIR_NAME],
-                stdin=f,
-            )
-
-            file_basenames = [os.path.basename(filename) for filename in filenames]
-            if owner == RUNNER_USERNAME:
-                self._chown_files(file_basenames)
-
-            if read_only:
-                chmod_cmd = ["chmod", "444"] + file_basenames
-                self.run_command(chmod_cmd, as_root=True)
+        if fs is None:
+            fs, filenames = host_fs(), tuple(map(host_path, filenames))
+        self._put_members(fs, file_members(fs, filenames), owner, read_only)
 
     def add_and_rename_file(self, filename: str, new_filename: str) -> None:
         """
         Copies the specified file into the working directory of this
         runner and renames it to new_filename.
         """
-        dest = os.path.join(self.name + ":" + RUNNER_WORKING_DIR_NAME, new_filename)
-        subprocess.check_call(["docker", "cp", filename, dest])
-        self._chown_files([new_filename])
+        fs = host_fs()
+        self._put_members(
+            fs, [(host_path(filename), new_filename)], RUNNER_USERNAME, False
+        )
 
-    def _chown_files(self, filenames: Sequence[str]) -> None:
-        chown_cmd = ["chown", "{}:{}".format(RUNNER_USERNAME, RUNNER_USERNAME)]
-        chown_cmd += filenames
-        self.run_command(chown_cmd, as_root=True)
+    def get_files(self, *paths: str) -> Dict[str, bytes]:
+        """
+        Reads the specified files (or directories, recursively) from the
+        runner into memory, keyed by their path inside the runner.
+        Relative paths are relative to the working directory.
+        """
+        files = {}
+        for path in paths:
+            path = os.path.join(RUNNER_WORKING_DIR_NAME, path)
+            with self.get_archive(path) as archive:
+                files.update(read_tar(archive, os.path.dirname(path)))
+        return files
 
 
 # Generator that reads amount_to_read bytes from file_obj, yielding
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 from pydantic import BaseModel
 
@@ -40,6 +40,63 @@ class RecordCaseResult(StrEnumMixin, Enum):
     etc = "etc"
 
 
+class RunnerCommand(BaseModel):
+    """
+    A command to be run by the runner binary, with its output limits.
+    """
+
+    args: List[str]
+    # bytes of stdout / stderr kept in the result, the runner binary keeps
+    # RUNNER_DEFAULT_TRUNCATE bytes when None
+    truncate_stdout: Optional[int] = None
+    truncate_stderr: Optional[int] = None
+    # the command is killed when stdout or stderr exceeds this many bytes
+    output_limit: Optional[int] = None
+    # files inside the runner receiving the whole stdout / stderr
+    stdout_file: Optional[str] = None
+    stderr_file: Optional[str] = None
+    # file inside the runner opened as the stdin of the command, which reads
+    # /dev/null when None
+    stdin_file: Optional[str] = None
+    # cpus the command is pinned to, in the cpuset list format (e.g. "3")
+    cpuset: Optional[str] = None
+    # cpu time in milliseconds, the command is killed when exceeding it (or
+    # twice as much wall time) and timed_out is set in the result
+    time_limit: Optional[int] = None
+    # memory of the command (and its children) in bytes
+    memory_limit: Optional[int] = None
+    stack_limit: Optional[int] = None
+    pids_limit: Optional[int] = None
+
+    def to_flags(self) -> List[str]:
+        flags = []
+        for name, value in self.dict(exclude={"args"}, exclude_none=True).items():
+            flags += ["--" + name, str(value)]
+        return flags
+
+    def to_request(self, request_id: int) -> Dict[str, Any]:
+        return {
+            "ID": request_id,
+            "Args": self.args,
+            # negative for the default of the runner binary, 0 keeps nothing
+            "TruncateStdout": -1
+            if self.truncate_stdout is None
+            else self.truncate_stdout,
+            "TruncateStderr": -1
+            if self.truncate_stderr is None
+            else self.truncate_stderr,
+            "OutputLimit": self.output_limit or 0,
+            "StdoutFile": self.stdout_file or "",
+            "StderrFile": self.stderr_file or "",
+            "StdinFile": self.stdin_file or "",
+            "Cpuset": self.cpuset or "",
+            "TimeLimit": self.time_limit or 0,
+            "MemoryLimit": self.memory_limit or 0,
+            "StackLimit": self.stack_limit or 0,
+            "PidsLimit": self.pids_limit or 0,
+        }
+
+
 class CompletedCommand(BaseModel):
     return_code: int
     stdout: bytes
@@ -49,11 +106,108 @@ class CompletedCommand(BaseModel):
     stderr_truncated: bool
     time: int
     memory: int
+    memory_limit_exceeded: bool = False
+    output_limit_exceeded: bool = False
+
+
+Output = Union[bytes, memoryview]
+
+
+class CommandResult:
+    """
+    The result of a command as decoded from the runner binary.
+
+    This is the validation-free internal counterpart of CompletedCommand:
+    stdout and stderr are slices of the buffer the result was decoded from
+    (except for the synchronous Runner, which has to copy them out of the
+    mapped file), nothing is copied until to_completed_command() is called
+    at the API boundary.
+    """
+
+    __slots__ = (
+        "return_code",
+        "stdout",
+        "stderr",
+        "timed_out",
+        "stdout_truncated",
+        "stderr_truncated",
+        "time",
+        "memory",
+        "memory_limit_exceeded",
+        "output_limit_exceeded",
+    )
+
+    def __init__(
+        self,
+        return_code: int,
+        stdout: Output,
+        stderr: Output,
+        timed_out: bool = False,
+        stdout_truncated: bool = False,
+        stderr_truncated: bool = False,
+        time: int = 0,
+        memory: int = 0,
+        memory_limit_exceeded: bool = False,
+        output_limit_exceeded: bool = False,
+    ):
+        self.return_code = return_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.stdout_truncated = stdout_truncated
+        self.stderr_truncated = stderr_truncated
+        self.time = time
+        self.memory = memory
+        self.memory_limit_exceeded = memory_limit_exceeded
+        self.output_limit_exceeded = output_limit_exceeded
+
+    def __repr__(self) -> str:
+        return (
+            f"CommandResult(return_code={self.return_code}, "
+            f"stdout=<{len(self.stdout)} bytes>, stderr=<{len(self.stderr)} bytes>, "
+            f"timed_out={self.timed_out}, time={self.time}, memory={self.memory}, "
+            f"memory_limit_exceeded={self.memory_limit_exceeded}, "
+            f"output_limit_exceeded={self.output_limit_exceeded})"
+        )
+
+    def to_completed_command(self, truncate: Optional[int] = None) -> CompletedCommand:
+        """
+        :param truncate: When not None, stdout and stderr are truncated
+            after this many bytes, e.g. to report a command whose whole
+            output was kept for checking.
+        """
+        stdout, stderr = self.stdout[:truncate], self.stderr[:truncate]
+        return CompletedCommand(
+            return_code=self.return_code,
+            stdout=bytes(stdout),
+            stderr=bytes(stderr),
+            timed_out=self.timed_out,
+            stdout_truncated=self.stdout_truncated or len(stdout) < len(self.stdout),
+            stderr_truncated=self.stderr_truncated or len(stderr) < len(self.stderr),
+            time=self.time,
+            memory=self.memory,
+            memory_limit_exceeded=self.memory_limit_exceeded,
+            output_limit_exceeded=self.output_limit_exceeded,
+        )
+
+
+class CheckMode(StrEnumMixin, Enum):
+    exact = "exact"
+    trailing_whitespace = "trailing_whitespace"
+    token = "token"
+    float = "float"
+
+
+class CheckResult(BaseModel):
+    accepted: bool
+    # where the output first differs from the answer, in bytes
+    offset: Optional[int] = None
 
 
 class ExecuteResult(BaseModel):
     status: RecordCaseResult
     completed_command: CompletedCommand
+    check_result: Optional[CheckResult] = None
 
 
 class SubmitResult(BaseModel):
@@ -0,0 +1,349 @@
+import asyncio
+import os
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fs.base import FS
+
+from joj.tiger.async_runner import AsyncRunner, RunnerDaemon
+from joj.tiger.pool import RunnerPool
+from joj.tiger.runner import RUNNER_WORKING_DIR_NAME, RunnerCommandError
+from joj.tiger.schemas import CommandResult, RunnerCommand
+from joj.tiger.utils.archive import iter_tar
+from joj.tiger.utils.cpuset import reserve_cpus
+
+# where the snapshot is written before it is fetched, see take_snapshot
+SESSION_SNAPSHOT_PATH = "/tmp/.joj-snapshot.tar"
+# where the input of a case is copied before it starts, see stage_inputs
+SESSION_INPUT_DIR = "/tmp/.joj-input"
+
+
+class JudgeSession:
+    """
+    A runner kept for all the stages of a submission.
+
+    The session leases one runner from a pool and starts a RunnerDaemon in
+    it, the compile command and all the cases then run in the same
+    container, so the compiled artifact is available to the cases and the
+    container is set up only once. Between two cases only the runtime state
+    is reset: the processes left by a case are killed by the runner binary
+    itself, /tmp is emptied and, if snapshot is enabled, the working
+    directory is restored to its state right after compilation.
+
+    Cases run as root, so nothing they can write is kept across a reset:
+    the snapshot and the case inputs are kept on the host and copied into
+    the runner after the reset, see take_snapshot and stage_inputs. The
+    input of a case is opened by the runner binary as its stdin instead of
+    being piped through docker.
+    """
+
+    def __init__(
+        self,
+        pool: RunnerPool,
+        snapshot: Optional[bool] = None,
+        task_id: Optional[str] = None,
+    ):
+        """
+        :param pool: The pool to lease the runner from.
+
+        :param snapshot: Whether each case starts from the post-compile
+            filesystem, defaults to the snapshot option of the image.
+
+        :param task_id: The celery task the session runs for, see
+            RunnerPool.lease.
+        """
+        self._pool = pool
+        self._task_id = task_id
+        self._snapshot = pool.image.snapshot if snapshot is None else snapshot
+        self._exit_stack = AsyncExitStack()
+        self._runner: Optional[AsyncRunner] = None
+        self._daemon: Optional[RunnerDaemon] = None
+        self._snapshot_archive: Optional[bytes] = None
+        # the filesystem and path of the inputs by their input_path
+        self._inputs: Dict[str, Tuple[FS, str]] = {}
+
+    async def __aenter__(self) -> "JudgeSession":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.stop()
+
+    @property
+    def pool(self) -> RunnerPool:
+        return self._pool
+
+    @property
+    def snapshot(self) -> bool:
+        return self._snapshot
+
+    @property
+    def runner(self) -> AsyncRunner:
+        if self._runner is None:
+            raise RuntimeError("judge session is not started")
+        return self._runner
+
+    @property
+    def daemon(self) -> RunnerDaemon:
+        if self._daemon is None:
+            raise RuntimeError("judge session is not started")
+        return self._daemon
+
+    async def start(self) -> None:
+        try:
+            self._runner = await self._exit_stack.enter_async_context(
+                self._pool.lease(self._task_id)
+            )
+            self._exit_stack.push_async_callback(self._stop_daemon)
+            await self._start_daemon()
+        except BaseException:
+            await self._exit_stack.aclose()
+            raise
+
+    async def stop(self) -> None:
+        await self._exit_stack.aclose()
+        self._runner = self._daemon = None
+
+    async def _start_daemon(self) -> None:
+        daemon = RunnerDaemon(self.runner)
+        await daemon.start()
+        self._daemon = daemon
+
+    async def _stop_daemon(self) -> None:
+        daemon, self._daemon = self._daemon, None
+        if daemon is not None:
+            await daemon.stop()
+
+    async def recycle(self) -> None:
+        """
+        Prepares the session for another submission without handing its
+        runner back: the daemon is restarted after cleaning the runner as a
+        pool does, and the snapshot and the staged inputs are dropped.
+        """
+        await self._stop_daemon()
+        await self.runner.clean()
+        self._snapshot_archive = None
+        self._inputs.clear()
+        await self._start_daemon()
+
+    async def compile(self, command: RunnerCommand) -> CommandResult:
+        """
+        Runs the compile command, then takes the snapshot of the working
+        directory if enabled.
+        """
+        result = await self.daemon.run(command)
+        if self._snapshot:
+            await self.take_snapshot()
+        return result
+
+    async def take_snapshot(self) -> None:
+        """
+        Archives the working directory and keeps the archive on the host,
+        where the cases cannot alter it. The archive written in the runner
+        is removed by the next reset.
+        """
+        await self.daemon.run_command(
+            [
+                "tar",
+                "-cf",
+                SESSION_SNAPSHOT_PATH,
+                "-C",
+                RUNNER_WORKING_DIR_NAME,
+                ".",
+            ],
+            check=True,
+        )
+        files = await self.runner.get_files(SESSION_SNAPSHOT_PATH)
+        self._snapshot_archive = files[SESSION_SNAPSHOT_PATH]
+
+    @staticmethod
+    def input_path(path: str) -> str:
+        """
+        Where the input staged from path (see stage_inputs) is in the runner.
+        """
+        return os.path.join(SESSION_INPUT_DIR, path.lstrip("/"))
+
+    def stage_inputs(self, fs: FS, paths: Sequence[str]) -> None:
+        """
+        Makes the files at paths in fs available to the cases at their
+        input_path. A file is copied into the runner, read-only, right
+        before each case reading it as its stdin_file, after the reset, so
+        that no case sees what an earlier one did to it. The inputs are
+        kept until the session is recycled, and staged as well in the
+        sessions this one is copied to.
+        """
+        for path in paths:
+            self._inputs[self.input_path(path)] = (fs, path)
+
+    async def _copy_input(self, command: RunnerCommand) -> None:
+        if command.stdin_file not in self._inputs:
+            return
+        fs, path = self._inputs[command.stdin_file]
+        name = os.path.join(os.path.basename(SESSION_INPUT_DIR), path.lstrip("/"))
+        await self.runner.put_archive(
+            os.path.dirname(SESSION_INPUT_DIR),
+            iter_tar(fs, [(path, name)], read_only=True),
+        )
+
+    async def copy_to(self, other: "JudgeSession") -> None:
+        """
+        Copies the working directory of this session into other, e.g. to
+        run cases in other after compiling in this session, along with the
+        staged inputs.
+        """
+        other._inputs.update(self._inputs)
+        await other.restore_working_dir([await self.working_dir_archive()])
+
+    async def working_dir_archive(self) -> bytes:
+        """
+        A tar archive of the working directory as of the last snapshot, or
+        as of now if no snapshot was taken yet.
+        """
+        if self._snapshot_archive is None:
+            await self.take_snapshot()
+        assert self._snapshot_archive is not None
+        return self._snapshot_archive
+
+    async def restore_working_dir(self, chunks: Iterable[bytes]) -> None:
+        """
+        Extracts a tar archive returned by working_dir_archive into the
+        working directory, in place of compiling, and keeps it as the
+        snapshot of the working directory if enabled.
+        """
+        if not self._snapshot:
+            await self.runner.put_archive(RUNNER_WORKING_DIR_NAME, chunks)
+            return
+        archive = b"".join(chunks)
+        await self.runner.put_archive(RUNNER_WORKING_DIR_NAME, [archive])
+        self._snapshot_archive = archive
+
+    @staticmethod
+    def _reset_command(restore: bool) -> RunnerCommand:
+        script = "find /tmp -mindepth 1 -maxdepth 1 -exec rm -rf {{}} +"
+        if restore:
+            script += (
+                " && find {working_dir} -mindepth 1 -maxdepth 1 -exec rm -rf {{}} +"
+            )
+        return RunnerCommand(
+            args=["sh", "-c", script.format(working_dir=RUNNER_WORKING_DIR_NAME)]
+        )
+
+    async def _reset(self, command: RunnerCommand, restore: bool) -> None:
+        """
+        Empties /tmp, and the working directory if restore and a snapshot
+        was taken, then copies the snapshot and the input of command into
+        the runner.
+        """
+        archive = self._snapshot_archive if restore and self._snapshot else None
+        result = await self.daemon.run(self._reset_command(archive is not None))
+        if result.return_code != 0 or result.timed_out:
+            raise RunnerCommandError(
+                "session reset failed: "
+                + bytes(result.stderr).decode("utf-8", "surrogateescape")
+            )
+        if archive is not None:
+            await self.runner.put_archive(RUNNER_WORKING_DIR_NAME, [archive])
+        await self._copy_input(command)
+
+    async def _run_with_resets(
+        self,
+        commands: Sequence[RunnerCommand],
+        timeout: Optional[int],
+        reset_first: bool = False,
+    ) -> AsyncIterator[CommandResult]:
+        """
+        Runs the commands one by one through the daemon, each one after a
+        reset that restores the snapshot (but for the first one unless
+        reset_first), and yields their results in order.
+        """
+        for i, command in enumerate(commands):
+            await self._reset(command, restore=i > 0 or reset_first)
+            yield await self.daemon.run(command, timeout)
+
+    async def execute(
+        self,
+        commands: Sequence[RunnerCommand],
+        timeout: Optional[int] = None,
+        max_parallel: int = 1,
+    ) -> AsyncIterator[CommandResult]:
+        """
+        Runs the cases and yields their results in order.
+
+        Every case is pinned to a cpu reserved for this session, see
+        reserve_cpus. When max_parallel is greater than 1, up to
+        max_parallel cases run at the same time, each in its own runner
+        pinned to its own cpu; the extra runners are leased from the same
+        pool and receive a copy of the working directory of this session.
+        If no cpu can be reserved, the cases run sequentially, unpinned.
+        """
+        with reserve_cpus(min(max_parallel, len(commands))) as cpus:
+            if len(cpus) <= 1:
+                if cpus:
+                    commands = [
+                        command.copy(update={"cpuset": str(cpus[0])})
+                        for command in commands
+                    ]
+                async for result in self._run_with_resets(commands, timeout):
+                    yield result
+                return
+
+            async with AsyncExitStack() as exit_stack:
+                sessions = [self]
+                for _ in cpus[1:]:
+                    session = await exit_stack.enter_async_context(
+                        JudgeSession(self._pool, self._snapshot, self._task_id)
+                    )
+                    await self.copy_to(session)
+                    sessions.append(session)
+                async for result in self._execute_parallel(
+                    sessions, cpus, commands, timeout
+                ):
+                    yield result
+
+    @staticmethod
+    async def _execute_parallel(
+        sessions: Sequence["JudgeSession"],
+        cpus: Sequence[int],
+        commands: Sequence[RunnerCommand],
+        timeout: Optional[int],
+    ) -> AsyncIterator[CommandResult]:
+        loop = asyncio.get_running_loop()
+        futures: List["asyncio.Future[CommandResult]"] = [
+            loop.create_future() for _ in commands
+        ]
+        # shared by the lanes, each case is taken by the first idle lane
+        queue = iter(enumerate(commands))
+
+        async def lane(session: JudgeSession, cpu: int) -> None:
+            reset_first = False
+            for i, command in queue:
+                try:
+                    async for result in session._run_with_resets(
+                        [command.copy(update={"cpuset": str(cpu)})],
+                        timeout,
+                        reset_first,
+                    ):
+                        futures[i].set_result(result)
+                except Exception as e:
+                    # the runner of this lane is broken, fail the execution
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    return
+                reset_first = True
+
+        lanes = [
+            asyncio.create_task(lane(session, cpu))
+            for session, cpu in zip(sessions, cpus)
+        ]
+        try:
+            for future in futures:
+                yield await future
+        finally:
+            for task in lanes:
+                task.cancel()
+            await asyncio.gather(*lanes, return_exceptions=True)
+            for future in futures:
+                if future.done() and not future.cancelled():
+                    # retrieved, so that asyncio does not log them
+                    future.exception()
@@ -1,7 +1,10 @@
 import asyncio
+import os
+import shutil
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
-from functools import lru_cache
-from typing import Any, Awaitable, Dict, List, cast
+from functools import lru_cache, partial
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, cast
 from uuid import UUID, uuid4
 
 import orjson
@@ -12,19 +15,45 @@ from loguru import logger
 from joj.elephant.manager import Manager
 from joj.elephant.rclone import RClone
 from joj.elephant.schemas import Case, Config, Language
-from joj.elephant.storage import LakeFSStorage, Storage, TempStorage
+from joj.elephant.storage import LakeFSStorage, LocalStorage, Storage, TempStorage
 from joj.horse_client.models import JudgerCredentials, RecordSubmit
 from joj.tiger import errors
+from joj.tiger.checker import check_output
 from joj.tiger.config import settings
 from joj.tiger.horse_apis import HorseClient
-from joj.tiger.runner import Runner
+from joj.tiger.lock_manager import host_lock
+from joj.tiger.pool import RunnerPool, get_runner_pool
+from joj.tiger.reaper import track_task
+from joj.tiger.result_cache import get_result_cache, is_reusable
+from joj.tiger.runner import (
+    RUNNER_CASE_PIDS_LIMIT,
+    RUNNER_COMPILE_TIME_LIMIT,
+    RUNNER_OUTPUT_LIMIT,
+    RUNNER_TRUNCATE_OUTPUT,
+)
 from joj.tiger.schemas import (
+    CommandResult,
     CompletedCommand,
     ExecuteResult,
     RecordCaseResult,
     RecordState,
+    RunnerCommand,
     SubmitResult,
 )
+from joj.tiger.session import JudgeSession
+from joj.tiger.toolchains import get_toolchains_config
+from joj.tiger.utils.archive import iter_file
+from joj.tiger.utils.cache import DirectoryCache, fs_digest
+from joj.tiger.utils.docker import get_docker
+from joj.tiger.utils.lakefs import apply_diff, iter_diff
+from joj.tiger.utils.units import parse_memory, parse_time
+
+# the files of an entry of the artifact cache, the outputs of the compile
+# command are kept apart since they may not be valid utf-8
+ARTIFACT_ARCHIVE = "working_dir.tar"
+ARTIFACT_RESULT = "compile_result.json"
+ARTIFACT_STDOUT = "compile_stdout"
+ARTIFACT_STDERR = "compile_stderr"
 
 
 @lru_cache
@@ -41,6 +70,70 @@ endpoint = http://{settings.lakefs_s3_domain}:{settings.lakefs_port}
     return RClone(rclone_config)
 
 
+def dump_compile_result(directory: str, res: CompletedCommand) -> None:
+    with open(os.path.join(directory, ARTIFACT_RESULT), "w") as f:
+        f.write(res.json(exclude={"stdout", "stderr"}))
+    with open(os.path.join(directory, ARTIFACT_STDOUT), "wb") as f:
+        f.write(res.stdout)
+    with open(os.path.join(directory, ARTIFACT_STDERR), "wb") as f:
+        f.write(res.stderr)
+
+
+def load_compile_result(directory: str) -> CompletedCommand:
+    with open(os.path.join(directory, ARTIFACT_RESULT), "rb") as f:
+        fields = orjson.loads(f.read())
+    with open(os.path.join(directory, ARTIFACT_STDOUT), "rb") as f:
+        fields["stdout"] = f.read()
+    with open(os.path.join(directory, ARTIFACT_STDERR), "rb") as f:
+        fields["stderr"] = f.read()
+    return CompletedCommand(**fields)
+
+
+@lru_cache
+def get_artifact_cache() -> DirectoryCache:
+    return DirectoryCache(
+        settings.artifact_cache_dir, parse_memory(settings.artifact_cache_size)
+    )
+
+
+@contextmanager
+def problem_fill_lock(key: str) -> Iterator[None]:
+    """
+    Lets a single worker process of the host download a problem, the other
+    ones wait for it and then read it from the cache. If the lock cannot be
+    taken (e.g. redis is down), the problem is downloaded anyway.
+    """
+    with ExitStack() as exit_stack:
+        try:
+            exit_stack.enter_context(host_lock(f"problem:{key}"))
+        except Exception as e:
+            logger.warning(f"problem {key} fetched without the host lock: {e}")
+        yield
+
+
+def get_lakefs_api_url() -> str:
+    host = settings.lakefs_host or settings.lakefs_s3_domain
+    return f"http://{host}:{settings.lakefs_port}/api/v1"
+
+
+def clear_directory(directory: str) -> None:
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+@lru_cache
+def get_problem_cache() -> DirectoryCache:
+    return DirectoryCache(
+        settings.problem_cache_dir,
+        parse_memory(settings.problem_cache_size),
+        fill_lock=problem_fill_lock,
+    )
+
+
 class TigerTask:
     id: UUID
     task: Task
@@ -54,14 +147,26 @@ class TigerTask:
     tasks: List[Awaitable[Any]]
     submit_res: SubmitResult
     judged_at: datetime
+    exit_stack: ExitStack
+    reuse_results: bool
+    record_digest: Optional[str]
 
-    def __init__(self, task: Task, record: Dict[str, Any], base_url: str) -> None:
+    def __init__(
+        self,
+        task: Task,
+        record: Dict[str, Any],
+        base_url: str,
+        horse_client: Optional[HorseClient] = None,
+    ) -> None:
         self.id = uuid4()  # this id should be unique, be used to create docker images
         self.task = task
         self.task_id = cast(str, cast(Context, task.request).id)
         self.record = record
-        self.horse_client = HorseClient(base_url)
+        self.horse_client = horse_client or HorseClient(base_url)
         self.tasks = []
+        self.exit_stack = ExitStack()
+        self.reuse_results = True
+        self.record_digest = None
 
     async def login(self) -> None:
         await self.horse_client.login()
@@ -77,27 +182,59 @@ class TigerTask:
         )
 
     async def fetch_problem_config(self) -> None:
-        def sync_func() -> None:
+        repo_name = self.credentials.problem_config_repo_name
+        commit_id = self.credentials.problem_config_commit_id
+
+        def populate(directory: str) -> None:
+            cache = get_problem_cache()
             source = LakeFSStorage(
                 endpoint_url=f"http://{settings.lakefs_s3_domain}:{settings.lakefs_port}",
-                repo_name=self.credentials.problem_config_repo_name,
-                branch_name=self.credentials.problem_config_commit_id,
+                repo_name=repo_name,
+                branch_name=commit_id,
                 username=settings.lakefs_username,
                 password=settings.lakefs_password,
                 host_in_config="lakefs",
             )
+            base_commit_id = cache.get_ref(repo_name)
+            if base_commit_id is not None and base_commit_id != commit_id:
+                try:
+                    with cache.get(cache.key(repo_name, base_commit_id)) as base:
+                        if base is not None:
+                            self.sync_problem_diff(
+                                source, base_commit_id, base, directory
+                            )
+                            return
+                except Exception as e:
+                    logger.warning(
+                        f"Task joj.tiger.task[{self.id}] problem diff from "
+                        f"{base_commit_id} failed: {e}"
+                    )
+                    clear_directory(directory)
             rclone = get_rclone()
-            self.config_storage = TempStorage()
-            manager = Manager(rclone, source, self.config_storage)
+            manager = Manager(rclone, source, LocalStorage(directory))
             manager.sync_without_validation()
+
+        def sync_func() -> None:
+            # a commit never changes, so its files are shared by every task
+            # judging it, until the task exits (see run)
+            cache = get_problem_cache()
+            path = self.exit_stack.enter_context(
+                cache.open(cache.key(repo_name, commit_id), populate)
+            )
+            # the next commits of the problem are synced from this one
+            cache.set_ref(repo_name, commit_id)
+            self.config_storage = LocalStorage(path)
             logger.info(
                 f"Task joj.tiger.task[{self.id}] config fetched: "
                 f"{self.config_storage.fs.listdir('/')}"
             )
             try:
                 config_json_file = self.config_storage.fs.open("config.json")
-                original_config = Config(**orjson.loads(config_json_file.read()))
+                config_json = orjson.loads(config_json_file.read())
+                original_config = Config(**config_json)
                 config = Config.parse_defaults(original_config)
+                # e.g. false for problems whose checkers are nondeterministic
+                self.reuse_results = bool(config_json.get("reuse_results", True))
             except Exception:
                 config = Config.generate_default_value()
             logger.debug(f"parsed config: {config}")
@@ -115,6 +252,30 @@ class TigerTask:
             f"Task joj.tiger.task[{self.id}] problem config fetched: {self.config}"
         )
 
+    def sync_problem_diff(
+        self, source: LakeFSStorage, base_commit_id: str, base: str, directory: str
+    ) -> None:
+        """
+        Materializes the problem config of source in directory from base,
+        the cache entry of an older commit, downloading only the objects
+        changed since, as listed by the diff API of lakefs.
+        """
+        repo_name = self.credentials.problem_config_repo_name
+        commit_id = self.credentials.problem_config_commit_id
+        changes = iter_diff(
+            get_lakefs_api_url(),
+            repo_name,
+            base_commit_id,
+            commit_id,
+            settings.lakefs_username,
+            settings.lakefs_password,
+        )
+        downloaded = apply_diff(source.fs, base, directory, changes)
+        logger.info(
+            f"Task joj.tiger.task[{self.id}] problem synced from {base_commit_id}"
+            f" to {commit_id}: {downloaded} objects downloaded"
+        )
+
     async def fetch_record(self) -> None:
         def sync_func() -> None:
             source = LakeFSStorage(
@@ -137,65 +298,264 @@ class TigerTask:
         loop = asyncio.get_event_loop()
         await loop.run_in_executor(None, sync_func)
 
-    async def compile(self) -> CompletedCommand:
+    async def get_record_digest(self) -> str:
+        if self.record_digest is None:
+            loop = asyncio.get_running_loop()
+            self.record_digest = await loop.run_in_executor(
+                None, fs_digest, self.record_storage.fs
+            )
+        return self.record_digest
+
+    async def artifact_key(self, session: JudgeSession) -> str:
+        image = await get_docker().images.inspect(session.runner.docker_image)
+        return DirectoryCache.key(
+            await self.get_record_digest(),
+            orjson.dumps(self.config.compile_args).decode(),
+            image["Id"],
+        )
+
+    async def result_key(self) -> str:
+        # the results change with the compilers of the image
+        image = await get_docker().images.inspect(
+            self.runner_pool().image.container_image
+        )
+        return DirectoryCache.key(
+            self.credentials.problem_config_repo_name,
+            self.credentials.problem_config_commit_id,
+            self.record["language"],
+            await self.get_record_digest(),
+            settings.output_check_mode,
+            image["Id"],
+        )
+
+    async def reuse_result(self) -> bool:
+        """
+        Takes the result of an identical submission judged before, if any,
+        and submits its cases again.
+        """
+        cache = get_result_cache()
+        if cache is None or not self.reuse_results:
+            return False
+        loop = asyncio.get_running_loop()
+        try:
+            res = await loop.run_in_executor(None, cache.get, await self.result_key())
+        except Exception as e:
+            logger.warning(f"Task joj.tiger.task[{self.id}] result not reused: {e}")
+            return False
+        if res is None:
+            return False
+        for case_number, exec_res in enumerate(res.execute_results or []):
+            self.submit_case(case_number, exec_res)
+        self.submit_res = res
+        logger.info(f"Task joj.tiger.task[{self.id}] result reused: {res}")
+        return True
+
+    async def save_result(self) -> None:
+        cache = get_result_cache()
+        if cache is None or not self.reuse_results:
+            return
+        if not is_reusable(self.submit_res):
+            logger.info(f"Task joj.tiger.task[{self.id}] result not reusable")
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            key = await self.result_key()
+            await loop.run_in_executor(None, cache.put, key, self.submit_res)
+        except Exception as e:
+            logger.warning(f"Task joj.tiger.task[{self.id}] result not saved: {e}")
+
+    async def compile(self, session: JudgeSession) -> Optional[CompletedCommand]:
+        # the cases need the record files even when nothing is compiled (e.g.
+        # interpreted languages) or the compilation is cached
+        await session.runner.add_directory("/", fs=self.record_storage.fs)
         if len(self.config.compile_args) == 0:
+            if session.snapshot:
+                await session.take_snapshot()
             logger.info(f"Task joj.tiger.task[{self.id}] compile stage skipped")
-        with Runner() as runner:
-            # TODO: add files
-            res = await runner.async_run_command(self.config.compile_args)
+            return None
+        cache = get_artifact_cache()
+        key = await self.artifact_key(session)
+        loop = asyncio.get_running_loop()
+        # held until the task exits, so that the entry is not evicted meanwhile
+        path = await loop.run_in_executor(
+            None, self.exit_stack.enter_context, cache.get(key)
+        )
+        if path is not None:
+            res = load_compile_result(path)
+            with open(os.path.join(path, ARTIFACT_ARCHIVE), "rb") as f:
+                await session.restore_working_dir(iter_file(f))
+            logger.info(
+                f"Task joj.tiger.task[{self.id}] compile result (cached): {res}"
+            )
+            return res
+        command_res = await session.compile(
+            RunnerCommand(
+                args=self.config.compile_args,
+                truncate_stdout=RUNNER_TRUNCATE_OUTPUT,
+                truncate_stderr=RUNNER_TRUNCATE_OUTPUT,
+                output_limit=RUNNER_OUTPUT_LIMIT,
+                time_limit=RUNNER_COMPILE_TIME_LIMIT,
+            )
+        )
+        res = command_res.to_completed_command()
+        # only successful compilations are cached, the others may depend on
+        # the load of the host (e.g. time limit)
+        if command_res.return_code == 0 and not command_res.timed_out:
+            archive = await session.working_dir_archive()
+
+            def populate(directory: str) -> None:
+                with open(os.path.join(directory, ARTIFACT_ARCHIVE), "wb") as f:
+                    f.write(archive)
+                dump_compile_result(directory, res)
+
+            await loop.run_in_executor(None, cache.put, key, populate)
         # TODO: update state to horse
         logger.info(f"Task joj.tiger.task[{self.id}] compile result: {res}")
         return res
 
-    async def execute(self) -> List[ExecuteResult]:
+    def stage_inputs(self, session: JudgeSession) -> None:
+        cases: List[Case] = self.config.cases or []
+        paths = sorted(
+            {case.execute_input_file for case in cases if case.execute_input_file}
+        )
+        if paths:
+            session.stage_inputs(self.config_storage.fs, paths)
+
+    @staticmethod
+    def case_command(case: Case) -> RunnerCommand:
+        memory_limit = parse_memory(case.memory)
+        return RunnerCommand(
+            args=case.execute_args,
+            stdin_file=JudgeSession.input_path(case.execute_input_file)
+            if case.execute_input_file
+            else None,
+            # the whole stdout is kept in memory for the checker, which only
+            # streams the answer, see check_output
+            truncate_stdout=RUNNER_OUTPUT_LIMIT
+            if case.execute_output_file
+            else RUNNER_TRUNCATE_OUTPUT,
+            truncate_stderr=RUNNER_TRUNCATE_OUTPUT,
+            output_limit=RUNNER_OUTPUT_LIMIT,
+            time_limit=parse_time(case.time),
+            memory_limit=memory_limit,
+            stack_limit=memory_limit,
+            pids_limit=RUNNER_CASE_PIDS_LIMIT,
+        )
+
+    @staticmethod
+    def case_status(command_res: CommandResult) -> RecordCaseResult:
+        if command_res.timed_out:
+            return RecordCaseResult.time_limit_exceeded
+        if command_res.memory_limit_exceeded:
+            return RecordCaseResult.memory_limit_exceeded
+        if command_res.output_limit_exceeded:
+            return RecordCaseResult.output_limit_exceeded
+        if command_res.return_code != 0:
+            return RecordCaseResult.runtime_error
+        return RecordCaseResult.accepted
+
+    async def execute(self, session: JudgeSession) -> List[ExecuteResult]:
         res = []
-        with Runner() as runner:
-            # TODO: add files, check status & output
-            case: Case
-            for i, case in enumerate(self.config.cases or []):
-                status = RecordCaseResult.accepted
-                command_res = await runner.async_run_command(case.execute_args)
-                exec_res = ExecuteResult(status=status, completed_command=command_res)
-                res.append(exec_res)
-                self.tasks.append(
-                    asyncio.create_task(
-                        self.horse_client.submit_case(
-                            domain_id=self.record["domain_id"],
-                            record_id=self.record["id"],
-                            case_number=i,
-                            exec_res=exec_res,
-                        )
-                    )
+        cases: List[Case] = self.config.cases or []
+        async for command_res in session.execute(
+            [self.case_command(case) for case in cases],
+            max_parallel=settings.max_parallel_cases,
+        ):
+            case = cases[len(res)]
+            status = self.case_status(command_res)
+            check_result = None
+            if status == RecordCaseResult.accepted and case.execute_output_file:
+                # checked while the next cases run
+                check_result = await check_output(
+                    command_res.stdout,
+                    partial(self.config_storage.fs.openbin, case.execute_output_file),
+                    settings.output_check_mode,
                 )
+                if not check_result.accepted:
+                    status = RecordCaseResult.wrong_answer
+            exec_res = ExecuteResult(
+                status=status,
+                completed_command=command_res.to_completed_command(
+                    truncate=RUNNER_TRUNCATE_OUTPUT
+                ),
+                check_result=check_result,
+            )
+            self.submit_case(len(res), exec_res)
+            res.append(exec_res)
         logger.info(f"Task joj.tiger.task[{self.id}] execute result: {res}")
         return res
 
+    def submit_case(self, case_number: int, exec_res: ExecuteResult) -> None:
+        self.tasks.append(
+            asyncio.create_task(
+                self.horse_client.submit_case(
+                    domain_id=self.record["domain_id"],
+                    record_id=self.record["id"],
+                    case_number=case_number,
+                    exec_res=exec_res,
+                )
+            )
+        )
+
     async def clean(self) -> None:
         await asyncio.gather(*self.tasks)
 
+    def runner_pool(self) -> RunnerPool:
+        image = get_toolchains_config().find_language_image(self.record["language"])
+        if image is None:
+            return get_runner_pool()
+        return get_runner_pool(image.image)
+
+    async def open_session(self) -> JudgeSession:
+        session = JudgeSession(self.runner_pool(), task_id=self.task_id)
+        await session.start()
+        return session
+
+    async def close_session(self, session: JudgeSession) -> None:
+        await session.stop()
+
+    def retry(self) -> None:
+        self.task.retry(countdown=5)
+
     async def run(self) -> None:
-        try:
-            await self.login()
-            await self.claim()
-            await asyncio.gather(self.fetch_problem_config(), self.fetch_record())
-            self.judged_at = datetime.now()
-            compile_result = await self.compile()
-            execute_results = await self.execute()
-            self.submit_res = SubmitResult(
-                submit_status=RecordState.accepted,
-                compile_result=compile_result,
-                execute_results=execute_results,
-            )
-        except errors.WorkerRejectError as e:
-            logger.exception(e)
-            # fail the task
-            self.submit_res = SubmitResult(submit_status=RecordState.rejected)
-        except errors.RetryableError:
-            self.task.retry(countdown=5)
-        except Exception as e:
-            logger.exception(e)
-            # fail the task
-            self.submit_res = SubmitResult(submit_status=RecordState.rejected)
+        with track_task(self.task_id):
+            # the image only depends on the record, so the sandbox is acquired
+            # while the task talks to horse and lakefs
+            warm_up = asyncio.create_task(self.open_session())
+            try:
+                await self.login()
+                await self.claim()
+                await asyncio.gather(self.fetch_problem_config(), self.fetch_record())
+                self.judged_at = datetime.now()
+                if await self.reuse_result():
+                    return
+                session = await warm_up
+                self.stage_inputs(session)
+                compile_result = await self.compile(session)
+                execute_results = await self.execute(session)
+                self.submit_res = SubmitResult(
+                    submit_status=RecordState.accepted,
+                    compile_result=compile_result,
+                    execute_results=execute_results,
+                )
+                await self.save_result()
+            except errors.WorkerRejectError as e:
+                logger.exception(e)
+                # fail the task
+                self.submit_res = SubmitResult(submit_status=RecordState.rejected)
+            except errors.RetryableError:
+                self.retry()
+            except Exception as e:
+                logger.exception(e)
+                # fail the task
+                self.submit_res = SubmitResult(submit_status=RecordState.rejected)
+            finally:
+                # the sandbox is not cancelled halfway, so that it is handed
+                # back properly even if the task failed before using it
+                (opened,) = await asyncio.gather(warm_up, return_exceptions=True)
+                if isinstance(opened, JudgeSession):
+                    await self.close_session(opened)
+                self.exit_stack.close()
 
     async def submit(self) -> SubmitResult:
         await self.run()
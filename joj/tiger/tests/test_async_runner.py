@@ -0,0 +1,363 @@
+import asyncio
+import os
+import tempfile
+
+import aiodocker
+import pytest
+
+from joj.tiger.async_runner import AsyncRunner, RunnerDaemon
+from joj.tiger.reaper import (
+    CREATED_LABEL,
+    TASK_LABEL,
+    WORKER_LABEL,
+    collect_orphans,
+    get_reaper,
+    track_task,
+    worker_id,
+)
+from joj.tiger.runner import RUNNER_DOCKER_IMAGE, RunnerCommandError
+from joj.tiger.schemas import RunnerCommand
+from joj.tiger.toolchains import COMPILER_CACHE_DIR, Image, PrecompiledHeader
+from joj.tiger.utils.background import run_in_background
+from joj.tiger.utils.docker import get_docker
+
+
+@pytest.mark.asyncio
+async def test_run_command() -> None:
+    async with AsyncRunner() as runner:
+        result = await runner.run_command(["echo", "hello world"])
+        assert result.return_code == 0
+        assert result.stdout == b"hello world\n"
+
+
+@pytest.mark.asyncio
+async def test_return_code_reported_and_stderr_recorded() -> None:
+    async with AsyncRunner() as runner:
+        result = await runner.run_command(["ls", "definitely not a file"])
+        assert result.return_code != 0
+        assert result.stderr != b""
+        with pytest.raises(RunnerCommandError):
+            await runner.run_command(["ls", "definitely not a file"], check=True)
+
+
+@pytest.mark.asyncio
+async def test_add_files() -> None:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, "spam.txt")
+        with open(filename, "w") as f:
+            f.write("egg")
+        async with AsyncRunner() as runner:
+            await runner.add_files(filename, read_only=True)
+            result = await runner.run_command(["cat", "/root/spam.txt"])
+            assert result.stdout == b"egg"
+
+
+@pytest.mark.asyncio
+async def test_add_directory_and_get_files() -> None:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.mkdir(os.path.join(temp_dir, "egg"))
+        with open(os.path.join(temp_dir, "egg", "spam.txt"), "w") as f:
+            f.write("egg")
+        async with AsyncRunner() as runner:
+            await runner.add_directory(temp_dir, read_only=True)
+            await runner.run_command(["cp", "/root/egg/spam.txt", "/tmp/bacon.txt"])
+            files = await runner.get_files("egg", "/tmp/bacon.txt")
+    assert files == {"/root/egg/spam.txt": b"egg", "/tmp/bacon.txt": b"egg"}
+
+
+@pytest.mark.asyncio
+async def test_clean() -> None:
+    async with AsyncRunner() as runner:
+        await runner.run_command(["touch", "/root/spam.txt"])
+        await runner.clean()
+        result = await runner.run_command(["ls", "/root/spam.txt"])
+        assert result.return_code != 0
+
+
+@pytest.mark.asyncio
+async def test_daemon_pipelined_commands() -> None:
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        results = await asyncio.gather(
+            *[daemon.run_command(["echo", str(i)]) for i in range(10)]
+        )
+        for i, result in enumerate(results):
+            assert result.return_code == 0
+            assert result.stdout == "{}\n".format(i).encode()
+
+
+@pytest.mark.asyncio
+async def test_daemon_command_error() -> None:
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        with pytest.raises(RunnerCommandError):
+            await daemon.run_command(["definitely not an executable"])
+        # the daemon should survive a failed command
+        result = await daemon.run_command(["echo", "spam"])
+        assert result.stdout == b"spam\n"
+
+
+@pytest.mark.asyncio
+async def test_daemon_stdin_file() -> None:
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        await daemon.run_command(["sh", "-c", "echo spam > /tmp/stdin"])
+        result = await daemon.run_command(["cat"], stdin_file="/tmp/stdin")
+        assert result.stdout == b"spam\n"
+
+
+@pytest.mark.asyncio
+async def test_run_batch() -> None:
+    commands = [RunnerCommand(args=["echo", str(i)]) for i in range(10)] + [
+        RunnerCommand(args=["ls", "not a file"])
+    ]
+    async with AsyncRunner() as runner:
+        results = [result async for result in runner.run_batch(commands)]
+    assert len(results) == len(commands)
+    for i, result in enumerate(results[:-1]):
+        assert result.stdout == "{}\n".format(i).encode()
+    assert results[-1].return_code != 0
+
+
+@pytest.mark.asyncio
+async def test_truncate_output() -> None:
+    async with AsyncRunner() as runner:
+        result = await runner.run_command(
+            ["python3", "-c", "print('a' * 100)"],
+            truncate_stdout=9,
+            stdout_file="/tmp/stdout",
+        )
+        assert result.stdout == b"a" * 9
+        assert result.stdout_truncated
+        assert not result.stderr_truncated
+        assert not result.output_limit_exceeded
+        result = await runner.run_command(["wc", "-c", "/tmp/stdout"])
+        assert bytes(result.stdout).split()[0] == b"101"
+
+
+@pytest.mark.asyncio
+async def test_truncate_output_to_nothing() -> None:
+    command = RunnerCommand(args=["echo", "spam"], truncate_stdout=0)
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        result = await daemon.run(command)
+        assert result.stdout == b""
+        assert result.stdout_truncated
+        result = await daemon.run(command.copy(update={"truncate_stdout": None}))
+        assert result.stdout == b"spam\n"
+        assert not result.stdout_truncated
+
+
+@pytest.mark.asyncio
+async def test_output_limit_exceeded() -> None:
+    async with AsyncRunner() as runner:
+        result = await runner.run_command(["yes"], output_limit=10**6)
+        assert result.output_limit_exceeded
+        assert not result.timed_out
+
+
+@pytest.mark.asyncio
+async def test_time_limit_exceeded() -> None:
+    async with AsyncRunner() as runner:
+        result = await runner.run_command(
+            ["sh", "-c", "while :; do :; done"], timeout=1
+        )
+        assert result.timed_out
+        assert result.time >= 10**9
+
+
+@pytest.mark.asyncio
+async def test_memory_limit_exceeded() -> None:
+    command = RunnerCommand(
+        args=["python3", "-c", "b = bytearray(256 * 2**20)"],
+        memory_limit=64 * 2**20,
+    )
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        result = await daemon.run(command)
+        assert result.memory_limit_exceeded
+        assert result.return_code != 0
+        # limits are not kept for the next command
+        result = await daemon.run_command(command.args)
+        assert not result.memory_limit_exceeded
+        assert result.return_code == 0
+
+
+@pytest.mark.asyncio
+async def test_tmpfs_writes_not_charged_to_next_command() -> None:
+    async with AsyncRunner(tmpfs_size="64m") as runner, RunnerDaemon(runner) as daemon:
+        result = await daemon.run_command(
+            ["dd", "if=/dev/zero", "of=/tmp/spam", "bs=1M", "count=32"]
+        )
+        assert result.return_code == 0
+        result = await daemon.run_command(["true"])
+        assert result.memory < 16 * 2**20
+        # the file written by the first command is kept
+        result = await daemon.run_command(["stat", "-c", "%s", "/tmp/spam"])
+        assert result.stdout == f"{32 * 2**20}\n".encode()
+
+
+@pytest.mark.asyncio
+async def test_cancel_kills_command() -> None:
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                daemon.run_command(["sh", "-c", "sleep 100 & sleep 100"]), 1
+            )
+        # the daemon runs the next command right away, and nothing is left
+        result = await daemon.run_command(["pgrep", "sleep"], timeout=10)
+        assert result.return_code != 0
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(runner.run_command(["sleep", "100"]), 1)
+        result = await runner.run_command(["pgrep", "sleep"])
+        assert result.return_code != 0
+
+
+@pytest.mark.asyncio
+async def test_cancel_spares_other_commands() -> None:
+    async with AsyncRunner() as runner, RunnerDaemon(runner) as daemon:
+        commands = asyncio.gather(
+            daemon.run_command(["sh", "-c", "sleep 1 && echo spam"]),
+            runner.run_command(["sh", "-c", "sleep 1 && echo egg"]),
+        )
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(runner.run_command(["sleep", "100"]), 0.5)
+        spam, egg = await commands
+        assert spam.stdout == b"spam\n"
+        assert egg.stdout == b"egg\n"
+
+
+@pytest.mark.asyncio
+async def test_runner_image() -> None:
+    image = Image(name="test", image=RUNNER_DOCKER_IMAGE)
+    await image.build_runner_image()
+    assert image.runner_image is not None
+    async with AsyncRunner(
+        docker_image=image.container_image, runner_binary_installed=True
+    ) as runner:
+        result = await runner.run_command(["echo", "spam"])
+        assert result.stdout == b"spam\n"
+
+
+@pytest.mark.asyncio
+async def test_precompiled_header() -> None:
+    flags = ["-std=c++17", "-O2"]
+    image = Image(
+        name="test-pch",
+        image=RUNNER_DOCKER_IMAGE,
+        precompiled_headers=[PrecompiledHeader(header="bits/stdc++.h", flags=flags)],
+    )
+    await image.build_runner_image()
+    async with AsyncRunner(
+        docker_image=image.container_image, runner_binary_installed=True
+    ) as runner:
+        result = await runner.run_command(
+            [
+                "sh",
+                "-c",
+                "echo '#include <bits/stdc++.h>' "
+                f"| g++ {' '.join(flags)} -H -c -o /dev/null -x c++ -",
+            ]
+        )
+        assert result.return_code == 0
+        # gcc marks the precompiled headers it uses with a !
+        assert bytes(result.stderr).startswith(b"! ")
+
+
+@pytest.mark.asyncio
+async def test_compiler_cache_shared() -> None:
+    image = Image(
+        name="test-ccache", image=RUNNER_DOCKER_IMAGE, compiler_cache_size="64m"
+    )
+    command = ["sh", "-c", f"echo spam > {COMPILER_CACHE_DIR}/egg"]
+    async with AsyncRunner(
+        environment_variables=image.compiler_cache_environment(read_only=False),
+        volumes=image.compiler_cache_volumes(),
+    ) as runner:
+        result = await runner.run_command(command)
+        assert result.return_code == 0
+    async with AsyncRunner(read_only_volumes=image.compiler_cache_volumes()) as runner:
+        result = await runner.run_command(["cat", f"{COMPILER_CACHE_DIR}/egg"])
+        assert result.stdout == b"spam\n"
+        # even as root
+        result = await runner.run_command(command)
+        assert result.return_code != 0
+    async with AsyncRunner() as runner:
+        result = await runner.run_command(["ls", COMPILER_CACHE_DIR])
+        assert result.return_code != 0
+    await get_docker().volumes.get(image.compiler_cache_volume).delete()
+
+
+@pytest.mark.asyncio
+async def test_compiler_cache_warmup_hit() -> None:
+    flags = ["-std=c++17", "-O2"]
+    source = "printf '#include <bits/stdc++.h>\\nint main() {}\\n' > a.cpp"
+    compile = f"g++ {' '.join(flags)} -fpch-preprocess -c a.cpp"
+    image = Image(
+        name="test-ccache-warmup",
+        image=RUNNER_DOCKER_IMAGE,
+        precompiled_headers=[PrecompiledHeader(header="bits/stdc++.h", flags=flags)],
+        compiler_cache_size="64m",
+        compiler_cache_warmup=[f"{source} && {compile}"],
+    )
+    await image.build_runner_image()
+    await image.warm_compiler_cache()
+    async with AsyncRunner(
+        docker_image=image.container_image,
+        runner_binary_installed=True,
+        # the compiler only runs on a miss, and then fails
+        environment_variables={
+            **image.compiler_cache_environment(),
+            "CCACHE_PREFIX": "false",
+        },
+        read_only_volumes=image.compiler_cache_volumes(),
+    ) as runner:
+        result = await runner.run_command(["sh", "-c", f"{source} && {compile}"])
+        assert result.return_code == 0
+        result = await runner.run_command(
+            ["sh", "-c", f"echo 'int x;' > b.cpp && {compile.replace('a.', 'b.')}"]
+        )
+        assert result.return_code != 0
+    await get_docker().volumes.get(image.compiler_cache_volume).delete()
+
+
+@pytest.mark.asyncio
+async def test_container_reaped() -> None:
+    async with AsyncRunner() as runner:
+        pass
+    await asyncio.wrap_future(run_in_background(get_reaper().join()))
+    with pytest.raises(aiodocker.DockerError):
+        await get_docker().containers.get(runner.name)
+
+
+@pytest.mark.asyncio
+async def test_orphan_collected() -> None:
+    with track_task("running"):
+        async with AsyncRunner(task_id="running") as running:
+            async with AsyncRunner(task_id="finished") as finished:
+                info = await get_docker().containers.get(finished.name)
+                labels = info["Config"]["Labels"]
+                assert labels[WORKER_LABEL] == worker_id()
+                assert labels[TASK_LABEL] == "finished"
+                assert int(labels[CREATED_LABEL]) > 0
+                orphans = await asyncio.wrap_future(
+                    run_in_background(collect_orphans())
+                )
+                assert finished.name in orphans
+                assert running.name not in orphans
+
+
+@pytest.mark.asyncio
+async def test_tmpfs_working_dir() -> None:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, "spam.txt")
+        with open(filename, "w") as f:
+            f.write("egg")
+        async with AsyncRunner(tmpfs_size="64m") as runner:
+            await runner.add_files(filename)
+            result = await runner.run_command(
+                ["sh", "-c", "df --output=fstype /root /tmp && cat /root/spam.txt"]
+            )
+            assert result.return_code == 0
+            assert bytes(result.stdout).split().count(b"tmpfs") == 2
+            assert bytes(result.stdout).endswith(b"egg")
+
+
+def test_tmpfs_exceeds_memory_limit() -> None:
+    with pytest.raises(ValueError):
+        AsyncRunner(tmpfs_size="1g", memory_limit="1g")
@@ -0,0 +1,79 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List
+
+from joj.tiger.utils.cache import DirectoryCache
+
+
+def populate_with(size: int, calls: List[str]) -> Callable[[str], None]:
+    def populate(directory: str) -> None:
+        calls.append(directory)
+        with open(os.path.join(directory, "data"), "wb") as f:
+            f.write(b"x" * size)
+
+    return populate
+
+
+def test_populated_once(tmp_path: Path) -> None:
+    cache = DirectoryCache(str(tmp_path), 2**20)
+    calls: List[str] = []
+    for _ in range(3):
+        with cache.open(cache.key("repo", "commit"), populate_with(10, calls)) as path:
+            assert os.path.getsize(os.path.join(path, "data")) == 10
+    assert len(calls) == 1
+
+
+def test_in_use_entry_not_evicted(tmp_path: Path) -> None:
+    cache = DirectoryCache(str(tmp_path), 25)
+    calls: List[str] = []
+    with cache.open(cache.key("a"), populate_with(10, calls)) as a:
+        with cache.open(cache.key("b"), populate_with(10, calls)):
+            pass
+        with cache.open(cache.key("c"), populate_with(10, calls)):
+            pass
+        assert os.path.isdir(a)
+    # b was the least recently used entry not in use
+    with cache.open(cache.key("b"), populate_with(10, calls)):
+        pass
+    assert len(calls) == 4
+
+
+def test_concurrent_fills_single_flight(tmp_path: Path) -> None:
+    cache = DirectoryCache(str(tmp_path), 2**20)
+    calls: List[str] = []
+
+    def populate(directory: str) -> None:
+        time.sleep(0.1)
+        populate_with(10, calls)(directory)
+
+    def read() -> int:
+        with cache.open(cache.key("repo", "commit"), populate) as path:
+            return os.path.getsize(os.path.join(path, "data"))
+
+    with ThreadPoolExecutor(8) as executor:
+        sizes = list(executor.map(lambda _: read(), range(8)))
+    assert sizes == [10] * 8
+    assert len(calls) == 1
+
+
+def test_get_and_put(tmp_path: Path) -> None:
+    cache = DirectoryCache(str(tmp_path), 2**20)
+    calls: List[str] = []
+    key = cache.key("sources", "args", "image")
+    with cache.get(key) as path:
+        assert path is None
+    cache.put(key, populate_with(10, calls))
+    with cache.get(key) as path:
+        assert path is not None
+        assert os.path.getsize(os.path.join(path, "data")) == 10
+    assert len(calls) == 1
+
+
+def test_refs(tmp_path: Path) -> None:
+    cache = DirectoryCache(str(tmp_path), 2**20)
+    assert cache.get_ref("spam") is None
+    cache.set_ref("spam", "egg")
+    cache.set_ref("spam", "bacon")
+    assert cache.get_ref("spam") == "bacon"
@@ -0,0 +1,87 @@
+import io
+from typing import Iterator
+
+import pytest
+
+from joj.tiger.checker import CHECKER_FLOAT_MAX_LENGTH, check, check_output, iter_output
+from joj.tiger.schemas import CheckMode, CheckResult
+
+
+def chunks(data: bytes, size: int = 3) -> Iterator[bytes]:
+    return iter_output(data, size)
+
+
+def check_bytes(output: bytes, answer: bytes, mode: CheckMode) -> CheckResult:
+    return check(chunks(output), chunks(answer), mode)
+
+
+@pytest.mark.parametrize("mode", list(CheckMode))
+def test_identical_accepted(mode: CheckMode) -> None:
+    data = b"1 2.5\nspam egg\n\n3\n"
+    assert check_bytes(data, data, mode).accepted
+
+
+def test_exact_offset() -> None:
+    result = check_bytes(b"hello world\n", b"hello there\n", CheckMode.exact)
+    assert result == CheckResult(accepted=False, offset=6)
+    result = check_bytes(b"hello", b"hello\n", CheckMode.exact)
+    assert result == CheckResult(accepted=False, offset=5)
+
+
+def test_trailing_whitespace() -> None:
+    output = b"a b  \t\nc\r\n\n\n"
+    assert check_bytes(output, b"a b\nc", CheckMode.trailing_whitespace).accepted
+    # empty lines in the middle still count
+    result = check_bytes(b"a\n\nb\n", b"a\nb\n", CheckMode.trailing_whitespace)
+    assert result == CheckResult(accepted=False, offset=2)
+    # leading whitespace still counts
+    result = check_bytes(b"a\n b\n", b"a\nb\n", CheckMode.trailing_whitespace)
+    assert result == CheckResult(accepted=False, offset=2)
+
+
+def test_token() -> None:
+    output = b"  1\n2   3\n\n"
+    assert check_bytes(output, b"1 2 3", CheckMode.token).accepted
+    result = check_bytes(b"1 2 34", b"1 2 35", CheckMode.token)
+    assert result == CheckResult(accepted=False, offset=5)
+    result = check_bytes(b"1 2", b"1 2 3", CheckMode.token)
+    assert result == CheckResult(accepted=False, offset=3)
+    result = check_bytes(b"1 2 3", b"1 2", CheckMode.token)
+    assert result == CheckResult(accepted=False, offset=4)
+
+
+def test_float_tolerance() -> None:
+    assert check_bytes(b"0.3333333", b"0.33333333", CheckMode.float).accepted
+    assert check_bytes(b"1000000.5", b"1000000", CheckMode.float).accepted
+    result = check_bytes(b"x 0.334", b"x 0.333", CheckMode.float)
+    assert result == CheckResult(accepted=False, offset=2)
+    assert not check_bytes(b"nan", b"1", CheckMode.float).accepted
+
+
+def test_items_across_chunks() -> None:
+    token = b"spam" * 10000
+    result = check_bytes(token + b"x", token + b"y", CheckMode.token)
+    assert result == CheckResult(accepted=False, offset=len(token))
+    result = check_bytes(
+        b"a  \n" * 1000 + b"b", b"a\n" * 1000 + b"c", CheckMode.trailing_whitespace
+    )
+    assert result == CheckResult(accepted=False, offset=4000)
+    output = b"x " + b" " * 10000 + b"\n1.0000001"
+    assert check_bytes(output, b"x 1", CheckMode.float).accepted
+
+
+def test_float_max_length() -> None:
+    digits = b"1" * CHECKER_FLOAT_MAX_LENGTH
+    # too long to be parsed, so compared byte by byte
+    result = check_bytes(b"x " + digits + b"1", b"x " + digits + b"2", CheckMode.float)
+    assert result == CheckResult(accepted=False, offset=2)
+    assert check_bytes(digits[2:] + b".0", digits[2:], CheckMode.float).accepted
+
+
+@pytest.mark.asyncio
+async def test_check_output_in_executor() -> None:
+    output = memoryview(b"spam " * 100000)
+    result = await check_output(
+        output, lambda: io.BytesIO(b"spam " * 99999 + b"egg "), CheckMode.token
+    )
+    assert result == CheckResult(accepted=False, offset=5 * 99999)
@@ -0,0 +1,33 @@
+import os
+from pathlib import Path
+
+from fs.memoryfs import MemoryFS
+
+from joj.tiger.utils.lakefs import apply_diff
+
+
+def test_apply_diff(tmp_path: Path) -> None:
+    base, directory = tmp_path / "base", tmp_path / "new"
+    (base / "cases").mkdir(parents=True)
+    directory.mkdir()
+    for name in ("config.json", "cases/1.in", "cases/2.in"):
+        (base / name).write_text("old")
+    source = MemoryFS()
+    source.makedir("cases")
+    source.writetext("cases/1.in", "new")
+    source.writetext("cases/3.in", "new")
+    downloaded = apply_diff(
+        source,
+        str(base),
+        str(directory),
+        [("changed", "cases/1.in"), ("added", "cases/3.in"), ("removed", "cases/2.in")],
+    )
+    assert downloaded == 2
+    assert sorted(
+        os.path.relpath(os.path.join(root, name), directory)
+        for root, _, files in os.walk(directory)
+        for name in files
+    ) == ["cases/1.in", "cases/3.in", "config.json"]
+    assert (directory / "cases/1.in").read_text() == "new"
+    # unchanged files are linked, not downloaded
+    assert os.path.samefile(directory / "config.json", base / "config.json")
@@ -0,0 +1,76 @@
+import tempfile
+
+from joj.tiger.result_cache import LocalResultCache, is_reusable
+from joj.tiger.schemas import (
+    CheckResult,
+    CompletedCommand,
+    ExecuteResult,
+    RecordCaseResult,
+    RecordState,
+    SubmitResult,
+)
+
+
+def completed_command(stdout: bytes) -> CompletedCommand:
+    return CompletedCommand(
+        return_code=0,
+        stdout=stdout,
+        stderr=b"",
+        timed_out=False,
+        stdout_truncated=False,
+        stderr_truncated=False,
+        time=10**6,
+        memory=2**20,
+    )
+
+
+def test_local_result_cache() -> None:
+    result = SubmitResult(
+        submit_status=RecordState.accepted,
+        compile_result=completed_command(b"compiled"),
+        execute_results=[
+            ExecuteResult(
+                status=RecordCaseResult.wrong_answer,
+                # not valid utf-8
+                completed_command=completed_command(b"\xff\xfe"),
+                check_result=CheckResult(accepted=False, offset=0),
+            )
+        ],
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = LocalResultCache(temp_dir, 2**20)
+        assert cache.get("spam") is None
+        cache.put("spam", result)
+        assert cache.get("spam") == result
+        assert cache.get("egg") is None
+
+
+def test_is_reusable() -> None:
+    def result(status: RecordCaseResult, timed_out: bool = False) -> SubmitResult:
+        command = completed_command(b"")
+        command.timed_out = timed_out
+        return SubmitResult(
+            submit_status=RecordState.accepted,
+            compile_result=completed_command(b""),
+            execute_results=[
+                ExecuteResult(
+                    status=RecordCaseResult.accepted,
+                    completed_command=completed_command(b""),
+                ),
+                ExecuteResult(status=status, completed_command=command),
+            ],
+        )
+
+    assert is_reusable(result(RecordCaseResult.wrong_answer))
+    assert not is_reusable(result(RecordCaseResult.time_limit_exceeded))
+    assert not is_reusable(result(RecordCaseResult.system_error))
+    assert not is_reusable(result(RecordCaseResult.runtime_error, timed_out=True))
+    compile_timed_out = completed_command(b"")
+    compile_timed_out.timed_out = True
+    assert not is_reusable(
+        SubmitResult(
+            submit_status=RecordState.accepted,
+            compile_result=compile_timed_out,
+            execute_results=[],
+        )
+    )
@@ -1,5 +1,6 @@
 # modified from https://github.com/eecs-autograder/autograder-sandbox/blob/develop/autograder_sandbox/tests.py
 # Copyright eecs-autograder under GNU Lesser General Public License v3.0
+import asyncio
 import itertools
 import multiprocessing
 import os
@@ -12,7 +13,9 @@ from collections import OrderedDict
 from typing import IO, Callable, Optional, TypeVar
 from unittest import mock
 
-from joj.tiger.runner import Runner
+from joj.tiger.runner import RUNNER_DOCKER_IMAGE, Runner
+from joj.tiger.toolchains import Image
+from joj.tiger.utils.docker import close_docker
 
 # from joj.tiger.runner import (
 #     Runner,
@@ -184,6 +187,22 @@ class RunnerMiscTestCase(unittest.TestCase):
         file_obj.write(content)
         file_obj.seek(0)
 
+    def test_runner_binary_installed(self) -> None:
+        image = Image(name="test", image=RUNNER_DOCKER_IMAGE)
+
+        async def build() -> None:
+            await image.build_runner_image()
+            await close_docker()
+
+        asyncio.run(build())
+        with Runner(
+            docker_image=image.container_image, runner_binary_installed=True
+        ) as runner:
+            with self.assertRaises(ValueError):
+                runner.allow_network_access = True
+            result = runner.run_command(["echo", "spam"])
+            self.assertEqual(b"spam\n", result.stdout)
+
     # def test_very_large_io_no_truncate(self) -> None:
     #     output_size_performance_test(10 ** 9)
 
@@ -257,6 +276,16 @@ class RunnerMiscTestCase(unittest.TestCase):
         with Runner(name=self.name):
             pass
 
+    def test_clean(self) -> None:
+        with Runner() as runner:
+            runner.run_command(["touch", "/root/spam.txt"])
+            runner.clean()
+            result = runner.run_command(["ls", "/root/spam.txt"])
+            self.assertNotEqual(0, result.return_code)
+            # the runner should still work after cleaning
+            result = runner.run_command(["echo", "egg"])
+            self.assertEqual(0, result.return_code)
+
     # def test_runner_environment_variables_set(self) -> None:
     #     print_env_var_script = "echo ${}".format(" $".join(self.environment_variables))
 
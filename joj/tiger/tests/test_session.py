@@ -0,0 +1,124 @@
+import pytest
+from fs.memoryfs import MemoryFS
+
+from joj.tiger.pool import RunnerPool
+from joj.tiger.runner import RUNNER_DOCKER_IMAGE
+from joj.tiger.schemas import RunnerCommand
+from joj.tiger.session import SESSION_SNAPSHOT_PATH, JudgeSession
+from joj.tiger.toolchains import Image
+
+
+def new_pool() -> RunnerPool:
+    return RunnerPool(Image(name="test", image=RUNNER_DOCKER_IMAGE))
+
+
+@pytest.mark.asyncio
+async def test_compile_and_execute_share_runner() -> None:
+    async with JudgeSession(new_pool()) as session:
+        result = await session.compile(
+            RunnerCommand(args=["sh", "-c", "echo spam > /root/a.out"])
+        )
+        assert result.return_code == 0
+        results = [
+            result
+            async for result in session.execute(
+                [RunnerCommand(args=["cat", "/root/a.out"])] * 3
+            )
+        ]
+    assert len(results) == 3
+    for result in results:
+        assert result.stdout == b"spam\n"
+
+
+@pytest.mark.asyncio
+async def test_snapshot_restored_between_cases() -> None:
+    commands = [
+        RunnerCommand(args=["sh", "-c", "rm /root/a.out && touch /root/b /tmp/c"]),
+        RunnerCommand(args=["ls", "/root/a.out", "/root/b", "/tmp/c"]),
+    ]
+    async with JudgeSession(new_pool(), snapshot=True) as session:
+        await session.compile(RunnerCommand(args=["touch", "/root/a.out"]))
+        results = [result async for result in session.execute(commands)]
+    assert results[0].return_code == 0
+    assert results[1].stdout == b"/root/a.out\n"
+    assert results[1].return_code != 0
+
+
+@pytest.mark.asyncio
+async def test_parallel_execute_in_order() -> None:
+    commands = [
+        RunnerCommand(args=["sh", "-c", f"sleep 0.{9 - i}; echo {i}"])
+        for i in range(10)
+    ] + [RunnerCommand(args=["grep", "Cpus_allowed_list", "/proc/self/status"])]
+    async with JudgeSession(new_pool()) as session:
+        await session.compile(RunnerCommand(args=["true"]))
+        results = [result async for result in session.execute(commands, max_parallel=4)]
+    assert len(results) == len(commands)
+    for i, result in enumerate(results[:-1]):
+        assert result.stdout == f"{i}\n".encode()
+    # pinned to a single cpu
+    assert bytes(results[-1].stdout).split()[-1].isdigit()
+
+
+@pytest.mark.asyncio
+async def test_staged_inputs_as_stdin() -> None:
+    fs = MemoryFS()
+    fs.makedir("cases")
+    for i in range(2):
+        fs.writebytes(f"cases/{i}.in", f"spam {i}\n".encode())
+    commands = [
+        RunnerCommand(
+            args=["cat"],
+            stdin_file=JudgeSession.input_path(f"cases/{i}.in"),
+        )
+        for i in range(2)
+    ]
+    async with JudgeSession(new_pool()) as session:
+        session.stage_inputs(fs, ["cases/0.in", "cases/1.in"])
+        results = [result async for result in session.execute(commands)]
+    assert [result.stdout for result in results] == [b"spam 0\n", b"spam 1\n"]
+
+
+@pytest.mark.asyncio
+async def test_recycle_keeps_runner() -> None:
+    async with JudgeSession(new_pool(), snapshot=True) as session:
+        runner = session.runner
+        await session.compile(
+            RunnerCommand(args=["sh", "-c", "touch /root/a.out && sleep 100 &"])
+        )
+        await session.recycle()
+        assert session.runner is runner
+        result = await session.daemon.run_command(
+            ["sh", "-c", "ls /root /tmp && pgrep sleep"]
+        )
+    assert result.stdout == b"/root:\n\n/tmp:\n"
+    assert result.return_code != 0
+
+
+@pytest.mark.asyncio
+async def test_case_cannot_alter_next_case() -> None:
+    fs = MemoryFS()
+    fs.makedir("cases")
+    for i in range(2):
+        fs.writebytes(f"cases/{i}.in", f"spam {i}\n".encode())
+    commands = [
+        RunnerCommand(
+            args=[
+                "sh",
+                "-c",
+                f"echo egg > {JudgeSession.input_path('cases/1.in')} "
+                f"&& touch /root/b && tar -cf {SESSION_SNAPSHOT_PATH} -C /root .",
+            ],
+            stdin_file=JudgeSession.input_path("cases/0.in"),
+        ),
+        RunnerCommand(
+            args=["sh", "-c", "cat && ls /root"],
+            stdin_file=JudgeSession.input_path("cases/1.in"),
+        ),
+    ]
+    async with JudgeSession(new_pool(), snapshot=True) as session:
+        session.stage_inputs(fs, ["cases/0.in", "cases/1.in"])
+        await session.compile(RunnerCommand(args=["touch", "/root/a.out"]))
+        results = [result async for result in session.execute(commands)]
+    assert results[0].return_code == 0
+    assert results[1].stdout == b"spam 1\na.out\n"
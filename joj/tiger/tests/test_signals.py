@@ -0,0 +1,50 @@
+import asyncio
+import os
+import signal
+import threading
+from types import FrameType
+from typing import List, Optional
+
+import pytest
+
+from joj.tiger.utils.signals import cancel_on_signal
+
+
+@pytest.mark.asyncio
+async def test_cancel_on_signal_restores_handler() -> None:
+    received: List[int] = []
+
+    def handler(signum: int, frame: Optional[FrameType]) -> None:
+        received.append(signum)
+
+    previous = signal.signal(signal.SIGUSR1, handler)
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            with cancel_on_signal(signal.SIGUSR1):
+                os.kill(os.getpid(), signal.SIGUSR1)
+                await asyncio.sleep(10)
+        assert received == []
+        assert signal.getsignal(signal.SIGUSR1) is handler
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert received == [signal.SIGUSR1]
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_cancel_on_signal_off_main_thread() -> None:
+    async def run() -> None:
+        with cancel_on_signal():
+            await asyncio.sleep(0)
+
+    errors: List[BaseException] = []
+
+    def target() -> None:
+        try:
+            asyncio.run(run())
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    assert errors == []
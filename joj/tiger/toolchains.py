@@ -1,22 +1,234 @@
 import asyncio
+import hashlib
+import io
+import os
+import shlex
+import tarfile
 from functools import lru_cache
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 import aiodocker
 from benedict import benedict
 from loguru import logger
 from pydantic import BaseModel, root_validator
 
+from joj.tiger.async_runner import AsyncRunner
+from joj.tiger.runner import RUNNER_PATH, add_runner_binary, get_runner_binary_path
+
+# where the compiler cache volume is mounted in the runners
+COMPILER_CACHE_DIR = "/var/cache/joj-ccache"
+# the ccache masquerade directory of debian comes first, so that gcc, g++,
+# cc, c++ and clang go through ccache when it is installed in the image
+COMPILER_CACHE_PATH = (
+    "/usr/lib/ccache:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+)
+
+
+@lru_cache()
+def _runner_binary_hash() -> str:
+    with open(get_runner_binary_path(), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class PrecompiledHeader(BaseModel):
+    # as included by the sources, e.g. bits/stdc++.h
+    header: str
+    # gcc looks up precompiled headers by itself, clang does not
+    compiler: str = "g++"
+    language: str = "c++"
+    # gcc only uses a precompiled header compiled with the same flags as the
+    # source, e.g. [-std=c++17, -O2], so list one entry per set of flags
+    flags: List[str] = []
+
+    def digest(self) -> str:
+        parts = [self.header, self.compiler, self.language, *self.flags]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def build_command(self) -> str:
+        """
+        A shell command finding where the header is in the image and
+        precompiling it into the <header>.gch directory next to it, where
+        gcc picks the first precompiled header valid for its flags.
+        """
+        flags = " ".join(shlex.quote(flag) for flag in self.flags)
+        compiler = shlex.quote(self.compiler)
+        include = shlex.quote(f"#include <{self.header}>")
+        return (
+            f'path="$(echo {include} | {compiler} {flags} -x {self.language} '
+            "-E -H -o /dev/null - 2>&1 | sed -n '1s/^\\. //p')\" && "
+            'mkdir -p "$path.gch" && '
+            f'{compiler} {flags} -x {self.language}-header "$path" '
+            f'-o "$path.gch/{self.digest()[:16]}.gch"'
+        )
+
 
 class Image(BaseModel):
     name: str
     image: str
+    # number of idle runners kept warm for this image, 0 disables the pool
+    pool_size: int = 0
+    # a pooled runner is destroyed after being leased this many times (and
+    # the session of a TigerBatch after judging this many records). Only
+    # the working directory and /tmp are cleaned between two leases, and the
+    # commands run as root, so anything written elsewhere would be seen by
+    # the next submissions: keep 1 unless the image is only used by trusted
+    # commands.
+    max_reuse: int = 1
+    # restore the working directory as it was after compilation before each
+    # case, instead of letting cases see the files left by previous ones
+    snapshot: bool = False
+    # keep the working directory and /tmp of the runners on tmpfs of this
+    # size (e.g. "256m"), counted against their memory limit
+    tmpfs_size: Optional[str] = None
+    # the languages (names of the record) judged in this image, the others
+    # use RUNNER_DOCKER_IMAGE, see find_language_image
+    languages: List[str] = []
+    # headers precompiled into the runner image, see build_runner_image
+    precompiled_headers: List[PrecompiledHeader] = []
+    # compile with a ccache volume shared by the runners and capped at this
+    # size (e.g. "2g"), filled by compiler_cache_warmup, see
+    # compiler_cache_volumes
+    compiler_cache_size: Optional[str] = None
+    # trusted shell commands filling the compiler cache, e.g. compiling the
+    # sources shared by the submissions, see warm_compiler_cache. ccache only
+    # caches a source using a precompiled header through a plain #include
+    # if it is compiled with -fpch-preprocess, and so do the compile commands
+    # of the submissions need it to hit these entries.
+    compiler_cache_warmup: List[str] = []
+    # the image derived from image with the runner binary installed, set by
+    # build_runner_image
+    runner_image: Optional[str] = None
+
+    @property
+    def container_image(self) -> str:
+        """
+        The image runners should be created from.
+        """
+        return self.runner_image or self.image
+
+    @property
+    def compiler_cache_volume(self) -> str:
+        return f"joj-tiger-ccache-{self.name}"
+
+    def compiler_cache_volumes(self) -> Dict[str, str]:
+        """
+        The volumes of the runners, if compiler_cache_size is set, to be
+        mounted read-only.
+
+        The ccache volume of the image is shared by the runners of all the
+        workers of the docker host. Submissions are compiled as root and
+        may run code of their own (e.g. a Makefile), so they only read the
+        cache, which would otherwise serve what they wrote in it to the
+        other submissions: it is filled by the trusted commands of
+        warm_compiler_cache only, never by the submissions it serves, and
+        kept under compiler_cache_size by ccache.
+        """
+        if self.compiler_cache_size is None:
+            return {}
+        return {self.compiler_cache_volume: COMPILER_CACHE_DIR}
+
+    def compiler_cache_environment(self, read_only: bool = True) -> Dict[str, str]:
+        if self.compiler_cache_size is None:
+            return {}
+        environment = {
+            "PATH": COMPILER_CACHE_PATH,
+            "CCACHE_DIR": COMPILER_CACHE_DIR,
+            "CCACHE_MAXSIZE": self.compiler_cache_size,
+            # the cached files are not writable by the other users
+            "CCACHE_UMASK": "022",
+            # copied out of the cache, never linked to it
+            "CCACHE_NOHARDLINK": "1",
+            # needed to cache the sources using precompiled headers, the
+            # sources are copied into the runner right before compiling
+            "CCACHE_SLOPPINESS": (
+                "pch_defines,time_macros,include_file_mtime,include_file_ctime"
+            ),
+        }
+        if read_only:
+            # hits are used, misses are not stored, and the temporary files
+            # go to a writable directory
+            environment["CCACHE_READONLY"] = "1"
+            environment["CCACHE_TEMPDIR"] = "/tmp"
+        return environment
 
     async def pull(self) -> None:
         logger.info("docker pull {}", self.image)
         docker = aiodocker.Docker()
         await docker.images.pull(self.image)
 
+    async def build_runner_image(self) -> None:
+        """
+        Derives an image with the runner binary installed at RUNNER_PATH
+        from image, so that runners start with a single create call instead
+        of copying the binary into every container. The precompiled_headers
+        are built into the derived image as well, once per host instead of
+        at every compilation. The derived image is tagged after the id of
+        image, the hash of the binary and the precompiled headers, and only
+        built if no image has this tag yet.
+        """
+        docker = aiodocker.Docker()
+        try:
+            image_id = (await docker.images.inspect(self.image))["Id"]
+            tag = "joj-tiger-runner/{}:{}-{}".format(
+                self.name, image_id.split(":")[-1][:16], self._runner_image_hash()
+            )
+            try:
+                await docker.images.inspect(tag)
+            except aiodocker.DockerError:
+                logger.info("docker build {}", tag)
+                messages = await docker.images.build(
+                    fileobj=self._runner_image_context(), tag=tag
+                )
+                for message in messages:
+                    if "error" in message:
+                        raise aiodocker.DockerError(500, message)
+            self.runner_image = tag
+        finally:
+            await docker.close()
+
+    async def warm_compiler_cache(self) -> None:
+        """
+        Runs the compiler_cache_warmup commands in the working directory of
+        a runner of container_image, the only runner mounting the compiler
+        cache read-write. Once a worker of the docker host did so, they only
+        hit the cache.
+        """
+        if self.compiler_cache_size is None or not self.compiler_cache_warmup:
+            return
+        async with AsyncRunner(
+            docker_image=self.container_image,
+            runner_binary_installed=self.runner_image is not None,
+            environment_variables=self.compiler_cache_environment(read_only=False),
+            volumes=self.compiler_cache_volumes(),
+        ) as runner:
+            for command in self.compiler_cache_warmup:
+                logger.info("compiler cache warm-up [{}]: {}", self.name, command)
+                await runner.run_command(["sh", "-c", command], check=True)
+
+    def _runner_image_hash(self) -> str:
+        if not self.precompiled_headers:
+            return _runner_binary_hash()[:16]
+        digest = hashlib.sha256(_runner_binary_hash().encode())
+        for header in self.precompiled_headers:
+            digest.update(header.digest().encode())
+        return digest.hexdigest()[:16]
+
+    def _runner_image_context(self) -> io.BytesIO:
+        dockerfile = "FROM {}\nCOPY {} {}\n".format(
+            self.image, os.path.basename(RUNNER_PATH), RUNNER_PATH
+        )
+        for header in self.precompiled_headers:
+            dockerfile += "RUN {}\n".format(header.build_command())
+        data = dockerfile.encode()
+        buffer = io.BytesIO()
+        with tarfile.TarFile(fileobj=buffer, mode="w") as tar_file:
+            tar_info = tarfile.TarInfo("Dockerfile")
+            tar_info.size = len(data)
+            tar_file.addfile(tar_info, io.BytesIO(data))
+            add_runner_binary(tar_file)
+        buffer.seek(0)
+        return buffer
+
 
 class Queue(BaseModel):
     name: str
@@ -65,6 +277,37 @@ class ToolchainsConfig(BaseModel):
             )
         except aiodocker.exceptions.DockerError as e:
             logger.error(f"docker pull failed: {e}")
+        # runners of the images whose build fails copy the binary instead
+        results = await asyncio.gather(
+            *[self.images[image].build_runner_image() for image in unique_images],
+            return_exceptions=True,
+        )
+        for image, result in zip(unique_images, results):
+            if isinstance(result, Exception):
+                logger.error(f"docker build of runner image {image} failed: {result}")
+        results = await asyncio.gather(
+            *[self.images[image].warm_compiler_cache() for image in unique_images],
+            return_exceptions=True,
+        )
+        for image, result in zip(unique_images, results):
+            if isinstance(result, Exception):
+                logger.error(f"compiler cache warm-up of {image} failed: {result}")
+
+    def find_image(self, docker_image: str) -> Optional[Image]:
+        for image in self.images.values():
+            if image.image == docker_image:
+                return image
+        return None
+
+    def find_language_image(self, language: str) -> Optional[Image]:
+        """
+        The image of the queues of this worker that judges language, if any.
+        """
+        for queue in self.queues.values():
+            for name in queue.images:
+                if language in self.images[name].languages:
+                    return self.images[name]
+        return None
 
     def generate_queues(self) -> List[str]:
         result = []
@@ -0,0 +1,146 @@
+import os
+import tarfile
+from typing import IO, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+from fs.base import FS
+from fs.osfs import OSFS
+
+ARCHIVE_CHUNK_SIZE = 2**16
+
+# (path in the source filesystem, name in the archive)
+ArchiveMember = Tuple[str, str]
+
+
+def host_fs() -> FS:
+    return OSFS("/")
+
+
+def host_path(filename: str) -> str:
+    return os.path.abspath(filename)
+
+
+def file_members(fs: FS, paths: Sequence[str]) -> Iterator[ArchiveMember]:
+    """
+    Names every file (or directory, recursively) after its basename.
+    """
+    for path in paths:
+        name = os.path.basename(path.rstrip("/"))
+        if fs.isdir(path):
+            yield from directory_members(fs, path, prefix=name)
+        else:
+            yield path, name
+
+
+def directory_members(
+    fs: FS, directory: str, prefix: Optional[str] = None
+) -> Iterator[ArchiveMember]:
+    """
+    Names every entry of directory relative to it (and under prefix if
+    given). The directory itself is only included when a prefix is given.
+    """
+    if prefix is not None:
+        yield directory, prefix
+    # directories first, so that they are extracted with their own mode
+    for path in list(fs.walk.dirs(directory)) + list(fs.walk.files(directory)):
+        name = os.path.relpath(path, directory)
+        yield path, name if prefix is None else os.path.join(prefix, name)
+
+
+def iter_tar(
+    fs: FS,
+    members: Iterable[ArchiveMember],
+    uid: int = 0,
+    uname: str = "root",
+    read_only: bool = False,
+    chunk_size: int = ARCHIVE_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Streams a tar archive of the members read from fs, one chunk at a time,
+    without building it in memory or in a temporary file. Owner and mode are
+    set in the tar headers, so that the files need no chown or chmod once
+    extracted.
+    """
+    for path, name in members:
+        tar_info = tarfile.TarInfo(name)
+        tar_info.uid = tar_info.gid = uid
+        tar_info.uname = tar_info.gname = uname
+        if fs.isdir(path):
+            tar_info.type = tarfile.DIRTYPE
+            tar_info.mode = 0o755
+        else:
+            tar_info.size = fs.getsize(path)
+            tar_info.mode = 0o644
+        if read_only:
+            tar_info.mode &= 0o555
+        if tar_info.isdir():
+            yield tar_info.tobuf(format=tarfile.GNU_FORMAT)
+            continue
+        with fs.openbin(path) as f:
+            yield from _iter_member(tar_info, f, chunk_size)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def iter_fileobj_tar(
+    fileobj: IO[bytes],
+    name: str,
+    uid: int = 0,
+    uname: str = "root",
+    chunk_size: int = ARCHIVE_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Streams a tar archive of a single file named name, with the contents of
+    fileobj from its current position to its end.
+    """
+    start = fileobj.tell()
+    tar_info = tarfile.TarInfo(name)
+    tar_info.uid = tar_info.gid = uid
+    tar_info.uname = tar_info.gname = uname
+    tar_info.mode = 0o644
+    tar_info.size = fileobj.seek(0, os.SEEK_END) - start
+    fileobj.seek(start)
+    yield from _iter_member(tar_info, fileobj, chunk_size)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def _iter_member(
+    tar_info: tarfile.TarInfo, f: IO[bytes], chunk_size: int
+) -> Iterator[bytes]:
+    yield tar_info.tobuf(format=tarfile.GNU_FORMAT)
+    remaining = tar_info.size
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            raise OSError(f"{tar_info.name} was truncated while archiving it")
+        remaining -= len(chunk)
+        yield chunk
+    padding = -tar_info.size % tarfile.BLOCKSIZE
+    if padding:
+        yield tarfile.NUL * padding
+
+
+def iter_file(f: IO[bytes], chunk_size: int = ARCHIVE_CHUNK_SIZE) -> Iterator[bytes]:
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_tar(fileobj: IO[bytes], directory: str) -> Dict[str, bytes]:
+    """
+    Reads the regular files of a tar stream (e.g. as returned by docker for
+    a path under directory) into memory, keyed by their path in directory.
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar_file:
+        return tar_file_contents(tar_file, directory)
+
+
+def tar_file_contents(tar_file: tarfile.TarFile, directory: str) -> Dict[str, bytes]:
+    files = {}
+    for tar_info in tar_file:
+        if not tar_info.isfile():
+            continue
+        f = tar_file.extractfile(tar_info)
+        assert f is not None
+        files[os.path.join(directory, tar_info.name)] = f.read()
+    return files
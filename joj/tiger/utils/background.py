@@ -0,0 +1,33 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Any, Coroutine, TypeVar
+
+T = TypeVar("T")
+
+
+@lru_cache()
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    An event loop living in a daemon thread of the worker process.
+
+    Every celery task runs in its own short-lived event loop, so anything
+    that must outlive a single task (e.g. refilling runner pools) is
+    scheduled here instead.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(
+        target=loop.run_forever, name="tiger-background", daemon=True
+    )
+    thread.start()
+    return loop
+
+
+def run_in_background(coro: Coroutine[Any, Any, T]) -> "Future[T]":
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+
+
+# threads do not survive fork, the celery pool children need a new loop
+os.register_at_fork(after_in_child=get_background_loop.cache_clear)
@@ -0,0 +1,263 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from fs.base import FS
+from loguru import logger
+
+from joj.tiger.utils.archive import iter_file
+
+# temporary directories older than this were left by dead processes
+CACHE_TEMP_TTL = 24 * 3600
+
+
+def fs_digest(fs: FS) -> str:
+    """
+    A hash of the paths and the contents of all the files of fs.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(fs.walk.files()):
+        digest.update(path.encode() + b"\0")
+        digest.update(str(fs.getsize(path)).encode() + b"\0")
+        with fs.openbin(path) as f:
+            for chunk in iter_file(f):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+class DirectoryCache:
+    """
+    A cache of read-only directories on the local disk, shared by all the
+    worker processes of the host.
+
+    Entries are keyed by a hash of their parts (e.g. the repo and the commit
+    of a problem), populated in a temporary directory and renamed into place,
+    so they are either complete or missing. An entry in use holds a shared
+    flock on its lock file, which also records its size; the least recently
+    used entries are evicted when the cache exceeds max_size, but only those
+    whose exclusive flock can be taken, i.e. that nobody uses.
+
+    Missing entries are filled in a single flight: concurrent opens of the
+    same key in a process wait for the first one to populate it, and so do
+    the ones of other processes if a fill_lock is given.
+
+    Refs are small named values kept along with the entries, e.g. the last
+    commit of a repo, to find an entry to populate another one from.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_size: int,
+        fill_lock: Optional[Callable[[str], ContextManager[object]]] = None,
+    ):
+        """
+        :param directory: Where the entries are stored.
+
+        :param max_size: The total size of the entries, in bytes, above
+            which the least recently used ones are evicted.
+
+        :param fill_lock: Returns a lock for the given key shared with the
+            other processes using the cache, held while filling the entry.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.fill_lock = fill_lock
+        self._filling: Dict[str, Tuple[threading.Lock, int]] = {}
+        self._filling_lock = threading.Lock()
+        for name in ("entries", "locks", "refs", "tmp"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, "entries", key)
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.directory, "locks", key)
+
+    def _temp_path(self) -> str:
+        return os.path.join(self.directory, "tmp", uuid.uuid4().hex)
+
+    def _ref_path(self, name: str) -> str:
+        return os.path.join(self.directory, "refs", self.key(name))
+
+    def get_ref(self, name: str) -> Optional[str]:
+        try:
+            with open(self._ref_path(name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set_ref(self, name: str, value: str) -> None:
+        temp_path = self._temp_path()
+        with open(temp_path, "w") as f:
+            f.write(value)
+        os.replace(temp_path, self._ref_path(name))
+
+    @contextmanager
+    def _locked(self, key: str) -> Iterator[int]:
+        """
+        Holds the shared flock of the entry, which prevents its eviction.
+        """
+        fd = os.open(self._lock_path(key), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            yield fd
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def open(self, key: str, populate: Callable[[str], None]) -> Iterator[str]:
+        """
+        Yields the path of the entry, which must not be modified, after
+        calling populate with an empty directory to fill if it is missing.
+        The entry cannot be evicted until the context exits.
+        """
+        with self._locked(key) as fd:
+            path = self._entry_path(key)
+            if not os.path.isdir(path):
+                with self._single_flight(key):
+                    if not os.path.isdir(path):
+                        self._populate(fd, path, populate)
+                        self._evict(keep=key)
+            else:
+                # the mtime of an entry is its last use, see _evict
+                os.utime(path)
+            yield path
+
+    @contextmanager
+    def get(self, key: str) -> Iterator[Optional[str]]:
+        """
+        Same as open, but yields None instead of populating a missing entry.
+        """
+        with self._locked(key):
+            path = self._entry_path(key)
+            if not os.path.isdir(path):
+                yield None
+                return
+            os.utime(path)
+            yield path
+
+    def put(self, key: str, populate: Callable[[str], None]) -> None:
+        """
+        Populates the entry if it is missing, see open.
+        """
+        with self.open(key, populate):
+            pass
+
+    @contextmanager
+    def _single_flight(self, key: str) -> Iterator[None]:
+        """
+        Holds the fill locks of key, the one of this process first so that
+        its threads do not compete for the one shared with other processes.
+        """
+        with self._filling_lock:
+            lock, waiters = self._filling.get(key, (threading.Lock(), 0))
+            self._filling[key] = (lock, waiters + 1)
+        try:
+            with lock:
+                if self.fill_lock is None:
+                    yield
+                else:
+                    with self.fill_lock(key):
+                        yield
+        finally:
+            with self._filling_lock:
+                lock, waiters = self._filling[key]
+                if waiters == 1:
+                    del self._filling[key]
+                else:
+                    self._filling[key] = (lock, waiters - 1)
+
+    def _populate(self, fd: int, path: str, populate: Callable[[str], None]) -> None:
+        temp_path = self._temp_path()
+        os.makedirs(temp_path)
+        try:
+            populate(temp_path)
+            os.pwrite(fd, str(directory_size(temp_path)).encode().ljust(20), 0)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # populated by another process meanwhile
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        """
+        Lists (last use, key, size) of all the entries.
+        """
+        entries = []
+        for key in os.listdir(os.path.join(self.directory, "entries")):
+            try:
+                mtime = os.stat(self._entry_path(key)).st_mtime
+                with open(self._lock_path(key), "rb") as f:
+                    size = int(f.read().strip() or 0)
+            except (OSError, ValueError):
+                continue
+            entries.append((mtime, key, size))
+        return entries
+
+    def _evict(self, keep: str) -> None:
+        """
+        Removes the least recently used entries that are not in use until
+        the cache fits in max_size. Evictions are serialized by an exclusive
+        flock on the cache directory.
+        """
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            fcntl.flock(dir_fd, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _, _, size in entries)
+            for _, key, size in entries:
+                if total <= self.max_size:
+                    break
+                if key != keep and self._remove(key):
+                    total -= size
+            self._remove_stale_temps()
+        finally:
+            os.close(dir_fd)
+
+    def _remove_stale_temps(self) -> None:
+        temp_dir = os.path.join(self.directory, "tmp")
+        for name in os.listdir(temp_dir):
+            path = os.path.join(temp_dir, name)
+            try:
+                if time.time() - os.stat(path).st_mtime > CACHE_TEMP_TTL:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                continue
+
+    def _remove(self, key: str) -> bool:
+        fd = os.open(self._lock_path(key), os.O_RDWR)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # renamed first, so that the entry is never seen half removed
+            trash = self._temp_path()
+            os.rename(self._entry_path(key), trash)
+        finally:
+            os.close(fd)
+        logger.info(f"cache entry {key} evicted from {self.directory}")
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
@@ -0,0 +1,28 @@
+import asyncio
+from weakref import WeakKeyDictionary
+
+import aiodocker
+
+_clients: "WeakKeyDictionary[asyncio.AbstractEventLoop, aiodocker.Docker]" = (
+    WeakKeyDictionary()
+)
+
+
+def get_docker() -> aiodocker.Docker:
+    """
+    Returns the docker client bound to the running event loop. The client
+    keeps one pooled aiohttp session over the docker unix socket, so every
+    API call of the loop shares its connections.
+    """
+    loop = asyncio.get_running_loop()
+    docker = _clients.get(loop)
+    if docker is None:
+        docker = aiodocker.Docker()
+        _clients[loop] = docker
+    return docker
+
+
+async def close_docker() -> None:
+    docker = _clients.pop(asyncio.get_running_loop(), None)
+    if docker is not None:
+        await docker.close()
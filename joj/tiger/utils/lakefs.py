@@ -0,0 +1,104 @@
+import base64
+import json
+import os
+import shutil
+import urllib.parse
+import urllib.request
+from typing import Iterable, Iterator, Set, Tuple
+
+from fs.base import FS
+
+LAKEFS_DIFF_PAGE_SIZE = 1000
+LAKEFS_TIMEOUT = 60
+
+# (type, path) of a changed object, the type being added, removed, changed
+# or conflict
+Change = Tuple[str, str]
+
+
+def iter_diff(
+    api_url: str,
+    repo_name: str,
+    left_ref: str,
+    right_ref: str,
+    username: str,
+    password: str,
+    page_size: int = LAKEFS_DIFF_PAGE_SIZE,
+) -> Iterator[Change]:
+    """
+    Lists the objects that differ between two refs of a repository with the
+    diff API of lakefs (api_url being e.g. http://lakefs:8000/api/v1), page
+    by page. The refs are compared directly, not from their merge base.
+    """
+    credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+    url = "{}/repositories/{}/refs/{}/diff/{}".format(
+        api_url.rstrip("/"),
+        urllib.parse.quote(repo_name, safe=""),
+        urllib.parse.quote(left_ref, safe=""),
+        urllib.parse.quote(right_ref, safe=""),
+    )
+    after = ""
+    while True:
+        query = urllib.parse.urlencode(
+            {"after": after, "amount": page_size, "type": "two_dot"}
+        )
+        request = urllib.request.Request(
+            f"{url}?{query}", headers={"Authorization": f"Basic {credentials}"}
+        )
+        with urllib.request.urlopen(request, timeout=LAKEFS_TIMEOUT) as response:
+            page = json.load(response)
+        for result in page["results"]:
+            if result.get("path_type", "object") == "object":
+                yield result["type"], result["path"]
+        pagination = page["pagination"]
+        if not pagination["has_more"]:
+            return
+        after = pagination["next_offset"]
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. another filesystem
+        shutil.copy2(src, dst)
+
+
+def apply_diff(
+    source: FS,
+    base_directory: str,
+    directory: str,
+    changes: Iterable[Change],
+) -> int:
+    """
+    Materializes the files of source in the empty directory, given a copy
+    of an older version of source in base_directory and the changes from
+    that version: unchanged files are hard linked (or copied) from
+    base_directory, so that only the changed ones are read from source.
+    Returns the number of files read from source.
+
+    Files are linked, so neither base_directory nor directory may be
+    modified afterwards.
+    """
+    removed: Set[str] = set()
+    changed: Set[str] = set()
+    for change_type, path in changes:
+        path = os.path.normpath(path.lstrip("/"))
+        if path.startswith(".."):
+            raise ValueError(f"object path out of the repository: {path}")
+        (removed if change_type == "removed" else changed).add(path)
+    for root, _, files in os.walk(base_directory):
+        relative_root = os.path.relpath(root, base_directory)
+        for name in files:
+            path = os.path.normpath(os.path.join(relative_root, name))
+            if path in removed or path in changed:
+                continue
+            target = os.path.join(directory, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _link_or_copy(os.path.join(root, name), target)
+    for path in changed:
+        target = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            source.download("/" + path, f)
+    return len(changed)
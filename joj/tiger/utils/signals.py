@@ -0,0 +1,40 @@
+import asyncio
+import signal
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def cancel_on_signal(signum: int = signal.SIGTERM) -> Iterator[None]:
+    """
+    Cancels the running asyncio task when the process receives signum, e.g.
+    when a celery task is revoked with terminate=True. The cancellation
+    propagates through the awaited runner calls, which kill their commands
+    inside the runners and hand the runners back, instead of the process
+    being terminated with its commands still running.
+
+    The previous handler (e.g. the warm shutdown of the celery worker) is
+    restored on exit. Nothing is installed off the main thread (e.g. with
+    -P threads) or where the loop does not support signal handlers (e.g.
+    on Windows), the task is then terminated as before.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    assert task is not None
+    previous = signal.getsignal(signum)
+    try:
+        loop.add_signal_handler(signum, task.cancel)
+    except NotImplementedError:
+        yield
+        return
+    try:
+        yield
+    finally:
+        loop.remove_signal_handler(signum)
+        # None if the previous handler was not installed from python
+        if previous is not None:
+            signal.signal(signum, previous)
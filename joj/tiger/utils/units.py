@@ -0,0 +1,45 @@
+from typing import Union
+
+_MEMORY_UNITS = {
+    "b": 1,
+    "k": 2**10,
+    "m": 2**20,
+    "g": 2**30,
+}
+
+
+_TIME_UNITS = {
+    "ms": 1,
+    "s": 1000,
+    "m": 60 * 1000,
+    "h": 60 * 60 * 1000,
+}
+
+
+def parse_time(value: Union[int, str]) -> int:
+    """
+    Converts a duration (e.g. "500ms", "1.5s", "2m") into milliseconds.
+    Integers and strings without a unit are treated as milliseconds.
+    """
+    if isinstance(value, int):
+        return value
+    value = value.strip().lower()
+    for unit in sorted(_TIME_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[: -len(unit)]) * _TIME_UNITS[unit])
+    return int(value)
+
+
+def parse_memory(value: Union[int, str]) -> int:
+    """
+    Converts a memory size in the docker notation (e.g. "512m", "4g")
+    into bytes. Integers are treated as bytes.
+    """
+    if isinstance(value, int):
+        return value
+    value = value.strip().lower()
+    if value.endswith("b") and value[:-1] and not value[:-1].isdigit():
+        value = value[:-1]
+    if value and value[-1] in _MEMORY_UNITS:
+        return int(float(value[:-1]) * _MEMORY_UNITS[value[-1]])
+    return int(value)
@@ -0,0 +1,176 @@
+package main
+
+import (
+	"bufio"
+	"encoding/binary"
+	"errors"
+	"fmt"
+	"io"
+	"os"
+	"sync"
+
+	"github.com/containerd/cgroups"
+	"github.com/vmihailenco/msgpack/v5"
+)
+
+// Requests of the daemon are msgpack maps of commandRequest, responses are
+// results encoded by encodeResult, both prefixed with their length as a
+// big-endian uint32. Responses carry the ID of the request they answer.
+
+func readFrame(r io.Reader) ([]byte, error) {
+	var header [4]byte
+	if _, err := io.ReadFull(r, header[:]); err != nil {
+		return nil, err
+	}
+	body := make([]byte, binary.BigEndian.Uint32(header[:]))
+	if _, err := io.ReadFull(r, body); err != nil {
+		return nil, err
+	}
+	return body, nil
+}
+
+func writeFrame(w io.Writer, body []byte) error {
+	frame := make([]byte, 4+len(body))
+	binary.BigEndian.PutUint32(frame, uint32(len(body)))
+	copy(frame[4:], body)
+	_, err := w.Write(frame)
+	return err
+}
+
+var errKilled = errors.New("killed")
+
+// killSwitch lets kill requests, which are read while a command is running,
+// reach the running command or the queued ones. Request IDs are increasing.
+type killSwitch struct {
+	mu      sync.Mutex
+	last    uint64
+	running uint64
+	cancel  chan struct{}
+	killed  map[uint64]bool
+}
+
+// start registers request id as running and returns the channel closed when
+// it is killed, or false if it was killed before starting.
+func (k *killSwitch) start(id uint64) (<-chan struct{}, bool) {
+	k.mu.Lock()
+	defer k.mu.Unlock()
+	if k.killed[id] {
+		delete(k.killed, id)
+		return nil, false
+	}
+	k.last = id
+	k.running = id
+	k.cancel = make(chan struct{})
+	return k.cancel, true
+}
+
+func (k *killSwitch) finish() {
+	k.mu.Lock()
+	defer k.mu.Unlock()
+	k.running = 0
+	k.cancel = nil
+}
+
+func (k *killSwitch) kill(id uint64) {
+	k.mu.Lock()
+	defer k.mu.Unlock()
+	if id == k.running && k.cancel != nil {
+		close(k.cancel)
+		k.cancel = nil
+		return
+	}
+	if id > k.last {
+		// queued, requests that already finished are ignored
+		k.killed[id] = true
+	}
+}
+
+// readRequests decodes requests from r until EOF, then closes requests.
+// Kill requests are handled right away instead of being queued.
+func readRequests(r io.Reader, requests chan<- commandRequest, kills *killSwitch) {
+	defer close(requests)
+	reader := bufio.NewReader(r)
+	for {
+		body, err := readFrame(reader)
+		if err != nil {
+			if err != io.EOF {
+				fmt.Fprintf(os.Stderr, "read request: %v\n", err)
+			}
+			return
+		}
+		var request commandRequest
+		if err := msgpack.Unmarshal(body, &request); err != nil {
+			fmt.Fprintf(os.Stderr, "decode request: %v\n", err)
+			return
+		}
+		if request.Kill != 0 {
+			kills.kill(request.Kill)
+			continue
+		}
+		requests <- request
+	}
+}
+
+// leftoverChargeLimit is how much memory may stay charged to the cgroup once
+// a command is done before the cgroup is created again. Pages are charged to
+// the cgroup that first used them and outlive the processes, so the files
+// written by a command on a tmpfs would otherwise count against the memory
+// limit and usage of all the following commands.
+const leftoverChargeLimit = 1 << 20
+
+// renewControl replaces the cgroup by a new one if too much memory is left
+// charged to it, see leftoverChargeLimit. The charge goes to the parent
+// cgroup, i.e. it still counts against the memory limit of the container.
+func renewControl(control cgroups.Cgroup) cgroups.Cgroup {
+	if memoryUsage() <= leftoverChargeLimit {
+		return control
+	}
+	if err := control.Delete(); err != nil {
+		fmt.Fprintf(os.Stderr, "delete cgroup: %v\n", err)
+		return control
+	}
+	renewed, err := newControl()
+	if err != nil {
+		panic(err)
+	}
+	return renewed
+}
+
+// runDaemon serves requests from stdin one at a time, reusing a single
+// cgroup for all of them (unless renewed, see renewControl), until stdin is
+// closed.
+func runDaemon() {
+	control, err := newControl()
+	if err != nil {
+		panic(err)
+	}
+	defer func() { control.Delete() }()
+	requests := make(chan commandRequest, 64)
+	kills := &killSwitch{killed: make(map[uint64]bool)}
+	go readRequests(os.Stdin, requests, kills)
+	for request := range requests {
+		var command completedCommand
+		if len(request.Args) == 0 {
+			command.Error = "empty command"
+		} else if cancel, ok := kills.start(request.ID); !ok {
+			command.Error = errKilled.Error()
+		} else {
+			resetStats()
+			command, err = runCommand(control, request, cancel)
+			kills.finish()
+			if err != nil {
+				command.Error = err.Error()
+			}
+			control = renewControl(control)
+		}
+		command.ID = request.ID
+		b, err := encodeResult(command)
+		if err != nil {
+			panic(err)
+		}
+		if err := writeFrame(os.Stdout, b); err != nil {
+			fmt.Fprintf(os.Stderr, "write response: %v\n", err)
+			return
+		}
+	}
+}
@@ -0,0 +1,117 @@
+package main
+
+import (
+	"bufio"
+	"os"
+	"os/exec"
+	"strconv"
+	"strings"
+	"syscall"
+	"time"
+)
+
+// cpuPollInterval is how often the cpu time of a command with a time limit
+// is checked, i.e. how late a command may be killed after its limit.
+const cpuPollInterval = 10 * time.Millisecond
+
+func cgroupFile(subsystem string, name string) string {
+	return "/sys/fs/cgroup/" + subsystem + cgroupPath + "/" + name
+}
+
+// setLimits writes the limits of a request into the cgroup, and resets the
+// ones it does not set, since the cgroup is shared by all the commands of
+// the daemon. The files are written directly rather than through
+// control.Update, which cannot clear a limit.
+//
+// The oom killer is enabled in the cgroup: the container disables it, and
+// its cgroup passes the setting on, so a command reaching its memory limit
+// would otherwise hang until it times out instead of being killed.
+func setLimits(request commandRequest) error {
+	cpus := request.Cpuset
+	if cpus == "" {
+		parent, err := os.ReadFile("/sys/fs/cgroup/cpuset/cpuset.cpus")
+		if err != nil {
+			return err
+		}
+		cpus = strings.TrimSpace(string(parent))
+	}
+	memory := "-1"
+	if request.MemoryLimit > 0 {
+		memory = strconv.FormatInt(request.MemoryLimit, 10)
+	}
+	pids := "max"
+	if request.PidsLimit > 0 {
+		pids = strconv.FormatInt(request.PidsLimit, 10)
+	}
+	for file, value := range map[string]string{
+		cgroupFile("cpuset", "cpuset.cpus"):           cpus,
+		cgroupFile("memory", "memory.limit_in_bytes"): memory,
+		cgroupFile("memory", "memory.oom_control"):    "0",
+		cgroupFile("pids", "pids.max"):                pids,
+	} {
+		if err := os.WriteFile(file, []byte(value), 0); err != nil {
+			return err
+		}
+	}
+	return nil
+}
+
+// cpuUsage returns the cpu time used by the cgroup, in nanoseconds.
+func cpuUsage() uint64 {
+	b, err := os.ReadFile(cgroupFile("cpuacct", "cpuacct.usage"))
+	if err != nil {
+		return 0
+	}
+	usage, _ := strconv.ParseUint(strings.TrimSpace(string(b)), 10, 64)
+	return usage
+}
+
+// memoryUsage returns the memory charged to the cgroup, in bytes.
+func memoryUsage() uint64 {
+	b, err := os.ReadFile(cgroupFile("memory", "memory.usage_in_bytes"))
+	if err != nil {
+		return 0
+	}
+	usage, _ := strconv.ParseUint(strings.TrimSpace(string(b)), 10, 64)
+	return usage
+}
+
+// readOOMKills returns the number of processes of the cgroup killed by the
+// oom killer so far (this counter cannot be reset).
+func readOOMKills() uint64 {
+	f, err := os.Open(cgroupFile("memory", "memory.oom_control"))
+	if err != nil {
+		return 0
+	}
+	defer f.Close()
+	scanner := bufio.NewScanner(f)
+	for scanner.Scan() {
+		if line := scanner.Text(); strings.HasPrefix(line, "oom_kill ") {
+			kills, _ := strconv.ParseUint(strings.TrimPrefix(line, "oom_kill "), 10, 64)
+			return kills
+		}
+	}
+	return 0
+}
+
+// startWithStackLimit starts cmd with RLIMIT_STACK set to limit. The limit
+// is inherited from this process, so it is set here for the duration of
+// the fork only; commands are started one at a time.
+func startWithStackLimit(cmd *exec.Cmd, limit int64) error {
+	if limit <= 0 {
+		return cmd.Start()
+	}
+	var original syscall.Rlimit
+	if err := syscall.Getrlimit(syscall.RLIMIT_STACK, &original); err != nil {
+		return err
+	}
+	stack := syscall.Rlimit{Cur: uint64(limit), Max: original.Max}
+	if stack.Max != ^uint64(0) && stack.Cur > stack.Max {
+		stack.Cur = stack.Max
+	}
+	if err := syscall.Setrlimit(syscall.RLIMIT_STACK, &stack); err != nil {
+		return err
+	}
+	defer syscall.Setrlimit(syscall.RLIMIT_STACK, &original)
+	return cmd.Start()
+}
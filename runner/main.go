@@ -1,13 +1,15 @@
 package main
 
 import (
-	"bytes"
+	"encoding/binary"
+	"flag"
 	"fmt"
 	"os"
 	"os/exec"
 
 	// "os/user"
-	// "strconv"
+	"strconv"
+	"strings"
 	"syscall"
 	"time"
 
@@ -16,91 +18,326 @@ import (
 	"github.com/vmihailenco/msgpack/v5"
 )
 
+const (
+	// daemonCgroupPath is the cgroup of the commands of a daemon.
+	daemonCgroupPath = "/joj.tiger"
+	// oneShotCgroupPrefix names the cgroups of one-shot commands after their
+	// --name (or the pid of their runner), so that they never share a cgroup
+	// (nor the kills of killAll) with the commands of a daemon or of each
+	// other.
+	oneShotCgroupPrefix = "/joj.tiger-oneshot-"
+)
+
+// cgroupPath is the cgroup of the commands run by this process.
+var cgroupPath = daemonCgroupPath
+
+// commandRequest describes a command to run, it is either built from the
+// command line flags or sent by tiger to the daemon.
+type commandRequest struct {
+	ID             uint64
+	Args           []string
+	TruncateStdout int64
+	TruncateStderr int64
+	OutputLimit    int64
+	StdoutFile     string
+	StderrFile     string
+	StdinFile      string // opened as the stdin of the command, /dev/null if empty
+	Cpuset         string
+	TimeLimit      int64 // cpu time in milliseconds
+	MemoryLimit    int64 // bytes
+	StackLimit     int64 // bytes
+	PidsLimit      int64
+	// Kill is set by requests of the daemon asking to kill the command of
+	// the request with this ID, running or queued, instead of running one
+	Kill uint64
+}
+
+// completedCommand is written as a length-prefixed msgpack header followed
+// by the raw stdout and stderr, see encodeResult.
 type completedCommand struct {
-	ReturnCode int
-	Stdout     []byte
-	Stderr     []byte
-	TimedOut   bool
-	Time       uint64
-	Memory     uint64
+	ID                  uint64 `msgpack:",omitempty"`
+	ReturnCode          int
+	Stdout              []byte `msgpack:"-"`
+	Stderr              []byte `msgpack:"-"`
+	StdoutSize          int
+	StderrSize          int
+	StdoutTruncated     bool
+	StderrTruncated     bool
+	TimedOut            bool
+	MemoryLimitExceeded bool
+	OutputLimitExceeded bool
+	Time                uint64
+	Memory              uint64
+	Error               string `msgpack:",omitempty"`
 }
 
-func main() {
-	if len(os.Args) < 2 {
-		fmt.Println("usage: " + os.Args[0] + " <command>")
+func newControl() (cgroups.Cgroup, error) {
+	return cgroups.New(
+		cgroups.V1,
+		cgroups.StaticPath(cgroupPath),
+		&specs.LinuxResources{},
+	)
+}
+
+// resetStats clears the accounting of the cgroup, so that it can be reused
+// by the next command without being deleted and created again.
+func resetStats() {
+	for _, file := range []string{
+		"/sys/fs/cgroup/cpuacct" + cgroupPath + "/cpuacct.usage",
+		"/sys/fs/cgroup/memory" + cgroupPath + "/memory.max_usage_in_bytes",
+		"/sys/fs/cgroup/memory" + cgroupPath + "/memory.failcnt",
+	} {
+		if err := os.WriteFile(file, []byte("0"), 0); err != nil {
+			fmt.Fprintf(os.Stderr, "reset %s: %v\n", file, err)
+		}
+	}
+}
+
+// encodeResult serializes a result so that tiger can slice the outputs out
+// of its buffer instead of decoding (and copying) them.
+func encodeResult(command completedCommand) ([]byte, error) {
+	command.StdoutSize = len(command.Stdout)
+	command.StderrSize = len(command.Stderr)
+	header, err := msgpack.Marshal(&command)
+	if err != nil {
+		return nil, err
+	}
+	b := make([]byte, 4, 4+len(header)+len(command.Stdout)+len(command.Stderr))
+	binary.BigEndian.PutUint32(b, uint32(len(header)))
+	b = append(b, header...)
+	b = append(b, command.Stdout...)
+	return append(b, command.Stderr...), nil
+}
+
+// killAll kills every process of the cgroup: a command on timeout with all
+// its children, or the processes a command left behind (e.g. daemonized
+// children), so that they cannot interfere with the next command. The
+// cgroup is frozen meanwhile so that nothing can fork.
+func killAll(control cgroups.Cgroup) {
+	if err := control.Freeze(); err != nil {
+		fmt.Fprintf(os.Stderr, "freeze: %v\n", err)
+	}
+	defer control.Thaw()
+	processes, err := control.Processes(cgroups.Freezer, true)
+	if err != nil {
+		fmt.Fprintf(os.Stderr, "list processes: %v\n", err)
+		return
+	}
+	for _, process := range processes {
+		syscall.Kill(process.Pid, syscall.SIGKILL)
+	}
+}
+
+// killOneShot kills the processes of the one-shot command run with --name
+// name, leaving the other commands alone: the commands of the daemons are
+// killed through their daemon, with kill requests.
+func killOneShot(name string) {
+	if name == "" || strings.ContainsAny(name, "/.") {
+		fmt.Fprintf(os.Stderr, "invalid command name: %q\n", name)
 		os.Exit(1)
 	}
+	control, err := cgroups.Load(cgroups.V1, cgroups.StaticPath(oneShotCgroupPrefix+name))
+	if err != nil {
+		// the command finished meanwhile
+		fmt.Fprintf(os.Stderr, "load cgroup %s: %v\n", name, err)
+		return
+	}
+	killAll(control)
+}
+
+// runCommand runs a request in the cgroup. The command is killed, and
+// errKilled returned with its result, if cancel is closed before it exits.
+func runCommand(control cgroups.Cgroup, request commandRequest, cancel <-chan struct{}) (completedCommand, error) {
 	// u, err := user.Lookup(os.Getenv("SUDO_USER"))
 	// if err != nil {
 	// 	panic(err)
 	// }
-	timeoutMs := 1000
-	control, err := cgroups.New(
-		cgroups.V1,
-		cgroups.StaticPath("/joj.tiger"),
-		&specs.LinuxResources{},
-	)
-	if err != nil {
-		panic(err)
-	}
-	defer control.Delete()
-	cmd := exec.Command(os.Args[1], os.Args[2:]...)
+	args := request.Args
+	cmd := exec.Command(args[0], args[1:]...)
 	cmd.SysProcAttr = &syscall.SysProcAttr{}
 	// run command as non-root
 	// uid, _ := strconv.ParseUint(u.Uid, 10, 32)
 	// gid, _ := strconv.ParseUint(u.Gid, 10, 32)
 	// cmd.SysProcAttr.Credential = &syscall.Credential{Uid: uint32(uid), Gid: uint32(gid)}
-	var stdout, stderr bytes.Buffer
-	cmd.Stdout = &stdout
-	cmd.Stderr = &stderr
-	start := time.Now()
-	err = cmd.Start()
+	if request.StdinFile != "" {
+		// the child reads the file directly, nothing is copied by the runner
+		stdin, err := os.Open(request.StdinFile)
+		if err != nil {
+			return completedCommand{}, err
+		}
+		defer stdin.Close()
+		cmd.Stdin = stdin
+	}
+	if err := setLimits(request); err != nil {
+		return completedCommand{}, err
+	}
+	oomKills := readOOMKills()
+	outputExceeded, closeOutputExceeded := onceCloser()
+	stdout, err := newOutputCapture(request.TruncateStdout, request.OutputLimit, request.StdoutFile, closeOutputExceeded)
 	if err != nil {
-		panic(err)
+		return completedCommand{}, err
+	}
+	defer stdout.Close()
+	stderr, err := newOutputCapture(request.TruncateStderr, request.OutputLimit, request.StderrFile, closeOutputExceeded)
+	if err != nil {
+		return completedCommand{}, err
+	}
+	defer stderr.Close()
+	cmd.Stdout = stdout
+	cmd.Stderr = stderr
+	start := time.Now()
+	if err := startWithStackLimit(cmd, request.StackLimit); err != nil {
+		return completedCommand{}, err
 	}
 	pid := cmd.Process.Pid
 	fmt.Fprintf(os.Stderr, "pid: %d\n", pid)
 	if err := control.Add(cgroups.Process{Pid: pid}); err != nil {
-		panic(err)
+		cmd.Process.Kill()
+		cmd.Wait()
+		return completedCommand{}, err
 	}
 	var returnCode int
 	exitCode := make(chan int, 1)
 	go func(exit_code chan int) {
-		if err = cmd.Wait(); err != nil {
-			exit_code <- err.(*exec.ExitError).ExitCode()
+		err := cmd.Wait()
+		if exitErr, ok := err.(*exec.ExitError); ok {
+			exit_code <- exitErr.ExitCode()
 		} else {
-			exit_code <- 0
+			exit_code <- cmd.ProcessState.ExitCode()
 		}
 	}(exitCode)
-	timeoutLimit := time.Duration(timeoutMs) * time.Millisecond
+	// the command is killed as soon as its cpu time exceeds the limit, or
+	// when it has run for twice the limit (e.g. sleeping or blocked on io)
+	var cpuTicker, wallDeadline <-chan time.Time
+	if request.TimeLimit > 0 {
+		ticker := time.NewTicker(cpuPollInterval)
+		defer ticker.Stop()
+		cpuTicker = ticker.C
+		wallDeadline = time.After(2 * time.Duration(request.TimeLimit) * time.Millisecond)
+	}
 	timedOut := false
+	killed := false
+	outputLimitExceeded := false
+wait:
+	for {
+		select {
+		case returnCode = <-exitCode:
+			fmt.Fprintf(os.Stderr, "status: done in %v\n", time.Since(start))
+			break wait
+		case <-cpuTicker:
+			if cpuUsage() <= uint64(request.TimeLimit)*uint64(time.Millisecond) {
+				continue
+			}
+			fmt.Fprintf(os.Stderr, "status: time limit exceeded in %v\n", time.Since(start))
+			killAll(control)
+			returnCode = <-exitCode
+			timedOut = true
+			break wait
+		case <-wallDeadline:
+			fmt.Fprintf(os.Stderr, "status: timeout in %v\n", time.Since(start))
+			killAll(control)
+			returnCode = <-exitCode
+			timedOut = true
+			break wait
+		case <-outputExceeded:
+			fmt.Fprintf(os.Stderr, "status: output limit exceeded in %v\n", time.Since(start))
+			killAll(control)
+			returnCode = <-exitCode
+			break wait
+		case <-cancel:
+			fmt.Fprintf(os.Stderr, "status: killed in %v\n", time.Since(start))
+			killAll(control)
+			returnCode = <-exitCode
+			killed = true
+			break wait
+		}
+	}
 	select {
-	case returnCode = <-exitCode:
-		fmt.Fprintf(os.Stderr, "status: done in %v\n", time.Since(start))
-	case <-time.After(timeoutLimit):
-		fmt.Fprintf(os.Stderr, "status: timeout in %v\n", time.Since(start))
-		cmd.Process.Kill()
-		returnCode = <-exitCode
-		timedOut = true
+	case <-outputExceeded:
+		outputLimitExceeded = true
+	default:
 	}
+	killAll(control)
 	stats, _ := control.Stat(cgroups.IgnoreNotExist)
+	if request.TimeLimit > 0 && stats.CPU.Usage.Total > uint64(request.TimeLimit)*uint64(time.Millisecond) {
+		timedOut = true
+	}
+	// the oom killer of the cgroup killed the command (or one of its
+	// children), see setLimits
+	memoryLimitExceeded := readOOMKills() > oomKills
 	fmt.Fprintf(os.Stderr, "return_code: %d\n", returnCode)
 	fmt.Fprintf(os.Stderr, "time: %d\n", stats.CPU.Usage.Total)
 	fmt.Fprintf(os.Stderr, "memory: %d\n", stats.Memory.Usage.Max) // Memory.Usage.Max = 0 when killed
-	fmt.Fprintf(os.Stderr, "stdout: %s\n", stdout.String())
-	fmt.Fprintf(os.Stderr, "stderr: %s\n", stderr.String())
 	fmt.Fprintf(os.Stderr, "timed_out: %v\n", timedOut)
 	command := completedCommand{
-		ReturnCode: returnCode,
-		Stdout:     stdout.Bytes(),
-		Stderr:     stderr.Bytes(),
-		TimedOut:   timedOut,
-		Time:       stats.CPU.Usage.Total,
-		Memory:     stats.Memory.Usage.Max,
-	}
-	b, err := msgpack.Marshal(&command)
+		ReturnCode:          returnCode,
+		Stdout:              stdout.Bytes(),
+		Stderr:              stderr.Bytes(),
+		StdoutTruncated:     stdout.truncated,
+		StderrTruncated:     stderr.truncated,
+		TimedOut:            timedOut,
+		MemoryLimitExceeded: memoryLimitExceeded,
+		OutputLimitExceeded: outputLimitExceeded,
+		Time:                stats.CPU.Usage.Total,
+		Memory:              stats.Memory.Usage.Max,
+	}
+	if killed {
+		return command, errKilled
+	}
+	return command, nil
+}
+
+func main() {
+	daemon := flag.Bool("daemon", false, "serve length-prefixed msgpack requests on stdin")
+	name := flag.String("name", "", "name of the command, to kill it with --kill, its pid if empty")
+	kill := flag.String("kill", "", "kill every process of the one-shot command run with this --name")
+	var request commandRequest
+	flag.Int64Var(&request.TruncateStdout, "truncate_stdout", -1, "stdout bytes kept in the result, 32 MiB if negative")
+	flag.Int64Var(&request.TruncateStderr, "truncate_stderr", -1, "stderr bytes kept in the result, 32 MiB if negative")
+	flag.Int64Var(&request.OutputLimit, "output_limit", 0, "kill the command once a stream exceeds this many bytes")
+	flag.StringVar(&request.StdoutFile, "stdout_file", "", "copy the whole stdout into this file")
+	flag.StringVar(&request.StderrFile, "stderr_file", "", "copy the whole stderr into this file")
+	flag.StringVar(&request.StdinFile, "stdin_file", "", "open this file as the stdin of the command")
+	flag.StringVar(&request.Cpuset, "cpuset", "", "pin the command to these cpus")
+	flag.Int64Var(&request.TimeLimit, "time_limit", 0, "cpu time limit in milliseconds")
+	flag.Int64Var(&request.MemoryLimit, "memory_limit", 0, "memory limit in bytes")
+	flag.Int64Var(&request.StackLimit, "stack_limit", 0, "stack size limit in bytes")
+	flag.Int64Var(&request.PidsLimit, "pids_limit", 0, "maximum number of processes")
+	flag.Parse()
+	if *daemon {
+		runDaemon()
+		return
+	}
+	if *kill != "" {
+		killOneShot(*kill)
+		return
+	}
+	request.Args = flag.Args()
+	if len(request.Args) < 1 {
+		fmt.Println("usage: " + os.Args[0] + " [flags] <command>")
+		os.Exit(1)
+	}
+	if *name == "" {
+		*name = strconv.Itoa(os.Getpid())
+	} else if strings.ContainsAny(*name, "/.") {
+		fmt.Fprintf(os.Stderr, "invalid command name: %q\n", *name)
+		os.Exit(1)
+	}
+	cgroupPath = oneShotCgroupPrefix + *name
+	control, err := newControl()
+	if err != nil {
+		panic(err)
+	}
+	defer control.Delete()
+	command, err := runCommand(control, request, nil)
+	if err != nil {
+		panic(err)
+	}
+	fmt.Fprintf(os.Stderr, "stdout: %s\n", command.Stdout)
+	fmt.Fprintf(os.Stderr, "stderr: %s\n", command.Stderr)
+	b, err := encodeResult(command)
 	if err != nil {
 		panic(err)
 	}
-	fmt.Printf("%v\n", string(b))
+	os.Stdout.Write(b)
 }
@@ -0,0 +1,87 @@
+package main
+
+import (
+	"errors"
+	"os"
+	"sync"
+)
+
+// defaultTruncate bounds the output kept in memory when no limit is given
+// (a negative one), see RUNNER_DEFAULT_TRUNCATE in runner.py.
+const defaultTruncate = 32 << 20
+
+var errOutputLimitExceeded = errors.New("output limit exceeded")
+
+// outputCapture keeps a bounded prefix of a stream in memory and, when a
+// file is given, copies the whole stream into it. When more than
+// outputLimit bytes are written, exceeded is called and writes fail, so
+// that the process can be killed before it fills the disk or the memory.
+type outputCapture struct {
+	buf         []byte
+	limit       int64
+	truncated   bool
+	total       int64
+	outputLimit int64
+	file        *os.File
+	exceeded    func()
+}
+
+func newOutputCapture(limit int64, outputLimit int64, path string, exceeded func()) (*outputCapture, error) {
+	if limit < 0 {
+		limit = defaultTruncate
+	}
+	c := &outputCapture{limit: limit, outputLimit: outputLimit, exceeded: exceeded}
+	if path != "" {
+		file, err := os.Create(path)
+		if err != nil {
+			return nil, err
+		}
+		c.file = file
+	}
+	return c, nil
+}
+
+func (c *outputCapture) Write(p []byte) (int, error) {
+	n := len(p)
+	var err error
+	if c.outputLimit > 0 && c.total+int64(len(p)) > c.outputLimit {
+		p = p[:c.outputLimit-c.total]
+		c.truncated = true
+		c.exceeded()
+		err = errOutputLimitExceeded
+	}
+	c.total += int64(len(p))
+	if c.file != nil {
+		if _, err := c.file.Write(p); err != nil {
+			return 0, err
+		}
+	}
+	if room := c.limit - int64(len(c.buf)); int64(len(p)) > room {
+		c.buf = append(c.buf, p[:room]...)
+		c.truncated = true
+	} else {
+		c.buf = append(c.buf, p...)
+	}
+	if err != nil {
+		return len(p), err
+	}
+	return n, nil
+}
+
+func (c *outputCapture) Bytes() []byte {
+	return c.buf
+}
+
+func (c *outputCapture) Close() error {
+	if c.file == nil {
+		return nil
+	}
+	return c.file.Close()
+}
+
+// onceCloser returns a channel and a function closing it at most once.
+func onceCloser() (chan struct{}, func()) {
+	ch := make(chan struct{})
+	var once sync.Once
+	return ch, func() { once.Do(func() { close(ch) }) }
+}